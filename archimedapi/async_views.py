@@ -0,0 +1,241 @@
+import asyncio
+import os
+
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from pymongo.errors import DuplicateKeyError
+from rest_framework import status
+
+from db_connection import get_async_collection
+from utils.bill_utils import acheck_existing_bill, compute_investment_fee, compute_membership_fee, duplicate_bill_error
+from utils import cache
+from utils.cache import bump_generation, cache_document, get_cached_document, invalidate_documents
+from utils.currency_conversion import convert_currency
+from utils.expand import add_bill_totals, expand_pipeline, expand_projection, parse_expand
+from utils.filters import list_filter, list_projection
+from utils.identity_map import aget_document, forget_document
+from utils.investor_summary import record_bills_created
+from utils.json_codec import BSONJsonResponse, dumps, loads
+from utils.logger import log_payload, logger
+from utils.pagination import apaginate
+from utils.streaming import STREAM_FORMATS, astream_documents
+from utils.versioning import document_etag, etag_matches, last_modified, stamp_new, stamped
+
+from .models import (
+    BillModel,
+    BillType,
+    bill_model,
+    capital_call_model,
+    entity_model,
+    investment_model,
+    investor_summary_model,
+)
+from .views import paginated_response, versioned_response
+
+# Async versions of the read routes and of bill_investor, served under /async/ by ASGI
+# servers. MongoDB is queried through pymongo's AsyncMongoClient, the lookups that do not
+# depend on each other run concurrently. Redis (caches, exchange rates, generations) and the
+# investor summary hooks are still sync and run in a thread pool.
+
+def run_sync(function, *args):
+    return sync_to_async(function, thread_sensitive=False)(*args)
+
+async def list_response(request, collection, name, expandable=False):
+    user = await request.auser()
+    logger.info("async %s list view called with method %s by user %s", name, request.method, user)
+    expand = []
+    try:
+        query = list_filter(collection, request.GET)
+        projection = list_projection(collection, request.GET)
+        output_format = request.GET.get("stream")
+        if output_format:
+            if output_format not in STREAM_FORMATS:
+                return JsonResponse({'error': f"Invalid stream format {output_format}"}, status=status.HTTP_400_BAD_REQUEST)
+            logger.info("Streaming %s matching %s for user %s", name, query, user)
+            cursor = get_async_collection(collection).find(query, projection)
+            return StreamingHttpResponse(astream_documents(cursor, output_format), content_type=STREAM_FORMATS[output_format])
+        if expandable:
+            expand = parse_expand(request.GET.get("expand"))
+            projection = expand_projection(projection, expand)
+        documents, next_cursor = await apaginate(get_async_collection(collection), request.GET, query, expand_pipeline(expand), projection)
+    except ValueError as e:
+        logger.error("Invalid query parameters: %s", e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if "bills" in expand:
+        add_bill_totals(documents)
+    logger.info("Returning %d %s for user %s", len(documents), name, user)
+    return paginated_response(request, documents, next_cursor)
+
+async def document_response(request, collection, pk, name):
+    """Async version of views.document_response."""
+    user = await request.auser()
+    logger.info("async %s detail view called with method %s for id %s by user %s", name, request.method, pk, user)
+    entry = await run_sync(get_cached_document, collection, pk) if cache.DETAIL_CACHE_ENABLED else None
+    if entry is None:
+        async_collection = get_async_collection(collection)
+        try:
+            if_none_match = request.headers.get("If-None-Match")
+            if if_none_match:
+                stamp = await async_collection.find_one({"_id": ObjectId(pk)}, {"_version": 1, "updated_at": 1})
+                if stamp and etag_matches(if_none_match, document_etag(stamp)):
+                    logger.info("%s with id %s not modified for user %s", name.capitalize(), pk, user)
+                    return versioned_response(request, {"etag": document_etag(stamp), "last_modified": last_modified(stamp)})
+            document = await async_collection.find_one({"_id": ObjectId(pk)})
+        except Exception as e:
+            logger.error("Error retrieving %s with id %s: %s", name, pk, e)
+            return JsonResponse({'message': f'Error retrieving the {name}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not document:
+            logger.error("%s with id %s does not exist, requested by user %s", name.capitalize(), pk, user)
+            return JsonResponse({'message': f'The {name} does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        body = dumps(document)
+        entry = {"body": body, "etag": document_etag(document, body), "last_modified": last_modified(document)}
+        if cache.DETAIL_CACHE_ENABLED:
+            await run_sync(cache_document, collection, pk, entry)
+    logger.info("Returning %s data for id %s to user %s", name, pk, user)
+    return versioned_response(request, entry)
+
+@require_GET
+async def bill_list(request):
+    return await list_response(request, bill_model, "bills")
+
+@require_GET
+async def capital_call_list(request):
+    return await list_response(request, capital_call_model, "capital calls", expandable=True)
+
+@require_GET
+async def investment_list(request):
+    return await list_response(request, investment_model, "investments")
+
+@require_GET
+async def entity_list(request):
+    return await list_response(request, entity_model, "entities")
+
+@require_GET
+async def bill_detail(request, pk):
+    return await document_response(request, bill_model, pk, "bill")
+
+@require_GET
+async def capital_call_detail(request, pk):
+    if not request.GET.get("expand"):
+        return await document_response(request, capital_call_model, pk, "capital call")
+    user = await request.auser()
+    logger.info("async capital call detail view called with method %s for id %s by user %s", request.method, pk, user)
+    try:
+        expand = parse_expand(request.GET["expand"])
+    except ValueError as e:
+        logger.error("Invalid expand parameter: %s", e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        cursor = await get_async_collection(capital_call_model).aggregate([{"$match": {"_id": ObjectId(pk)}}, *expand_pipeline(expand)])
+        capital_call = next(iter(await cursor.to_list()), None)
+    except Exception as e:
+        logger.error("Error retrieving capital call with id %s: %s", pk, e)
+        return JsonResponse({'message': 'Error retrieving the capital call'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if not capital_call:
+        logger.error("Capital call with id %s does not exist, requested by user %s", pk, user)
+        return JsonResponse({'message': 'The capital call does not exist'}, status=status.HTTP_404_NOT_FOUND)
+    if "bills" in expand:
+        add_bill_totals([capital_call])
+    logger.info("Returning capital call data for id %s expanded with %s to user %s", pk, ", ".join(expand), user)
+    return BSONJsonResponse(capital_call)
+
+@require_GET
+async def investment_detail(request, pk):
+    return await document_response(request, investment_model, pk, "investment")
+
+@require_GET
+async def entity_detail(request, pk):
+    return await document_response(request, entity_model, pk, "entity")
+
+def record_bill_created(bill, capital_call_id):
+    record_bills_created([bill])
+    bump_generation(bill_model)
+    invalidate_documents(capital_call_model, [capital_call_id])
+
+@csrf_exempt
+@require_POST
+async def bill_investor(request):
+    user = await request.auser()
+    logger.info("async bill_investor view called with method %s by user %s", request.method, user)
+    try:
+        data = loads(request.body) if request.body else None
+    except ValueError as e:
+        return JsonResponse({'error': f"JSON parse error - {e}"}, status=status.HTTP_400_BAD_REQUEST)
+    if not data:
+        logger.error("No bill data provided by user %s", user)
+        return JsonResponse({'error': 'bill data is required'}, status=status.HTTP_400_BAD_REQUEST)
+    log_payload("Received bill data", data)
+    year = data.get("fees_year", 0)
+    data["fees_year"] = int(year)
+    investor_id = data.get("to_investor_id")
+    investment_id = data.get("investment_id")
+    if not investor_id:
+        logger.error("to_investor_id is missing in the request by user %s", user)
+        return JsonResponse({'error': 'to_investor_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not ObjectId.is_valid(investor_id):
+        logger.error("Invalid investor_id %s", investor_id)
+        return JsonResponse({'error': 'Invalid investor_id'}, status=status.HTTP_400_BAD_REQUEST)
+    bill_type = data.get("type")
+    if not bill_type:
+        logger.error("bill type is missing in the request by user %s", user)
+        return JsonResponse({'error': 'bill type is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if bill_type == BillType.MEMBERSHIP:
+        data["investment_id"] = investment_id = None
+
+    # The investor, the existing bill check and the documents the amount and the validation of
+    # the bill depend on are read concurrently, into the identity map of the request
+    bills = get_async_collection(bill_model)
+    lookups = {
+        "investor": aget_document(get_async_collection(entity_model), investor_id),
+        "existing_bill": acheck_existing_bill(bills, bill_type, investor_id, data["fees_year"]),
+    }
+    if ObjectId.is_valid(data.get("capital_call_id")):
+        lookups["capital_call"] = aget_document(get_async_collection(capital_call_model), data["capital_call_id"])
+    if bill_type == BillType.MEMBERSHIP:
+        lookups["summary"] = aget_document(get_async_collection(investor_summary_model), investor_id)
+    elif ObjectId.is_valid(investment_id):
+        lookups["investment"] = aget_document(get_async_collection(investment_model), investment_id)
+    try:
+        found = dict(zip(lookups, await asyncio.gather(*lookups.values())))
+    except Exception as e:
+        logger.error("Error retrieving the bill data for investor %s: %s", investor_id, e)
+        return JsonResponse({'error': 'Error retrieving the bill data'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    investor, response = found["investor"], found["existing_bill"]
+    if not investor or investor.get("type") != "investor":
+        logger.error("Entity with id %s is not an investor, requested by user %s", investor_id, user)
+        return JsonResponse({'error': 'The entity is not an investor'}, status=status.HTTP_400_BAD_REQUEST)
+    if response and response.status_code != 200:
+        logger.error("Existing bill check failed for investor %s", investor_id)
+        return response
+    # Same as compute_bill_amount, from the documents read above rather than with blocking queries
+    if bill_type == BillType.MEMBERSHIP:
+        summary = found["summary"]
+        bill_amount = compute_membership_fee([summary.get("investment_max", 0)] if summary else [])
+    else:
+        investment = found.get("investment")
+        if not investment:
+            logger.error("Investment with id %s not found", investment_id)
+            return JsonResponse({'error': f'Investment with id {investment_id} not found'}, status=status.HTTP_400_BAD_REQUEST)
+        bill_amount = compute_investment_fee(bill_type, float(os.getenv("PERCENTAGE_FEE", 0.02)), investment, data["fees_year"])
+    data["amount"] = await run_sync(convert_currency, bill_amount, investor.get("bank_account_currency"))
+    try:
+        bill = stamp_new(BillModel(**data).model_dump())
+        inserted_result = await bills.insert_one(bill)
+        capital_call_id = data["capital_call_id"]
+        await asyncio.gather(
+            get_async_collection(capital_call_model).update_one({"_id": ObjectId(capital_call_id)}, stamped({"$push": {"bills": inserted_result.inserted_id}})),
+            run_sync(record_bill_created, bill, capital_call_id),
+        )
+        forget_document(capital_call_model, capital_call_id)
+        logger.info("Capital call with id %s updated with new bill %s", capital_call_id, inserted_result.inserted_id)
+    except DuplicateKeyError:
+        logger.error("Duplicate %s bill for investor %s", bill_type, investor_id)
+        return JsonResponse({'error': duplicate_bill_error(bill_type, investor_id, year)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error("Error creating bill for investor %s: %s", investor_id, e)
+        return JsonResponse({'error': 'Error creating bill '}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    logger.info("Bill created successfully for investor %s", investor_id)
+    return JsonResponse({'message': 'Bill created successfully'}, status=status.HTTP_201_CREATED)
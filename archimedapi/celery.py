@@ -1,6 +1,8 @@
 from __future__ import absolute_import, unicode_literals
 import os
+import time
 from celery import Celery
+from celery.signals import task_postrun, task_prerun, worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'archimedapi.settings')
 
@@ -8,4 +10,24 @@ app = Celery('archimedapi', include=['archimedapi.tasks'])
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    from archimedapi.warmup import warm_up, warm_up_enabled
+    if warm_up_enabled():
+        warm_up()
+
+# Start times of the tasks running in this process, by task id
+_task_starts = {}
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_starts[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    from utils.metrics import TASK_DURATION
+    start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - start)
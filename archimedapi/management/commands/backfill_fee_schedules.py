@@ -0,0 +1,55 @@
+import os
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from archimedapi.models import investment_model
+from utils.cache import invalidate_documents
+from utils.fee_engine import fee_schedule_fields
+from utils.versioning import stamped
+
+class Command(BaseCommand):
+    help = "Store the fee schedule on the investments that have none or an outdated one"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Number of investments updated per bulk write")
+        parser.add_argument("--all", action="store_true", help="Recompute the schedule of every investment")
+
+    def handle(self, *args, **options):
+        fee_percentage = float(os.getenv("PERCENTAGE_FEE", 0.02))
+        today = date.today()
+        query = {} if options["all"] else {
+            "$or": [{"fee_schedule_year": {"$ne": today.year}}, {"fee_schedule_percentage": {"$ne": fee_percentage}}]
+        }
+        projection = {"amount": 1, "date": 1, "duration": 1}
+        updated = skipped = 0
+        last_id = None
+        while True:
+            chunk_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+            investments = list(investment_model.find(chunk_query, projection).sort("_id", 1).limit(options["chunk_size"]))
+            if not investments:
+                break
+            last_id = investments[-1]["_id"]
+            try:
+                schedules = fee_schedule_fields(investments, fee_percentage, today)
+            except (KeyError, TypeError, ValueError):
+                # At least one investment has an invalid date, compute them one by one to skip it
+                schedules = []
+                for investment in investments:
+                    try:
+                        schedules.append(fee_schedule_fields([investment], fee_percentage, today)[0])
+                    except (KeyError, TypeError, ValueError) as e:
+                        self.stdout.write(self.style.WARNING(f"Skipping investment {investment['_id']}: {e}"))
+                        schedules.append(None)
+            operations = [
+                UpdateOne({"_id": investment["_id"]}, stamped({"$set": fields}))
+                for investment, fields in zip(investments, schedules) if fields
+            ]
+            if operations:
+                investment_model.bulk_write(operations, ordered=False)
+                invalidate_documents(investment_model, [investment["_id"] for investment, fields in zip(investments, schedules) if fields])
+            updated += len(operations)
+            skipped += len(investments) - len(operations)
+            self.stdout.write(f"Updated {updated} investments")
+        self.stdout.write(self.style.SUCCESS(f"Fee schedules backfilled: {updated} updated, {skipped} skipped"))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+
+from archimedapi.models import INDEXES
+from db_connection import db
+
+def index_options(spec):
+    return {key: value for key, value in spec.items() if key not in ("key", "name", "v", "ns", "background")}
+
+class Command(BaseCommand):
+    help = "Create the MongoDB indexes declared in archimedapi.models.INDEXES and report extra or unused ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the indexes that would be created")
+        parser.add_argument("--skip-usage", action="store_true", help="Do not read $indexStats to report unused indexes")
+        parser.add_argument("--recreate", action="store_true", help="Drop and recreate the indexes whose definition changed")
+
+    def handle(self, *args, **options):
+        failed = False
+        for collection_name, indexes in INDEXES.items():
+            collection = db[collection_name]
+            existing = collection.index_information()
+            missing = []
+            for index in indexes:
+                document = index.document
+                name = document["name"]
+                if name not in existing:
+                    missing.append(index)
+                    continue
+                if list(existing[name]["key"]) != list(document["key"].items()) or index_options(existing[name]) != index_options(document):
+                    if options["recreate"] and not options["dry_run"]:
+                        self.stdout.write(f"{collection_name}.{name}: definition changed, recreating")
+                        collection.drop_index(name)
+                        missing.append(index)
+                    else:
+                        self.stdout.write(self.style.WARNING(
+                            f"{collection_name}.{name}: existing index differs from its declaration, run with --recreate to recreate it"
+                        ))
+            for index in missing:
+                self.stdout.write(f"{collection_name}.{index.document['name']}: {'missing' if options['dry_run'] else 'creating'}")
+            if missing and not options["dry_run"]:
+                try:
+                    collection.create_indexes(missing)
+                except OperationFailure as e:
+                    # e.g. a unique index cannot be built while duplicates exist
+                    self.stderr.write(f"{collection_name}: failed to create indexes: {e}")
+                    failed = True
+
+            declared = {index.document["name"] for index in indexes} | {"_id_"}
+            for name in sorted(set(existing) - declared):
+                self.stdout.write(self.style.WARNING(f"{collection_name}.{name}: not declared in INDEXES"))
+            if not options["skip_usage"]:
+                self.report_unused(collection)
+        if failed:
+            raise CommandError("Some indexes could not be created")
+        self.stdout.write(self.style.SUCCESS("Indexes are up to date" if not options["dry_run"] else "Dry run complete"))
+
+    def report_unused(self, collection):
+        try:
+            stats = list(collection.aggregate([{"$indexStats": {}}]))
+        except OperationFailure as e:
+            self.stdout.write(self.style.WARNING(f"{collection.name}: cannot read index usage ({e})"))
+            return
+        for stat in stats:
+            if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0:
+                self.stdout.write(f"{collection.name}.{stat['name']}: unused since {stat['accesses']['since']}")
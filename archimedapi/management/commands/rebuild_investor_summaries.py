@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from utils.investor_summary import rebuild_investor_summaries
+
+class Command(BaseCommand):
+    help = "Recompute the per-investor summaries from the investments and bills to repair drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--investor", action="append", dest="investor_ids", help="Only rebuild the summary of this investor id, can be repeated")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Number of summaries written per bulk write")
+
+    def handle(self, *args, **options):
+        written, deleted = rebuild_investor_summaries(options["investor_ids"], options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Investor summaries rebuilt: {written} written, {deleted} deleted"))
@@ -0,0 +1,69 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from utils.identity_map import unit_of_work
+from utils.logger import logger
+from utils.metrics import measure_request
+
+class IdentityMapMiddleware:
+    """Run each request in its own unit of work.
+
+    Documents looked up by ID are loaded at most once per request, and the number of MongoDB
+    round trips of the request is available on `request.identity_map.round_trips`.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with unit_of_work() as identity_map:
+            request.identity_map = identity_map
+            response = self.get_response(request)
+        logger.debug("%s %s: %d MongoDB round trips %s", request.method, request.path, identity_map.total_round_trips, dict(identity_map.round_trips))
+        return response
+
+    async def __acall__(self, request):
+        with unit_of_work() as identity_map:
+            request.identity_map = identity_map
+            response = await self.get_response(request)
+        logger.debug("%s %s: %d MongoDB round trips %s", request.method, request.path, identity_map.total_round_trips, dict(identity_map.round_trips))
+        return response
+
+class MetricsMiddleware:
+    """Record the latency of each request, and the time it spent in MongoDB and Redis.
+
+    Both go to the Prometheus histograms of utils.metrics, labelled by URL name, and to a
+    Server-Timing header. To be placed first so that the other middlewares are timed too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with measure_request() as metrics:
+            response = self.get_response(request)
+            self.record(request, response, metrics)
+        return response
+
+    async def __acall__(self, request):
+        with measure_request() as metrics:
+            response = await self.get_response(request)
+            self.record(request, response, metrics)
+        return response
+
+    def record(self, request, response, metrics):
+        # URL names keep the cardinality of the labels bounded, unlike paths
+        view = request.resolver_match.url_name if request.resolver_match else "unmatched"
+        metrics.observe(view or "unnamed", request.method, response.status_code)
+        response["Server-Timing"] = metrics.server_timing()
@@ -1,14 +1,87 @@
+from functools import cache
+from typing import Optional, get_args
 from bson import ObjectId
+from django.conf import settings
 from django.db import models
 from db_connection import db
-from pydantic import BaseModel, field_validator, model_validator, root_validator
+from pydantic import BaseModel, create_model, field_validator, model_validator, root_validator
+from pymongo import ASCENDING, IndexModel
 from utils.general import validate_input
+from utils.identity_map import get_document, get_documents
 from datetime import date as datetime_date, timedelta
 
 bill_model = db['bill']
 investment_model = db['investment']
 capital_call_model = db['capital_call']
 entity_model = db['entity']
+# Per-investor aggregates maintained by utils/investor_summary.py, keyed by investor ObjectId
+investor_summary_model = db['investor_summary']
+# Deleted documents of every collection, read by the changes feeds
+tombstone_model = db['tombstone']
+
+MEMBERSHIP_BILL_INDEX = "to_investor_id_membership"
+YEARLY_BILL_INDEX = "to_investor_id_type_fees_year"
+
+# Changes feeds of utils/changes.py, by write time then id
+CHANGES_INDEX = IndexModel([("updated_at", ASCENDING), ("_id", ASCENDING)], name="updated_at_id")
+
+# Indexes backing every query issued by the views, utils/bill_utils.py and the Celery tasks,
+# keyed by collection name. Indexes of the list filters end with _id so that they serve both
+# the filter and the order of the pages: _id for an equality, the field then _id for a range
+# (see utils/pagination.py). They are created by `python manage.py ensure_indexes`.
+INDEXES = {
+    bill_model.name: [
+        # One membership bill per investor, also serves the membership waiver in investment_list
+        IndexModel([("to_investor_id", ASCENDING)], name=MEMBERSHIP_BILL_INDEX, unique=True, partialFilterExpression={"type": "membership"}),
+        # One bill per investor, type and fees year, also serves check_existing_bill
+        IndexModel([("to_investor_id", ASCENDING), ("type", ASCENDING), ("fees_year", ASCENDING)], name=YEARLY_BILL_INDEX, unique=True),
+        # mark_overdue_invoices
+        IndexModel([("status", ASCENDING), ("due_date", ASCENDING)], name="status_due_date"),
+        # Filters of the bill list, pages of a due date range are sorted by due_date then _id
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status"),
+        IndexModel([("to_investor_id", ASCENDING), ("_id", ASCENDING)], name="to_investor_id"),
+        IndexModel([("capital_call_id", ASCENDING), ("_id", ASCENDING)], name="capital_call_id"),
+        IndexModel([("due_date", ASCENDING), ("_id", ASCENDING)], name="due_date"),
+        CHANGES_INDEX,
+    ],
+    investment_model.name: [
+        # bulk billing lookups of an investor's investments and the investor filter of the investment list
+        IndexModel([("investor_id", ASCENDING), ("_id", ASCENDING)], name="investor_id"),
+        # fee forecast of a fund and the fund filter of the investment list
+        IndexModel([("fund_entity_id", ASCENDING), ("_id", ASCENDING)], name="fund_entity_id"),
+        CHANGES_INDEX,
+    ],
+    capital_call_model.name: [
+        # removal of a deleted bill from its capital calls
+        IndexModel([("bills", ASCENDING)], name="bills"),
+        # status filter of the capital call list
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status"),
+        CHANGES_INDEX,
+    ],
+    entity_model.name: [
+        # type filter of the entity list
+        IndexModel([("type", ASCENDING), ("_id", ASCENDING)], name="type"),
+        CHANGES_INDEX,
+    ],
+    investor_summary_model.name: [
+        # stale summaries deleted by rebuild_investor_summaries
+        IndexModel([("rebuilt_at", ASCENDING)], name="rebuilt_at"),
+    ],
+    tombstone_model.name: [
+        IndexModel([("collection", ASCENDING), ("updated_at", ASCENDING), ("_id", ASCENDING)], name="collection_updated_at_id"),
+        # Deletions older than the retention of the changes feeds are dropped by MongoDB
+        IndexModel([("updated_at", ASCENDING)], name="updated_at_ttl", expireAfterSeconds=settings.CHANGES_RETENTION_DAYS * 86400),
+    ],
+}
+
+def find_by_ids(collection, ids, projection):
+    """Fetch the documents with the given string ids in a single query at most, keyed by ObjectId.
+
+    Documents already loaded by the current request are served from its identity map.
+    """
+    if not ids:
+        return {}
+    return get_documents(collection, ids, projection)
 
 bank_account_type_regex = {"iban": "^[A-Z]{2}[0-9]{2}[A-Z0-9]{1,30}$", "swift": "^[A-Z]{6}[A-Z0-9]{2}([A-Z0-9]{3})?$"}
 
@@ -52,13 +125,23 @@ class Investment(BaseModel):
     investor_id: str
     duration: int
     date: str = datetime_date.today().isoformat()
+    fund_entity_id: str | None = None # fund the investment was made in, used by the fee forecast
 
     @field_validator("investor_id")
     def investor_exists(cls, value):
-        if not entity_model.find_one({"_id": ObjectId(value)}):
+        if not get_document(entity_model, value, {"_id": 1}):
             raise ValueError(f"Entity with id {value} not found")
         return value
 
+    @field_validator("fund_entity_id")
+    def fund_exists(cls, value):
+        if not value:
+            return
+        fund = get_document(entity_model, value, {"type": 1})
+        if not fund or fund.get("type") != EntityType.FUND:
+            raise ValueError(f"Fund with id {value} not found")
+        return value
+
 class BillType(models.TextChoices):
     MEMBERSHIP = 'membership'
     UPFRONT_FEES = 'upfront fees'
@@ -85,7 +168,7 @@ class BillModel(BaseModel):
     
     @field_validator("capital_call_id")
     def capital_call_exists(cls, value):
-        if not capital_call_model.find_one({"_id": ObjectId(value)}):
+        if not get_document(capital_call_model, value, {"_id": 1}):
             raise ValueError(f"Capital call with id {value} not found")
         return value 
         
@@ -93,7 +176,7 @@ class BillModel(BaseModel):
     def investment_exists(cls, value):
         if not value: 
             return
-        if not investment_model.find_one({"_id": ObjectId(value)}):
+        if not get_document(investment_model, value, {"_id": 1}):
             raise ValueError(f"Investment with id {value} not found")  
         return value  
 
@@ -116,24 +199,68 @@ class CapitalCallModel(BaseModel):
 
     @field_validator("bills")
     def bills_exist(cls, value):
-        for bill_id in value:
-            if not bill_model.find_one({"_id": ObjectId(bill_id)}):
-                raise ValueError(f"Bill with id {bill_id} not found")
+        bills = find_by_ids(bill_model, value, {"_id": 1})
+        errors = [f"Bill with id {bill_id} not found" for bill_id in value if ObjectId(bill_id) not in bills]
+        if errors:
+            raise ValueError("; ".join(errors))
         return value    
     @field_validator("fund_entity_id")
     def fund_entity_exists(cls, value):
-        if not entity_model.find_one({"_id": ObjectId(value)}):
+        if not get_document(entity_model, value, {"_id": 1}):
             raise ValueError(f"Entity with id {value} not found")    
         return value
     @field_validator("investor_entities")
     def investors_exist(cls, value):
+        investors = find_by_ids(entity_model, value, {"type": 1})
+        errors = []
         for investor_id in value:
-            investor = entity_model.find_one({"_id": ObjectId(investor_id)})
+            investor = investors.get(ObjectId(investor_id))
             if not investor:
-                raise ValueError(f"Entity with id {investor_id} not found")
-            if investor["type"] != EntityType.INVESTOR:
-                raise ValueError(f"Entity with id {investor_id} is not an investor")
+                errors.append(f"Entity with id {investor_id} not found")
+            elif investor["type"] != EntityType.INVESTOR:
+                errors.append(f"Entity with id {investor_id} is not an investor")
+        if errors:
+            raise ValueError("; ".join(errors))
         return value    
     class Config:
         arbitrary_types_allowed = True
 
+@cache
+def partial_model(model):
+    """Variant of a model where every field can be omitted, used to validate partial updates.
+
+    Validators only run on the fields present in the update. Fields that are not nullable in the
+    model are still rejected when sent as null, see validate_update.
+    """
+    fields = {name: (Optional[field.annotation], None) for name, field in model.model_fields.items()}
+    return create_model(f"Partial{model.__name__}", __base__=model, **fields)
+
+def is_nullable(field):
+    return field.annotation is type(None) or type(None) in get_args(field.annotation)
+
+def validate_update(model, data, stored=None):
+    """Validate the fields of a PUT payload against the model and return the $set document.
+
+    stored holds fields of the document that are not updated but that the model validators check
+    the updated ones against, e.g. the bank account type of an entity whose number changes.
+    """
+    if not data:
+        raise ValueError("No fields to update")
+    unknown_fields = set(data) - set(model.model_fields)
+    if unknown_fields:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+    null_fields = [name for name, value in data.items() if value is None and not is_nullable(model.model_fields[name])]
+    if null_fields:
+        raise ValueError(f"Fields cannot be null: {', '.join(sorted(null_fields))}")
+    return partial_model(model)(**{**(stored or {}), **data}).model_dump(include=set(data))
+
+# Entity fields validated together, the stored one is used when a PUT only sends the other
+BANK_ACCOUNT_FIELDS = ("bank_account_number", "bank_account_type")
+
+def stored_bank_account(pk, data):
+    """Bank account field of the entity that a PUT sending only the other one is validated against."""
+    missing = [field for field in BANK_ACCOUNT_FIELDS if field not in data]
+    if len(missing) != 1:
+        return {}
+    entity = get_document(entity_model, pk, {missing[0]: 1}) or {}
+    return {missing[0]: entity[missing[0]]} if entity.get(missing[0]) else {}
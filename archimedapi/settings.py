@@ -47,9 +47,11 @@ INSTALLED_APPS = [
     "rest_framework",
     'django_celery_beat',
     'django_celery_results',
+    'archimedapi',
 ]
 
 MIDDLEWARE = [
+    'archimedapi.middleware.MetricsMiddleware',
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -59,6 +61,7 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
      'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'archimedapi.middleware.IdentityMapMiddleware',
 ]
 
 ROOT_URLCONF = "archimedapi.urls"
@@ -82,6 +85,17 @@ TEMPLATES = [
 WSGI_APPLICATION = "archimedapi.wsgi.application"
 
 
+REST_FRAMEWORK = {
+    "DEFAULT_RENDERER_CLASSES": [
+        "utils.json_codec.BSONJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "utils.json_codec.BSONJSONParser",
+    ],
+}
+
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -96,6 +110,20 @@ load_dotenv()
 
 CELERY_BROKER_URL = os.getenv('REDIS_URL')
 CELERY_BEAT_SCHEDULE = 'django_celery_beat.schedulers.DatabaseScheduler'
+
+# List endpoints pagination
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 1000))
+# Number of documents fetched and serialised at a time by streaming exports
+API_STREAM_BATCH_SIZE = int(os.getenv('API_STREAM_BATCH_SIZE', 1000))
+# Changes feeds: changes younger than the settle delay are held back so that writes stamped
+# by a slightly late clock are not skipped, and deletions are remembered for the retention
+CHANGES_SETTLE_SECONDS = float(os.getenv('CHANGES_SETTLE_SECONDS', 5))
+CHANGES_RETENTION_DAYS = int(os.getenv('CHANGES_RETENTION_DAYS', 30))
+# Query plan guard of utils/query_plan.py: off, log or raise when a filtered query scans a whole
+# collection or examines more than QUERY_PLAN_MAX_RATIO documents per document returned
+QUERY_PLAN_GUARD = os.getenv('QUERY_PLAN_GUARD', 'off').lower()
+QUERY_PLAN_MAX_RATIO = float(os.getenv('QUERY_PLAN_MAX_RATIO', 10))
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -1,21 +1,41 @@
 import datetime
-import os
+import time
 from celery import shared_task
-import pymongo
+from archimedapi.models import BillStatus, bill_model
+from utils.cache import bump_generation, invalidate_documents
+from utils.metrics import record_task_rows, record_task_run
+from utils.versioning import stamped
 from utils.logger import logger
 
+# Number of bills flipped per update_many, bounds the size of each write
+OVERDUE_CHUNK_SIZE = 1000
+
 @shared_task
-def mark_overdue_invoices():
-    url = os.environ.get('MONGODB_URL')
-    client = pymongo.MongoClient(url)
-    db = client['archimed']
-    bill_model = db['bill']
-    overdue_invoices = bill_model.find({
+def mark_overdue_invoices(chunk_size=OVERDUE_CHUNK_SIZE):
+    start = time.perf_counter()
+    # Served by the status_due_date index
+    overdue_query = {
+        "status": BillStatus.PENDING,
         "due_date": {"$lt": datetime.datetime.now().strftime('%Y-%m-%d')},
-        "status": "pending"
-    })
-    overdue_invoices_list = list(overdue_invoices)
-    logger.info(f"Marking {len(overdue_invoices_list)} invoices as overdue")
-    for invoice in overdue_invoices_list:
-        logger.info(f"Marking invoice {invoice['_id']} as overdue")
-        bill_model.update_one({"_id": invoice["_id"]}, {"$set": {"status": "overdue"}})
\ No newline at end of file
+    }
+    matched = modified = chunks = 0
+    while True:
+        bill_ids = [bill["_id"] for bill in bill_model.find(overdue_query, {"_id": 1}).limit(chunk_size)]
+        if not bill_ids:
+            break
+        # Repeating the filter leaves out bills paid or cancelled since they were read
+        result = bill_model.update_many({"_id": {"$in": bill_ids}, **overdue_query}, stamped({"$set": {"status": BillStatus.OVERDUE}}))
+        invalidate_documents(bill_model, bill_ids)
+        matched += len(bill_ids)
+        modified += result.modified_count
+        chunks += 1
+        if len(bill_ids) < chunk_size:
+            break
+    if modified:
+        bump_generation(bill_model)
+    record_task_rows("mark_overdue_invoices", "matched", matched)
+    record_task_rows("mark_overdue_invoices", "modified", modified)
+    record_task_run("mark_overdue_invoices")
+    duration = time.perf_counter() - start
+    logger.info("mark_overdue_invoices: %d invoices marked as overdue out of %d matched in %d chunks, %.3fs", modified, matched, chunks, duration)
+    return {"matched": matched, "modified": modified, "chunks": chunks, "duration": duration}
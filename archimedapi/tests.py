@@ -1,23 +1,58 @@
+import asyncio
 import json
-from django.test import TestCase
+import logging
+import redis
+from unittest.mock import AsyncMock, MagicMock, patch
+from io import StringIO
+from django.conf import settings
+from django.core.management import call_command
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
+from prometheus_client import REGISTRY
 from rest_framework.test import APIClient
-from bson import ObjectId
-from datetime import date as datetime_date, timedelta
+from bson import Decimal128, ObjectId, json_util
+from pymongo.errors import PyMongoError
+from datetime import date as datetime_date, datetime, timedelta
+
+import db_connection
+from archimedapi.tasks import mark_overdue_invoices
+from utils.bill_utils import acheck_existing_bill, check_existing_bill, compute_investment_fee
+from utils.cache import bump_generation
+from utils.changes import encode_token
+from utils.currency_conversion import ExchangeRateProvider
+from utils.fee_engine import to_arrays, yearly_fee_schedules
+from utils.filters import LIST_FILTERS, list_filter
+from utils.investor_summary import get_investor_summary, rebuild_investor_summaries
+from utils.json_codec import dumps
+from utils.identity_map import forget_document, get_document, unit_of_work
+from utils.logger import JsonFormatter, SamplingFilter, log_payload
+from utils.pagination import encode_cursor, page_query, page_sort
+from utils.query_plan import UnindexedQuery, find_values
 
 from .models import (
     EntityType,
     BillType,
     BillStatus,
     CapitalCallStatus,
+    INDEXES,
+    find_by_ids,
     bill_model,
     capital_call_model,
     entity_model,
-    investment_model
+    investment_model,
+    investor_summary_model,
+    tombstone_model
 )
 
 class ArchimedAPITestCase(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # With QUERY_PLAN_GUARD=raise, any query of the suite not served by INDEXES fails its test
+        if settings.QUERY_PLAN_GUARD != "off":
+            call_command('ensure_indexes', '--skip-usage', stdout=StringIO())
+
     def setUp(self):
         self.client = APIClient()
 
@@ -66,12 +101,17 @@ class ArchimedAPITestCase(TestCase):
             "date": "2024-11-16"
         })
         self.investment_id = str(self.investment.inserted_id)
+        rebuild_investor_summaries()
 
     def tearDown(self):
         bill_model.delete_many({})
         capital_call_model.delete_many({})
         entity_model.delete_many({})
         investment_model.delete_many({})
+        investor_summary_model.delete_many({})
+        tombstone_model.delete_many({})
+        # Results cached in Redis must not survive the data they were computed from
+        bump_generation(bill_model, investment_model)
 
     def test_index_get(self):
         url = reverse('index')
@@ -110,6 +150,27 @@ class ArchimedAPITestCase(TestCase):
         self.assertIsNotNone(created_capital_call)
         self.assertEqual(created_capital_call['name'], "Second Capital Call") if 'name' in created_capital_call else self.assertTrue(True)
 
+    def test_capital_call_list_post_missing_references(self):
+        url = reverse('capital-call-list')
+        missing_bill_id = str(ObjectId())
+        missing_investor_id = str(ObjectId())
+        data = {
+            "fund_entity_id": self.fund_id,
+            "investor_entities": [self.investor_id, missing_investor_id, str(self.fund.inserted_id)],
+            "purpose": "Third Capital Call",
+            "date": "2024-01-15T00:00:00Z",
+            "status": "sent",
+            "currency": "EUR",
+            "payment_method": "credit_card",
+            "bills": [missing_bill_id]
+        }
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        error = response.json()['error']
+        self.assertIn(f"Bill with id {missing_bill_id} not found", error)
+        self.assertIn(f"Entity with id {missing_investor_id} not found", error)
+        self.assertIn(f"Entity with id {self.fund.inserted_id} is not an investor", error)
+
     def test_capital_call_detail_get(self):
         url = reverse('capital-call-detail', args=[self.capital_call_id])
         response = self.client.get(url)
@@ -119,18 +180,96 @@ class ArchimedAPITestCase(TestCase):
         self.assertEqual(data['investor_entities'], [self.investor_id])
         self.assertEqual(data['status'], "validated")
 
+    def test_capital_call_detail_get_expand(self):
+        bill_ids = bill_model.insert_many([
+            {"type": "yearly fees", "to_investor_id": self.investor_id, "fees_year": year, "currency": "GBP", "amount": 100.0, "status": bill_status}
+            for year, bill_status in enumerate(["paid", "overdue", "pending", "cancelled"], start=1)
+        ]).inserted_ids
+        capital_call_model.update_one({"_id": self.capital_call.inserted_id}, {"$set": {"bills": [bill_ids[0], str(bill_ids[1]), bill_ids[2], bill_ids[3]]}})
+        url = reverse('capital-call-detail', args=[self.capital_call_id])
+        response = self.client.get(url, {"expand": "bills,investors,fund"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['bills']), 4)
+        self.assertEqual(data['investor_entities'][0]['name'], "Test Investor")
+        self.assertEqual(data['fund_entity_id']['name'], "Test Fund")
+        self.assertEqual(data['bill_totals'], {"billed": {"GBP": 300.0}, "paid": {"GBP": 100.0}, "overdue": {"GBP": 100.0}})
+        self.assertEqual(response.wsgi_request.identity_map.round_trips, {"aggregate": 1})
+
+    def test_capital_call_list_get_expand(self):
+        url = reverse('capital-call-list')
+        response = self.client.get(url, {"expand": "investors"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['investor_entities'][0]['_id']['$oid'], self.investor_id)
+        # The references are resolved even when ?fields= leaves them out
+        response = self.client.get(url, {"expand": "investors", "fields": "purpose"})
+        self.assertEqual(response.json()[0]['purpose'], "Initial Capital Call")
+        self.assertEqual(response.json()[0]['investor_entities'][0]['name'], "Test Investor")
+        response = self.client.get(url, {"expand": "unknown"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_investment_detail_get_conditional(self):
+        response = self.client.post(reverse('investment-list'), data=json.dumps({"amount": 45000.0, "investor_id": self.investor_id, "duration": 3}), content_type='application/json')
+        url = reverse('investment-detail', args=[response.json()['id']])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"1"')
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"1"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.client.put(url, data=json.dumps({"duration": 4}), content_type='application/json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"2"')
+        self.assertEqual(response.json()['duration'], 4)
+
+    def test_entity_detail_get_cached(self):
+        url = reverse('entity-detail', args=[self.investor_id])
+        with patch("utils.cache.DETAIL_CACHE_ENABLED", True):
+            etag = self.client.get(url)['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.wsgi_request.identity_map.total_round_trips, 0)
+            self.client.put(url, data=json.dumps({"name": "Renamed Investor"}), content_type='application/json')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['name'], "Renamed Investor")
+            # The same document requested with an uppercase id shares the entry invalidated by the writes
+            upper_url = reverse('entity-detail', args=[self.investor_id.upper()])
+            self.assertEqual(self.client.get(upper_url).json()['name'], "Renamed Investor")
+            self.client.put(url, data=json.dumps({"name": "Renamed Again"}), content_type='application/json')
+            self.assertEqual(self.client.get(upper_url).json()['name'], "Renamed Again")
+            self.client.delete(url)
+            self.assertEqual(self.client.get(url).status_code, 404)
+
     def test_capital_call_detail_put(self):
         url = reverse('capital-call-detail', args=[self.capital_call_id])
         updated_data = {
-            "status": CapitalCallStatus.SENT.name,
+            "status": CapitalCallStatus.SENT,
             "currency": "GBP"
         }
         response = self.client.put(url, data=json.dumps(updated_data), content_type='application/json')
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], CapitalCallStatus.SENT)
         updated_capital_call = capital_call_model.find_one({"_id": ObjectId(self.capital_call_id)})
-        self.assertEqual(updated_capital_call['status'], CapitalCallStatus.SENT.name)
+        self.assertEqual(updated_capital_call['status'], CapitalCallStatus.SENT)
         self.assertEqual(updated_capital_call['currency'], "GBP")
 
+    def test_capital_call_detail_put_invalid(self):
+        url = reverse('capital-call-detail', args=[self.capital_call_id])
+        response = self.client.put(url, data=json.dumps({"status": "unknown"}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(url, data=json.dumps({"$unset": {"bills": ""}}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(capital_call_model.find_one({"_id": ObjectId(self.capital_call_id)})['status'], "validated")
+
+    def test_capital_call_detail_put_not_found(self):
+        url = reverse('capital-call-detail', args=[str(ObjectId())])
+        response = self.client.put(url, data=json.dumps({"currency": "GBP"}), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
     def test_capital_call_detail_delete(self):
         url = reverse('capital-call-detail', args=[self.capital_call_id])
         response = self.client.delete(url)
@@ -235,6 +374,24 @@ class ArchimedAPITestCase(TestCase):
         self.assertEqual(updated_bill['amount'], 3500.0)
         self.assertEqual(updated_bill['status'], "pending")
 
+        response = self.client.put(url, data=json.dumps({"amount": None, "status": None}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], "Fields cannot be null: amount, status")
+        self.assertEqual(bill_model.find_one({"_id": ObjectId(bill_id)})['amount'], 3500.0)
+        response = self.client.put(url, data=json.dumps({"investment_id": None}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_entity_detail_put_bank_account(self):
+        url = reverse('entity-detail', args=[self.investor_id])
+        response = self.client.put(url, data=json.dumps({"bank_account_number": "nonsense"}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("does not match iban format", response.json()['message'])
+        response = self.client.put(url, data=json.dumps({"bank_account_type": "swift"}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(url, data=json.dumps({"bank_account_number": "GB29NWBK60161331926819"}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(entity_model.find_one({"_id": self.investor.inserted_id})['bank_account_number'], "GB29NWBK60161331926819")
+
     def test_bill_detail_delete(self):
         bill = bill_model.insert_one({
             "type": BillType.MEMBERSHIP.name,
@@ -280,6 +437,118 @@ class ArchimedAPITestCase(TestCase):
         updated_capital_call = capital_call_model.find_one({"_id": ObjectId(self.capital_call_id)})
         self.assertIn(str(created_bill['_id']), [str(bill_id) for bill_id in updated_capital_call.get('bills', [])])
 
+    def test_identity_map_projection(self):
+        with unit_of_work() as identity_map:
+            entity = get_document(entity_model, self.investor_id, {"type": 1})
+            self.assertEqual(entity, {"_id": self.investor.inserted_id, "type": "investor"})
+            self.assertIs(find_by_ids(entity_model, [self.investor_id], {"type": 1})[self.investor.inserted_id], entity)
+            self.assertEqual(get_document(entity_model, self.investor_id)["name"], "Test Investor")
+            # The whole document now serves every projection
+            self.assertEqual(get_document(entity_model, self.investor_id, {"name": 1})["name"], "Test Investor")
+            self.assertEqual(identity_map.round_trips, {"find": 2})
+            forget_document(entity_model, self.investor_id)
+            get_document(entity_model, self.investor_id, {"type": 1})
+            self.assertEqual(identity_map.round_trips, {"find": 3})
+
+    def test_bill_investor_post_round_trips(self):
+        url = reverse('bill-investor')
+        data = {
+            "type": "upfront fees",
+            "to_investor_id": self.investor_id,
+            "capital_call_id": self.capital_call_id,
+            "investment_id": self.investment_id,
+            "currency": "GBP"
+        }
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        # Investor, exclusivity check, capital call and investment are each read once, the
+        # updates are the investor summary and the capital call
+        self.assertEqual(response.wsgi_request.identity_map.round_trips, {"find": 4, "insert": 1, "update": 2})
+
+    def test_async_bill_investor_post(self):
+        url = reverse('async-bill-investor')
+        data = {
+            "type": "upfront fees",
+            "to_investor_id": self.investor_id,
+            "capital_call_id": self.capital_call_id,
+            "investment_id": self.investment_id,
+            "currency": "GBP"
+        }
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.wsgi_request.identity_map.round_trips, {"find": 4, "insert": 1, "update": 2})
+        created_bill = bill_model.find_one({"type": "upfront fees", "to_investor_id": self.investor_id})
+        self.assertEqual(round(created_bill['amount'], 3), round(60000.0 * 0.02 * 5 * 0.792519, 3))
+        self.assertIn(created_bill['_id'], capital_call_model.find_one({"_id": ObjectId(self.capital_call_id)})['bills'])
+        self.assertEqual(get_investor_summary(self.investor_id)['outstanding_bills'], {"GBP": created_bill['amount']})
+
+        data["type"] = "yearly fees"
+        data["fees_year"] = 1
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()['error'],
+            f"Upfront fees bill already exists for investor {self.investor_id} hence cannot generate a yearly fees bill",
+        )
+        data["to_investor_id"] = "invalid_id"
+        self.assertEqual(self.client.post(url, data=json.dumps(data), content_type='application/json').json()['error'], 'Invalid investor_id')
+
+        data.update({"to_investor_id": self.investor_id, "type": "yearly fees", "fees_year": 2, "investment_id": str(ObjectId())})
+        bill_model.delete_many({"type": "upfront fees"})
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], f"Investment with id {data['investment_id']} not found")
+        with patch("archimedapi.async_views.aget_document", side_effect=PyMongoError("connection reset")):
+            response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()['error'], 'Error retrieving the bill data')
+
+    def test_async_client_closed_when_replaced(self):
+        async def get_client():
+            client = db_connection.get_async_client()
+            # Lets the close of the replaced client run
+            await asyncio.sleep(0)
+            return client
+
+        with patch("db_connection._async_client", None), patch("db_connection.pymongo.AsyncMongoClient", side_effect=lambda *args, **kwargs: MagicMock(close=AsyncMock())):
+            first, second = asyncio.run(get_client()), asyncio.run(get_client())
+        self.assertIsNot(first, second)
+        first.close.assert_awaited_once()
+        second.close.assert_not_called()
+
+    def test_lazy_collection_resolved_once_per_client(self):
+        collection = bill_model._collection()
+        self.assertIs(bill_model._collection(), collection)
+        # A new client, as after a fork, resolves the collection again
+        with patch("db_connection._client", MagicMock()) as client:
+            self.assertIs(bill_model._collection(), client["archimed"]["bill"])
+        self.assertIs(bill_model._collection().database.client, db_connection.get_client())
+
+    def test_async_list_and_detail_get(self):
+        for name in ('capital-call', 'entity', 'investment', 'bill'):
+            response = self.client.get(reverse(f'async-{name}-list'), {"limit": 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), self.client.get(reverse(f'{name}-list'), {"limit": 1}).json())
+        response = self.client.get(reverse('async-entity-list'), {"type": "investor", "fields": "name"})
+        self.assertEqual(response.json(), [{"_id": {"$oid": self.investor_id}, "name": "Test Investor"}])
+        self.assertEqual(self.client.get(reverse('async-bill-list'), {"due_date_to": "soon"}).status_code, 400)
+
+        url = reverse('async-investment-detail', args=[self.investment_id])
+        self.client.put(reverse('investment-detail', args=[self.investment_id]), data=json.dumps({"duration": 4}), content_type='application/json')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['duration'], 4)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        response = self.client.get(reverse('async-capital-call-detail', args=[self.capital_call_id]), {"expand": "investors"})
+        self.assertEqual(response.json()['investor_entities'][0]['_id']['$oid'], self.investor_id)
+        self.assertEqual(self.client.get(reverse('async-entity-detail', args=[str(ObjectId())])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('async-entity-list')).status_code, 405)
+
+    async def test_async_list_stream(self):
+        response = await AsyncClient().get(reverse('async-investment-list'), {"stream": "ndjson"})
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)['_id']['$oid'] for line in content.splitlines()], [self.investment_id])
+
     def test_bill_investor_post_missing_bill_data(self):
         url = reverse('bill-investor')
         data = {}
@@ -303,6 +572,38 @@ class ArchimedAPITestCase(TestCase):
         self.assertIn('error', response_data)
         self.assertEqual(response_data['error'], 'Invalid investor_id')
 
+    def test_bill_capital_call_post(self):
+        url = reverse('capital-call-bills', args=[self.capital_call_id])
+        data = {"type": "upfront fees", "fees_year": 1}
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response_data = response.json()
+        self.assertEqual(response_data['created'], 1)
+        result = response_data['results'][0]
+        self.assertEqual(result['investor_id'], self.investor_id)
+        self.assertEqual(result['status'], 'created')
+        self.assertEqual(result['currency'], 'GBP')
+        created_bill = bill_model.find_one({"_id": ObjectId(result['bill_id'])})
+        self.assertEqual(created_bill['investment_id'], self.investment_id)
+        self.assertEqual(created_bill['capital_call_id'], self.capital_call_id)
+        updated_capital_call = capital_call_model.find_one({"_id": ObjectId(self.capital_call_id)})
+        self.assertEqual(updated_capital_call['bills'], [created_bill['_id']])
+
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data['created'], 0)
+        self.assertEqual(response_data['results'][0]['status'], 'skipped')
+        self.assertIn('already exists', response_data['results'][0]['error'])
+
+    def test_bill_capital_call_post_membership(self):
+        url = reverse('capital-call-bills', args=[self.capital_call_id])
+        response = self.client.post(url, data=json.dumps({"type": "membership"}), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        created_bill = bill_model.find_one({"type": "membership", "to_investor_id": self.investor_id})
+        self.assertIsNone(created_bill['investment_id'])
+        self.assertEqual(created_bill['amount'], 0)
+
     def test_investment_list_get(self):
         url = reverse('investment-list')
         response = self.client.get(url)
@@ -332,6 +633,34 @@ class ArchimedAPITestCase(TestCase):
         self.assertEqual(created_investment['duration'], 3)
         self.assertEqual(created_investment['investor_id'], self.investor_id)
 
+    def test_investment_list_post_fee_schedule(self):
+        url = reverse('investment-list')
+        data = {
+            "amount": 45000.0,
+            "investor_id": self.investor_id,
+            "duration": 6,
+            "date": "2022-05-01"
+        }
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        created_investment = investment_model.find_one({"_id": ObjectId(response.json()['id'])})
+        self.assertEqual(created_investment['fee_schedule_year'], datetime_date.today().year)
+        self.assertEqual(len(created_investment['fee_schedule']), 6)
+        for year in range(1, 7):
+            self.assertEqual(created_investment['fee_schedule'][year - 1], compute_investment_fee(BillType.YEARLY_FEES, 0.02, data, year))
+
+        url = reverse('investment-detail', args=[response.json()['id']])
+        response = self.client.put(url, data=json.dumps({"duration": 8}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        updated_investment = investment_model.find_one({"_id": created_investment['_id']})
+        self.assertEqual(len(updated_investment['fee_schedule']), 8)
+
+    def test_backfill_fee_schedules(self):
+        call_command('backfill_fee_schedules', '--chunk-size', '1', stdout=StringIO())
+        investment = investment_model.find_one({"_id": self.investment.inserted_id})
+        self.assertEqual(investment['fee_schedule_year'], datetime_date.today().year)
+        self.assertEqual(len(investment['fee_schedule']), 5)
+
     def test_investment_list_post_high_amount(self):
         bill = bill_model.insert_one({
             "type": "membership",
@@ -366,4 +695,447 @@ class ArchimedAPITestCase(TestCase):
             "to_investor_id": self.investor_id
         })
         self.assertIsNotNone(membership_bill)
-        self.assertEqual(membership_bill['amount'], 0.0)
\ No newline at end of file
+        self.assertEqual(membership_bill['amount'], 0.0)
+    def test_entity_list_get_paginated(self):
+        url = reverse('entity-list')
+        response = self.client.get(url, {"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(len(first_page), 1)
+        self.assertIn('X-Next-Cursor', response)
+        response = self.client.get(url, {"limit": 1, "after": response['X-Next-Cursor']})
+        self.assertEqual(response.status_code, 200)
+        second_page = response.json()
+        self.assertEqual(len(second_page), 1)
+        self.assertNotEqual(first_page[0]['_id'], second_page[0]['_id'])
+        self.assertNotIn('X-Next-Cursor', response)
+
+    def test_entity_list_get_invalid_cursor(self):
+        url = reverse('entity-list')
+        response = self.client.get(url, {"after": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+    def test_investment_list_get_stream(self):
+        url = reverse('investment-list')
+        response = self.client.get(url, {"stream": "json"})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(data), investment_model.count_documents({}))
+        self.assertEqual(data[0]['investor_id'], self.investor_id)
+
+    def test_entity_list_get_stream_ndjson(self):
+        url = reverse('entity-list')
+        response = self.client.get(url, {"stream": "ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual({json.loads(line)['name'] for line in lines}, {"Test Fund", "Test Investor"})
+
+    def test_investment_fee_forecast(self):
+        investment_model.update_one({"_id": self.investment.inserted_id}, {"$set": {"fund_entity_id": str(self.fund.inserted_id)}})
+        url = reverse('investment-fee-forecast')
+        response = self.client.get(url, {"type": "upfront fees"})
+        self.assertEqual(response.status_code, 200)
+        funds = response.json()['funds']
+        self.assertEqual(len(funds), 1)
+        self.assertEqual(funds[0]['fund_entity_id'], str(self.fund.inserted_id))
+        self.assertEqual(funds[0]['years'], {"2024": 60000.0 * 0.02 * 5})
+        self.assertEqual(response.json()['skipped'], [])
+
+        # One malformed investment does not fail the forecast of the others
+        malformed_ids = investment_model.insert_many([
+            {"amount": 1000.0, "investor_id": self.investor_id, "duration": 1, "date": "2023-10-01T00:00:00Z"},
+            {"amount": 1000.0, "investor_id": self.investor_id, "duration": 1},
+        ]).inserted_ids
+        response = self.client.get(url, {"type": "upfront fees"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['funds'], funds)
+        self.assertCountEqual(response.json()['skipped'], [str(investment_id) for investment_id in malformed_ids])
+
+    def test_mark_overdue_invoices(self):
+        bills = [
+            {"type": "yearly fees", "fees_year": fees_year, "to_investor_id": self.investor_id, "status": status, "due_date": due_date, "capital_call_id": self.capital_call_id}
+            for fees_year, (status, due_date) in enumerate([
+                ("pending", "2023-10-11"),
+                ("pending", "2023-11-11"),
+                ("pending", (datetime_date.today() + timedelta(days=1)).isoformat()),
+                ("paid", "2023-10-11"),
+            ], start=1)
+        ]
+        bill_ids = bill_model.insert_many(bills).inserted_ids
+        modified_before = REGISTRY.get_sample_value("celery_task_rows_total", {"task": "mark_overdue_invoices", "operation": "modified"}) or 0
+        result = mark_overdue_invoices(chunk_size=1)
+        self.assertEqual(result['matched'], 2)
+        self.assertEqual(result['modified'], 2)
+        modified_after = REGISTRY.get_sample_value("celery_task_rows_total", {"task": "mark_overdue_invoices", "operation": "modified"})
+        self.assertEqual(modified_after - modified_before, 2)
+        self.assertEqual(REGISTRY.get_sample_value("celery_task_last_run_rows", {"task": "mark_overdue_invoices", "operation": "modified"}), 2)
+        self.assertIsNotNone(REGISTRY.get_sample_value("celery_task_last_run_timestamp_seconds", {"task": "mark_overdue_invoices"}))
+        mark_overdue_invoices()
+        self.assertEqual(REGISTRY.get_sample_value("celery_task_last_run_rows", {"task": "mark_overdue_invoices", "operation": "modified"}), 0)
+        statuses = [bill_model.find_one({"_id": bill_id})['status'] for bill_id in bill_ids]
+        self.assertEqual(statuses, ["overdue", "overdue", "pending", "paid"])
+
+    def test_investor_summary_maintained(self):
+        response = self.client.post(reverse('investment-list'), data=json.dumps({"amount": 80000.0, "investor_id": self.investor_id, "duration": 3}), content_type='application/json')
+        investment_id = response.json()['id']
+        bill = {"type": "membership", "to_investor_id": self.investor_id, "capital_call_id": self.capital_call_id, "currency": "GBP", "amount": 3000.0}
+        bill_id = self.client.post(reverse('bill-list'), data=json.dumps(bill), content_type='application/json').json()['id']
+        summary = get_investor_summary(self.investor_id)
+        self.assertEqual((summary['investment_count'], summary['investment_total'], summary['investment_max']), (2, 140000.0, 80000.0))
+        self.assertEqual(summary['currencies'], ["GBP"])
+        self.assertEqual(summary['outstanding_bills'], {"GBP": 3000.0})
+
+        self.client.put(reverse('bill-detail', args=[bill_id]), data=json.dumps({"status": "paid"}), content_type='application/json')
+        self.client.delete(reverse('investment-detail', args=[investment_id]))
+        summary = get_investor_summary(self.investor_id)
+        self.assertEqual((summary['investment_count'], summary['investment_total'], summary['investment_max']), (1, 60000.0, 60000.0))
+        self.assertEqual(summary['outstanding_bills'], {"GBP": 0})
+
+    def test_rebuild_investor_summaries(self):
+        investor_summary_model.update_one({"_id": ObjectId(self.investor_id)}, {"$set": {"investment_max": 0}})
+        bill_model.insert_one({"type": "yearly fees", "to_investor_id": self.investor_id, "fees_year": 1, "currency": "GBP", "amount": 100.0, "status": "pending"})
+        stale_investor_id, legacy_investor_id = ObjectId(), ObjectId()
+        investor_summary_model.insert_many([
+            {"_id": stale_investor_id, "investment_count": 1, "rebuilt_at": datetime(2020, 1, 1)},
+            {"_id": legacy_investor_id, "investment_count": 1},
+        ])
+        call_command('rebuild_investor_summaries', stdout=StringIO())
+        summary = get_investor_summary(self.investor_id)
+        self.assertEqual(summary['investment_max'], 60000.0)
+        self.assertEqual(summary['outstanding_bills'], {"GBP": 100.0})
+        self.assertIsNone(get_investor_summary(stale_investor_id))
+        self.assertIsNone(get_investor_summary(legacy_investor_id))
+
+    def test_bill_list_get_filtered(self):
+        bill_model.insert_many([
+            {"type": "yearly fees", "to_investor_id": self.investor_id, "fees_year": year, "currency": "GBP", "amount": 100.0, "status": bill_status, "due_date": due_date, "capital_call_id": self.capital_call_id}
+            for year, (bill_status, due_date) in enumerate([("pending", "2024-01-10"), ("overdue", "2024-02-10"), ("paid", "2024-03-10")], start=1)
+        ])
+        url = reverse('bill-list')
+        response = self.client.get(url, {"status": "pending,overdue", "due_date_from": "2024-02-01", "fields": "status,amount"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(set(data[0]), {"_id", "status", "amount"})
+        self.assertEqual(data[0]['status'], "overdue")
+        response = self.client.get(url, {"capital_call_id": self.capital_call_id, "stream": "ndjson"})
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 3)
+        self.assertEqual(self.client.get(url, {"fields": "$where"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"due_date_to": "soon"}).status_code, 400)
+
+    def test_bill_list_get_due_date_range_paginated(self):
+        # Inserted out of due date order, pages follow the (due_date, _id) index
+        bill_model.insert_many([
+            {"type": "yearly fees", "to_investor_id": self.investor_id, "fees_year": year, "amount": amount, "due_date": due_date, "capital_call_id": self.capital_call_id}
+            for year, (amount, due_date) in enumerate([(1.0, "2024-03-10"), (2.0, "2024-01-10"), (3.0, "2024-02-10"), (4.0, "2024-01-10"), (5.0, "2023-12-31")], start=1)
+        ])
+        url = reverse('bill-list')
+        params = {"due_date_from": "2024-01-01", "fields": "amount", "limit": 1}
+        amounts = []
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([set(bill) for bill in response.json()], [{"_id", "amount"}])
+            amounts += [bill['amount'] for bill in response.json()]
+            if 'X-Next-Cursor' not in response:
+                break
+            params["after"] = response['X-Next-Cursor']
+        self.assertEqual(amounts, [2.0, 4.0, 3.0, 1.0])
+        entity_cursor = self.client.get(reverse('entity-list'), {"limit": 1})['X-Next-Cursor']
+        self.assertEqual(self.client.get(url, {"due_date_from": "2024-01-01", "after": entity_cursor}).status_code, 400)
+
+    def test_bill_list_due_date_range_plan_has_no_sort(self):
+        call_command('ensure_indexes', '--skip-usage', stdout=StringIO())
+        first_page = page_query({"limit": 10}, list_filter(bill_model, {"due_date_from": "2024-01-01"}))[1]
+        next_page = page_query({"limit": 10, "after": encode_cursor(ObjectId(), "2024-02-01")}, first_page)[1]
+        for query in [first_page, next_page]:
+            cursor = bill_model.find(query).sort(page_sort(query)).limit(11)
+            if not hasattr(cursor, "explain"):
+                self.skipTest("explaining a query requires a MongoDB server")
+            stages = {stage for plan in find_values(cursor.explain(), "winningPlan") for stage in find_values(plan, "stage")}
+            self.assertNotIn("SORT", stages)
+
+    def test_report_bills(self):
+        bill_model.insert_many([
+            {"type": bill_type, "to_investor_id": self.investor_id, "capital_call_id": capital_call_id, "fees_year": year, "currency": currency, "amount": amount, "status": "pending", "date": bill_date}
+            for year, (bill_type, capital_call_id, currency, amount, bill_date) in enumerate([
+                ("yearly fees", self.capital_call_id, "GBP", 100.0, "2024-01-10"),
+                ("yearly fees", self.capital_call_id, "GBP", 50.0, "2024-02-10"),
+                ("upfront fees", None, "EUR", 30.0, "2024-02-15"),
+            ], start=1)
+        ])
+        url = reverse('report-bills')
+        response = self.client.get(url, {"status": "pending"})
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual(report['by_type'], [
+            {"type": "upfront fees", "currency": "EUR", "total": 30.0, "count": 1},
+            {"type": "yearly fees", "currency": "GBP", "total": 150.0, "count": 2},
+        ])
+        self.assertIn({"month": "2024-02", "currency": "GBP", "total": 50.0, "count": 1}, report['by_month'])
+        self.assertCountEqual(report['by_fund'], [
+            {"fund_entity_id": {"$oid": str(self.fund.inserted_id)}, "currency": "GBP", "total": 150.0, "count": 2},
+            {"fund_entity_id": None, "currency": "EUR", "total": 30.0, "count": 1},
+        ])
+
+        # Served from Redis until a bill is written
+        response = self.client.get(url, {"status": "pending"})
+        self.assertEqual(response.json(), report)
+        self.assertEqual(response.wsgi_request.identity_map.total_round_trips, 0)
+        bill = {"type": "membership", "to_investor_id": self.investor_id, "capital_call_id": self.capital_call_id, "currency": "GBP", "amount": 3000.0, "status": "pending"}
+        self.client.post(reverse('bill-list'), data=json.dumps(bill), content_type='application/json')
+        report = self.client.get(url, {"status": "pending"}).json()
+        self.assertIn({"type": "membership", "currency": "GBP", "total": 3000.0, "count": 1}, report['by_type'])
+
+        # and until the fund of a capital call changes
+        self.client.put(reverse('capital-call-detail', kwargs={'pk': self.capital_call_id}), data=json.dumps({"fund_entity_id": self.investor_id}), content_type='application/json')
+        report = self.client.get(url, {"status": "pending"}).json()
+        self.assertIn({"fund_entity_id": self.investor_id, "currency": "GBP", "total": 3150.0, "count": 3}, report['by_fund'])
+
+    def test_report_investments(self):
+        response = self.client.get(reverse('report-investments'), {"investor_id": self.investor_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['by_month'], [{"month": "2024-11", "total": 60000.0, "count": 1}])
+
+    @override_settings(CHANGES_SETTLE_SECONDS=0)
+    def test_changes_feed(self):
+        url = reverse('investment-changes')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([investment['_id']['$oid'] for investment in data['changes']], [self.investment_id])
+        self.assertFalse(data['has_more'])
+        since = data['next']
+
+        # Only the writes made after the token are returned, deletions as tombstones
+        self.assertEqual(self.client.get(url, {"since": since}).json()['changes'], [])
+        data = {"amount": 50000.0, "investor_id": self.investor_id, "duration": 2, "date": "2024-12-01"}
+        created_id = self.client.post(reverse('investment-list'), data=json.dumps(data), content_type='application/json').json()['id']
+        self.client.delete(reverse('investment-detail', kwargs={'pk': self.investment_id}))
+        response = self.client.get(url, {"since": since, "limit": 1})
+        data = response.json()
+        self.assertEqual([investment['_id']['$oid'] for investment in data['changes']], [created_id])
+        self.assertTrue(data['has_more'])
+        data = self.client.get(url, {"since": data['next']}).json()
+        self.assertEqual(data['changes'], [])
+        self.assertEqual([deleted['_id']['$oid'] for deleted in data['deleted']], [self.investment_id])
+        self.assertFalse(data['has_more'])
+
+    def test_changes_feed_invalid_token(self):
+        url = reverse('bill-changes')
+        self.assertEqual(self.client.get(url, {"since": "not a token"}).status_code, 400)
+        with override_settings(CHANGES_RETENTION_DAYS=1):
+            since = encode_token(datetime(2024, 1, 1), ObjectId())
+            self.assertEqual(self.client.get(url, {"since": since}).status_code, 410)
+
+    def test_request_metrics(self):
+        response = self.client.get(reverse('entity-list'))
+        self.assertIn('mongodb;dur=', response['Server-Timing'])
+        self.assertIn('desc="1 commands"', response['Server-Timing'])
+        response = self.client.get(reverse('report-investments'))
+        self.assertRegex(response['Server-Timing'], r'redis;dur=[0-9.]+;desc="[1-9][0-9]* calls"')
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="200",view="entity-list"}', content)
+        self.assertIn('http_request_mongodb_commands_bucket{le="1.0",view="entity-list"}', content)
+        self.assertIn('mongodb_command_duration_seconds_count{command="find"}', content)
+
+    def test_list_filters_are_indexed(self):
+        for collection_name, filters in LIST_FILTERS.items():
+            keys = [list(index.document["key"]) for index in INDEXES[collection_name]]
+            for parameter, (field, operator) in filters.items():
+                self.assertIn([field, "_id"], keys, f"{collection_name} filter {parameter} is not indexed in the order of the pages")
+                # Pages of an equality filter are sorted by _id, of a range by the field then _id
+                if operator == "$eq":
+                    self.assertEqual(page_sort({field: "value"}), [("_id", 1)])
+                else:
+                    self.assertEqual(page_sort({field: {operator: "value"}}), [(field, 1), ("_id", 1)])
+
+    def test_ensure_indexes(self):
+        call_command('ensure_indexes', '--skip-usage', stdout=StringIO())
+        self.assertIn('to_investor_id_type_fees_year', bill_model.index_information())
+        self.assertIn('status_due_date', bill_model.index_information())
+        self.assertIn('bills', capital_call_model.index_information())
+
+    def test_bill_investor_post_duplicate_membership(self):
+        call_command('ensure_indexes', '--skip-usage', stdout=StringIO())
+        bill_model.insert_one({"type": "membership", "to_investor_id": self.investor_id, "fees_year": 0, "capital_call_id": self.capital_call_id})
+        url = reverse('bill-investor')
+        data = {"type": "membership", "to_investor_id": self.investor_id, "capital_call_id": self.capital_call_id, "currency": "GBP"}
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], f"membership bill already exists for investor {self.investor_id}")
+        self.assertEqual(bill_model.count_documents({"to_investor_id": self.investor_id}), 1)
+
+    def test_bill_investor_post_yearly_after_upfront(self):
+        bill_model.insert_one({"type": "upfront fees", "to_investor_id": self.investor_id, "fees_year": 0, "capital_call_id": self.capital_call_id})
+        url = reverse('bill-investor')
+        data = {"type": "yearly fees", "to_investor_id": self.investor_id, "fees_year": 1, "capital_call_id": self.capital_call_id, "investment_id": self.investment_id}
+        response = self.client.post(url, data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()['error'],
+            f"Upfront fees bill already exists for investor {self.investor_id} hence cannot generate a yearly fees bill",
+        )
+
+    def test_query_plan_guard(self):
+        collection_scan = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}, "executionStats": {"totalDocsExamined": 3, "nReturned": 1}}
+        index_scan = {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}, "executionStats": {"totalDocsExamined": 1, "nReturned": 1}}
+        with override_settings(QUERY_PLAN_GUARD="raise"), patch("utils.query_plan.explain_find", return_value=collection_scan) as explain:
+            with self.assertRaisesMessage(UnindexedQuery, "find_one on bill scans the whole collection"):
+                check_existing_bill(bill_model, BillType.YEARLY_FEES, self.investor_id, 1)
+            with self.assertRaises(UnindexedQuery):
+                list(bill_model.find({"status": "overdue"}).limit(10))
+            # Queries without a filter read the whole collection by design
+            bill_model.delete_many({})
+            self.assertEqual(explain.call_count, 2)
+        with override_settings(QUERY_PLAN_GUARD="raise"), patch("utils.query_plan.explain_find", return_value=index_scan):
+            self.assertIsNone(check_existing_bill(bill_model, BillType.YEARLY_FEES, self.investor_id, 1))
+            mark_overdue_invoices()
+        examined_too_many = {**index_scan, "executionStats": {"totalDocsExamined": 50, "nReturned": 1}}
+        with override_settings(QUERY_PLAN_GUARD="log", QUERY_PLAN_MAX_RATIO=10), patch("utils.query_plan.explain_find", return_value=examined_too_many):
+            with self.assertLogs('app', level='WARNING') as logs:
+                response = self.client.get(reverse('entity-detail', kwargs={'pk': self.investor_id}))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("examined 50 documents for 1 returned", logs.output[0])
+        with patch("utils.query_plan.explain_find") as explain:
+            check_existing_bill(bill_model, BillType.YEARLY_FEES, self.investor_id, 1)
+            explain.assert_not_called()
+
+    def test_query_plan_guard_aggregate(self):
+        collection_scan = {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}, "executionStats": {"totalDocsExamined": 3, "nReturned": 3}}}]}
+        index_scan = {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}, "executionStats": {"totalDocsExamined": 1, "nReturned": 1}}
+        with override_settings(QUERY_PLAN_GUARD="raise"), patch("utils.query_plan.explain_aggregate", return_value=collection_scan) as explain, \
+                patch("utils.query_plan.explain_find", return_value=index_scan):
+            with self.assertRaisesMessage(UnindexedQuery, "aggregate on investment scans the whole collection"):
+                list(investment_model.aggregate([{"$match": {"amount": {"$gt": 0}}}]))
+            # Unfiltered pipelines read the whole collection by design
+            rebuild_investor_summaries()
+            list(investment_model.aggregate([{"$match": {}}, {"$count": "investments"}]))
+            self.assertEqual(explain.call_count, 1)
+
+    async def test_query_plan_guard_async(self):
+        collection_scan = {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}, "executionStats": {"totalDocsExamined": 3, "nReturned": 1}}
+        index_scan = {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}, "executionStats": {"totalDocsExamined": 1, "nReturned": 1}}
+        with override_settings(QUERY_PLAN_GUARD="raise"), patch("utils.query_plan.aexplain_find", AsyncMock(return_value=collection_scan)) as explain:
+            bills = db_connection.get_async_collection(bill_model)
+            with self.assertRaisesMessage(UnindexedQuery, "find_one on bill scans the whole collection"):
+                await acheck_existing_bill(bills, BillType.YEARLY_FEES, self.investor_id, 1)
+            self.assertEqual(explain.await_count, 1)
+        with override_settings(QUERY_PLAN_GUARD="raise"), patch("utils.query_plan.aexplain_find", AsyncMock(return_value=index_scan)), \
+                patch("utils.query_plan.aexplain_aggregate", AsyncMock(return_value=collection_scan)):
+            self.assertIsNone(await acheck_existing_bill(db_connection.get_async_collection(bill_model), BillType.YEARLY_FEES, self.investor_id, 1))
+            response = await AsyncClient().get(reverse('async-investment-detail', args=[self.investment_id]))
+            self.assertEqual(response.status_code, 200)
+            with self.assertLogs('app', level='ERROR') as logs:
+                response = await AsyncClient().get(reverse('async-capital-call-detail', args=[self.capital_call_id]), {"expand": "investors"})
+            self.assertEqual(response.status_code, 500)
+            self.assertIn("aggregate on capital_call scans the whole collection", logs.output[0])
+
+class JsonCodecTestCase(SimpleTestCase):
+
+    def test_dumps_matches_json_util(self):
+        document = {
+            "_id": ObjectId(),
+            "amount": Decimal128("1250.10"),
+            "date": datetime(2024, 1, 15, 10, 30, 0, 123000),
+            "due_date": datetime(2024, 2, 15),
+            "bills": [ObjectId(), str(ObjectId())],
+            "status": BillStatus.CREATED,
+        }
+        self.assertEqual(json.loads(dumps(document)), json.loads(json_util.dumps(document)))
+
+
+class LoggerTestCase(SimpleTestCase):
+
+    def test_json_formatter(self):
+        record = logging.makeLogRecord({"name": "app", "levelno": logging.INFO, "levelname": "INFO", "msg": "Bill %s created", "args": ("b1",), "investor_id": "i1"})
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry["level"], entry["message"], entry["investor_id"]), ("INFO", "Bill b1 created", "i1"))
+
+    def test_sampling_keeps_warnings(self):
+        sampling = SamplingFilter(0)
+        self.assertFalse(sampling.filter(logging.makeLogRecord({"levelno": logging.INFO})))
+        self.assertTrue(sampling.filter(logging.makeLogRecord({"levelno": logging.WARNING})))
+
+    def test_log_payload_is_debug_and_truncated(self):
+        with self.assertLogs("app", logging.INFO) as logs:
+            log_payload("Received bill data", {"amount": 1})
+            logging.getLogger("app").info("marker")
+        self.assertEqual(len(logs.records), 1)
+        with self.assertLogs("app", logging.DEBUG) as logs, patch("utils.logger.LOG_PAYLOAD_MAX_CHARS", 10):
+            log_payload("Received bill data", {"purpose": "x" * 100})
+        self.assertEqual(logs.records[0].getMessage(), 'Received bill data: {"purpose"... (115 chars)')
+
+
+class FeeEngineTestCase(SimpleTestCase):
+
+    def test_yearly_fee_schedules_match_compute_investment_fee(self):
+        investments = [
+            {"amount": amount, "date": investment_date, "duration": duration}
+            for amount in (45000.0, 120000.0)
+            for investment_date in ("2015-02-10", "2018-06-01", "2019-03-31", "2019-04-01", "2022-01-15", "2023-11-30")
+            for duration in (0, 1, 3, 6)
+        ]
+        schedules = yearly_fee_schedules(*to_arrays(investments), 0.02)
+        for investment, schedule in zip(investments, schedules):
+            for year in range(1, len(schedule) + 1):
+                self.assertEqual(schedule[year - 1], compute_investment_fee(BillType.YEARLY_FEES, 0.02, investment, year))
+
+
+class ExchangeRateProviderTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.next_rates = {"GBP": 0.8, "EUR": 0.9}
+
+    def load_rates(self):
+        self.loads.append(self.next_rates)
+        if isinstance(self.next_rates, Exception):
+            raise self.next_rates
+        return self.next_rates
+
+    def test_rates_are_cached_until_invalidated(self):
+        provider = ExchangeRateProvider(self.load_rates, ttl=60, channel=None)
+        self.assertEqual(provider.get("GBP"), 0.8)
+        self.assertEqual(provider.get("EUR"), 0.9)
+        self.assertEqual(len(self.loads), 1)
+        self.next_rates = {"GBP": 0.7}
+        provider.invalidate()
+        self.assertEqual(provider.get("GBP"), 0.7)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_previous_rates_are_kept_when_redis_is_down(self):
+        provider = ExchangeRateProvider(self.load_rates, ttl=0, channel=None)
+        self.assertEqual(provider.get("GBP"), 0.8)
+        self.next_rates = redis.ConnectionError("Redis is down")
+        self.assertEqual(provider.get("GBP"), 0.8)
+
+    def test_listener_restarts_after_failure(self):
+        connection = MagicMock()
+        with patch("utils.currency_conversion.get_redis", return_value=connection):
+            provider = ExchangeRateProvider(self.load_rates, ttl=60, channel="currencies:updated")
+            self.assertEqual(provider.get("GBP"), 0.8)
+            run_in_thread = connection.pubsub.return_value.run_in_thread
+            self.assertEqual(run_in_thread.call_count, 1)
+
+            # The thread is stopped and the rates, which may have missed updates, are reloaded
+            thread = MagicMock()
+            run_in_thread.call_args.kwargs["exception_handler"](redis.ConnectionError("Connection lost"), connection.pubsub.return_value, thread)
+            thread.stop.assert_called_once()
+            self.assertEqual(provider.get("GBP"), 0.8)
+            self.assertEqual(len(self.loads), 2)
+            self.assertEqual(run_in_thread.call_count, 2)
+            self.assertEqual(provider.get("GBP"), 0.8)
+            self.assertEqual(run_in_thread.call_count, 2)
+
+    def test_convert_many(self):
+        provider = ExchangeRateProvider(self.load_rates, ttl=60, channel=None)
+        self.assertEqual(provider.convert_many([100, 200, 300], ["GBP", "USD", "EUR"]), [80.0, 200, 270.0])
+        with self.assertRaisesMessage(ValueError, "Exchange rate not available for JPY."):
+            provider.convert_many([100, 200], ["GBP", "JPY"])
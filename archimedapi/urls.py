@@ -16,15 +16,22 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
+from archimedapi import async_views
 from archimedapi.views import (
+    bill_capital_call,
     bill_investor,
     bill_detail,
     bill_list,
+    changes,
     capital_call_detail,
     capital_call_list,
     index,
     investment_list,
     investment_detail,
+    investment_fee_forecast,
+    metrics,
+    report_bills,
+    report_investments,
     entity_list,
     entity_detail
 )
@@ -32,13 +39,31 @@ from archimedapi.views import (
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("", index, name='index'),
+    path("metrics", metrics, name='metrics'),
     path("capital_calls/", capital_call_list, name='capital-call-list'),
+    path("capital_calls/changes/", changes, {"collection": "capital_calls"}, name='capital-call-changes'),
     path('capital_calls/<str:pk>/', capital_call_detail, name='capital-call-detail'),
+    path('capital_calls/<str:pk>/bills/', bill_capital_call, name='capital-call-bills'),
     path("bills/", bill_list, name='bill-list'),
+    path("bills/changes/", changes, {"collection": "bills"}, name='bill-changes'),
     path("bills/<str:pk>/", bill_detail, name='bill-detail'),
     path("create_bill/", bill_investor, name='bill-investor'),
     path("entities/", entity_list, name='entity-list'),
+    path("entities/changes/", changes, {"collection": "entities"}, name='entity-changes'),
     path("entities/<str:pk>/", entity_detail, name='entity-detail'),
     path("investments/", investment_list, name='investment-list'),
+    path("investments/changes/", changes, {"collection": "investments"}, name='investment-changes'),
+    path("investments/fee_forecast/", investment_fee_forecast, name='investment-fee-forecast'),
     path("investments/<str:pk>/", investment_detail, name='investment-detail'),
+    path("reports/bills/", report_bills, name='report-bills'),
+    path("reports/investments/", report_investments, name='report-investments'),
+    path("async/capital_calls/", async_views.capital_call_list, name='async-capital-call-list'),
+    path("async/capital_calls/<str:pk>/", async_views.capital_call_detail, name='async-capital-call-detail'),
+    path("async/bills/", async_views.bill_list, name='async-bill-list'),
+    path("async/bills/<str:pk>/", async_views.bill_detail, name='async-bill-detail'),
+    path("async/create_bill/", async_views.bill_investor, name='async-bill-investor'),
+    path("async/entities/", async_views.entity_list, name='async-entity-list'),
+    path("async/entities/<str:pk>/", async_views.entity_detail, name='async-entity-detail'),
+    path("async/investments/", async_views.investment_list, name='async-investment-list'),
+    path("async/investments/<str:pk>/", async_views.investment_detail, name='async-investment-detail'),
 ]
@@ -1,17 +1,37 @@
-import json
 import os
 from dotenv import load_dotenv
 
-from bson import ObjectId, json_util
-from django.http import JsonResponse
+from bson import ObjectId
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from rest_framework import status
 from rest_framework.decorators import api_view
-from rest_framework.parsers import JSONParser
 
-from utils.logger import logger
+from utils.identity_map import forget_document, get_document
+from utils.investor_summary import (
+    record_bill_deleted,
+    record_bill_updated,
+    record_bills_created,
+    record_investment_created,
+    record_investment_deleted,
+    record_investment_updated,
+)
+from utils.json_codec import BSONJsonResponse, dumps
+from utils.logger import log_payload, logger
+from utils.metrics import render_metrics
 from utils.currency_conversion import convert_currency
-from utils.bill_utils import check_existing_bill, compute_bill_amount
+from utils.changes import ExpiredToken, changes_since, record_deletion
+from utils.cache import bump_generation, cache_document, cached_result, get_cached_document, invalidate_documents
+from utils.expand import add_bill_totals, expand_pipeline, expand_projection, parse_expand
+from utils.fee_engine import fee_forecast, fee_schedule_fields, split_valid_dates
+from utils.filters import list_filter, list_projection
+from utils.bill_utils import check_existing_bill, compute_bill_amount, duplicate_bill_error, prepare_capital_call_bills
+from utils.pagination import get_page_size, paginate
+from utils.reporting import bill_report, investment_report
+from utils.streaming import STREAM_FORMATS, stream_documents
+from utils.versioning import document_etag, etag_matches, last_modified, stamp_new, stamped, updated_document
 
 load_dotenv()
 
@@ -25,28 +45,97 @@ from .models import (
     capital_call_model,
     investment_model,
     entity_model,
+    stored_bank_account,
+    validate_update,
 )
 
-def parse_json(data):
-    return json.loads(json_util.dumps(data))
+# Investment fields the materialised fee schedule depends on
+FEE_SCHEDULE_FIELDS = {"amount", "date", "duration"}
+
+def paginated_response(request, documents, next_cursor):
+    response = BSONJsonResponse(documents)
+    if next_cursor:
+        params = request.GET.copy()
+        params["after"] = next_cursor
+        response["X-Next-Cursor"] = next_cursor
+        response["Link"] = f'<{request.build_absolute_uri(request.path)}?{params.urlencode()}>; rel="next"'
+    return response
+
+def versioned_response(request, entry):
+    """Respond with a serialised document, or with a 304 if the client already has this version of it."""
+    if etag_matches(request.headers.get("If-None-Match"), entry["etag"]):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = HttpResponse(entry["body"], content_type="application/json")
+    if entry["etag"]:
+        response["ETag"] = entry["etag"]
+    if entry["last_modified"]:
+        response["Last-Modified"] = entry["last_modified"]
+    return response
+
+def document_response(request, collection, pk, name):
+    """GET of a detail route, honouring If-None-Match and served from the detail cache when it is enabled."""
+    entry = get_cached_document(collection, pk)
+    if entry is None:
+        try:
+            if_none_match = request.headers.get("If-None-Match")
+            if if_none_match:
+                # Compare the versions before reading the whole document
+                stamp = collection.find_one({"_id": ObjectId(pk)}, {"_version": 1, "updated_at": 1})
+                if stamp and etag_matches(if_none_match, document_etag(stamp)):
+                    logger.info("%s with id %s not modified for user %s", name.capitalize(), pk, request.user)
+                    return versioned_response(request, {"etag": document_etag(stamp), "last_modified": last_modified(stamp)})
+            document = collection.find_one({"_id": ObjectId(pk)})
+        except Exception as e:
+            logger.error("Error retrieving %s with id %s: %s", name, pk, e)
+            return JsonResponse({'message': f'Error retrieving the {name}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not document:
+            logger.error("%s with id %s does not exist, requested by user %s", name.capitalize(), pk, request.user)
+            return JsonResponse({'message': f'The {name} does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        body = dumps(document)
+        entry = {"body": body, "etag": document_etag(document, body), "last_modified": last_modified(document)}
+        cache_document(collection, pk, entry)
+    logger.info("Returning %s data for id %s to user %s", name, pk, request.user)
+    return versioned_response(request, entry)
+
+def streaming_response(collection, output_format, query=None, projection=None):
+    if output_format not in STREAM_FORMATS:
+        return JsonResponse({'error': f"Invalid stream format {output_format}"}, status=status.HTTP_400_BAD_REQUEST)
+    return StreamingHttpResponse(stream_documents(collection.find(query or {}, projection), output_format), content_type=STREAM_FORMATS[output_format])
 
 def index(request):
     return JsonResponse({"message": "Hello, world. You're at the archimedapi index."})
 
+def metrics(request):
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
+
 @csrf_exempt
 @api_view(['GET', 'POST'])
 def bill_list(request):
     logger.info("bill_list view called with method %s by user %s", request.method, request.user)
     if request.method == 'GET':
-        bills = parse_json(bill_model.find())
+        try:
+            query = list_filter(bill_model, request.query_params)
+            projection = list_projection(bill_model, request.query_params)
+            if request.query_params.get("stream"):
+                logger.info("Streaming bills matching %s for user %s", query, request.user)
+                return streaming_response(bill_model, request.query_params["stream"], query, projection)
+            bills, next_cursor = paginate(bill_model, request.query_params, query, projection=projection)
+        except ValueError as e:
+            logger.error("Invalid query parameters: %s", e)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         logger.info("Returning %d bills for user %s", len(bills), request.user)
-        return JsonResponse(bills, safe=False)
+        return paginated_response(request, bills, next_cursor)
     elif request.method == 'POST':
-        bill_data = JSONParser().parse(request)
-        logger.info("Received bill data: %s", bill_data)
+        bill_data = request.data
+        log_payload("Received bill data", bill_data)
         try:
             validated_data = BillModel(**bill_data)
-            result = bill_model.insert_one(validated_data.model_dump())
+            bill = stamp_new(validated_data.model_dump())
+            result = bill_model.insert_one(bill)
+            record_bills_created([bill])
+            bump_generation(bill_model)
             return JsonResponse({'id': str(result.inserted_id)}, status=status.HTTP_201_CREATED)
         except Exception as e:
             logger.error("Failed to validate bill data: %s", e)
@@ -55,6 +144,26 @@ def bill_list(request):
 @api_view(['GET', 'PUT', 'DELETE'])
 def bill_detail(request, pk):
     logger.info("bill_detail view called with method %s for bill id %s by user %s", request.method, pk, request.user)
+    if request.method == 'PUT':
+        try:
+            bill_data = validate_update(BillModel, request.data)
+            update = stamped({"$set": bill_data})
+            bill = bill_model.find_one_and_update({"_id": ObjectId(pk)}, update)
+            updated_bill = bill and updated_document(bill, update)
+            if bill:
+                invalidate_documents(bill_model, [pk])
+                record_bill_updated(bill, updated_bill)
+                bump_generation(bill_model)
+        except Exception as e:
+            logger.warning("Bill update failed for id %s with errors: %s", pk, e)
+            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not updated_bill:
+            logger.error("Bill with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The bill does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        logger.info("Bill with id %s updated successfully by user %s", pk, request.user)
+        return BSONJsonResponse(updated_bill, status=status.HTTP_200_OK)
+    if request.method == 'GET':
+        return document_response(request, bill_model, pk, "bill")
     try:
         bill = bill_model.find_one({"_id": ObjectId(pk)})
         if not bill:
@@ -63,23 +172,17 @@ def bill_detail(request, pk):
     except Exception as e:
         logger.error("Error retrieving bill with id %s: %s", pk, e)
         return JsonResponse({'message': 'Error retrieving the bill'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    if request.method == 'GET':
-        logger.info("Returning bill data for id %s to user %s", pk, request.user)
-        return JsonResponse(parse_json(bill), safe=False)
-    elif request.method == 'PUT':
-        bill_data = JSONParser().parse(request)
-        try:
-            bill_model.update_one({"_id": ObjectId(pk)}, {"$set": bill_data})
-            updated_bill = bill_model.find_one({"_id": ObjectId(pk)})
-            logger.info("Bill with id %s updated successfully by user %s", pk, request.user)
-            return JsonResponse(parse_json(updated_bill), status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.warning("Bill update failed for id %s with errors: %s", pk, e)
-            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    elif request.method == 'DELETE':
+    if request.method == 'DELETE':
         try:
             bill_model.delete_one({"_id": ObjectId(pk)})
-            capital_call_model.update_many({"bills": ObjectId(pk)}, {"$pull": {"bills": ObjectId(pk)}})
+            invalidate_documents(bill_model, [pk])
+            record_deletion(bill_model, pk)
+            record_bill_deleted(bill)
+            bump_generation(bill_model)
+            capital_call_ids = [capital_call["_id"] for capital_call in capital_call_model.find({"bills": ObjectId(pk)}, {"_id": 1})]
+            if capital_call_ids:
+                capital_call_model.update_many({"_id": {"$in": capital_call_ids}}, stamped({"$pull": {"bills": ObjectId(pk)}}))
+                invalidate_documents(capital_call_model, capital_call_ids)
             logger.info("Bill with id %s deleted successfully by user %s", pk, request.user)
             return JsonResponse({'message': 'Bill was deleted successfully!'}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
@@ -91,15 +194,28 @@ def bill_detail(request, pk):
 def capital_call_list(request):
     logger.info("capital_call_list view called with method %s by user %s", request.method, request.user)
     if request.method == 'GET':
-        capital_calls = parse_json(capital_call_model.find())
+        try:
+            query = list_filter(capital_call_model, request.query_params)
+            projection = list_projection(capital_call_model, request.query_params)
+            if request.query_params.get("stream"):
+                logger.info("Streaming capital calls matching %s for user %s", query, request.user)
+                return streaming_response(capital_call_model, request.query_params["stream"], query, projection)
+            expand = parse_expand(request.query_params.get("expand"))
+            projection = expand_projection(projection, expand)
+            capital_calls, next_cursor = paginate(capital_call_model, request.query_params, query, expand_pipeline(expand), projection)
+        except ValueError as e:
+            logger.error("Invalid query parameters: %s", e)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if "bills" in expand:
+            add_bill_totals(capital_calls)
         logger.info("Returning %d capital calls for user %s", len(capital_calls), request.user)
-        return JsonResponse(capital_calls, safe=False)
+        return paginated_response(request, capital_calls, next_cursor)
     elif request.method == 'POST':
-        capital_call_data = JSONParser().parse(request)
-        logger.info("Received capital call data: %s", capital_call_data)
+        capital_call_data = request.data
+        log_payload("Received capital call data", capital_call_data)
         try:
             validated_data = CapitalCallModel(**capital_call_data)
-            result = capital_call_model.insert_one(validated_data.model_dump())
+            result = capital_call_model.insert_one(stamp_new(validated_data.model_dump()))
             return JsonResponse({'id': str(result.inserted_id)}, status=status.HTTP_201_CREATED)
         except Exception as e:
             logger.error("Failed to validate capital call data: %s", e)
@@ -108,6 +224,41 @@ def capital_call_list(request):
 @api_view(['GET', 'PUT', 'DELETE'])
 def capital_call_detail(request, pk):
     logger.info("capital_call_detail view called with method %s for capital id %s by user %s", request.method, pk, request.user)
+    if request.method == 'PUT':
+        try:
+            capital_call_data = validate_update(CapitalCallModel, request.data)
+            updated_capital_call = capital_call_model.find_one_and_update({"_id": ObjectId(pk)}, stamped({"$set": capital_call_data}), return_document=ReturnDocument.AFTER)
+            invalidate_documents(capital_call_model, [pk])
+            # The bill report totals the bills per fund of their capital call
+            bump_generation(capital_call_model)
+        except Exception as e:
+            logger.warning("Capital call update failed for id %s with errors: %s", pk, e)
+            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not updated_capital_call:
+            logger.error("Capital call with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The capital call does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        logger.info("Capital call with id %s updated successfully by user %s", pk, request.user)
+        return BSONJsonResponse(updated_capital_call, status=status.HTTP_200_OK)
+    if request.method == 'GET' and request.query_params.get("expand"):
+        try:
+            expand = parse_expand(request.query_params["expand"])
+        except ValueError as e:
+            logger.error("Invalid expand parameter: %s", e)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            capital_call = next(capital_call_model.aggregate([{"$match": {"_id": ObjectId(pk)}}, *expand_pipeline(expand)]), None)
+        except Exception as e:
+            logger.error("Error retrieving capital call with id %s: %s", pk, e)
+            return JsonResponse({'message': 'Error retrieving the capital call'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if not capital_call:
+            logger.error("Capital call with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The capital call does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        if "bills" in expand:
+            add_bill_totals([capital_call])
+        logger.info("Returning capital call data for id %s expanded with %s to user %s", pk, ", ".join(expand), request.user)
+        return BSONJsonResponse(capital_call)
+    if request.method == 'GET':
+        return document_response(request, capital_call_model, pk, "capital call")
     try:
         capital_call = capital_call_model.find_one({"_id": ObjectId(pk)})
         if not capital_call:
@@ -116,22 +267,12 @@ def capital_call_detail(request, pk):
     except Exception as e:
         logger.error("Error retrieving capital call with id %s: %s", pk, e)
         return JsonResponse({'message': 'Error retrieving the capital call'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    if request.method == 'GET':
-        logger.info("Returning capital call data for id %s to user %s", pk, request.user)
-        return JsonResponse(parse_json(capital_call), safe=False)
-    elif request.method == 'PUT':
-        capital_call_data = JSONParser().parse(request)
-        try:
-            capital_call_model.update_one({"_id": ObjectId(pk)}, {"$set": capital_call_data})
-            updated_capital_call = capital_call_model.find_one({"_id": ObjectId(pk)})
-            logger.info("Capital call with id %s updated successfully by user %s", pk, request.user)
-            return JsonResponse(parse_json(updated_capital_call), status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.warning("Capital call update failed for id %s with errors: %s", pk, e)
-            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    elif request.method == 'DELETE':
+    if request.method == 'DELETE':
         try:
             capital_call_model.delete_one({"_id": ObjectId(pk)})
+            invalidate_documents(capital_call_model, [pk])
+            bump_generation(capital_call_model)
+            record_deletion(capital_call_model, pk)
             logger.info("Capital call with id %s deleted successfully by user %s", pk, request.user)
             return JsonResponse({'message': 'Capital call was deleted successfully!'}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
@@ -140,7 +281,9 @@ def capital_call_detail(request, pk):
 
 def update_capital_call_with_bill(capital_call_id, bill):
     try:
-        capital_call_model.update_one({"_id": ObjectId(capital_call_id)}, {"$push": {"bills": bill.inserted_id}})
+        capital_call_model.update_one({"_id": ObjectId(capital_call_id)}, stamped({"$push": {"bills": bill.inserted_id}}))
+        forget_document(capital_call_model, capital_call_id)
+        invalidate_documents(capital_call_model, [capital_call_id])
         logger.info("Capital call with id %s updated with new bill %s", capital_call_id, bill.inserted_id)
     except Exception as e:
         logger.error("Failed to update capital call with id %s with new bill: %s", capital_call_id, e)
@@ -149,11 +292,11 @@ def update_capital_call_with_bill(capital_call_id, bill):
 @api_view(['POST'])
 def bill_investor(request):
     logger.info("bill_investor view called with method %s by user %s", request.method, request.user)
-    data = JSONParser().parse(request)
+    data = request.data
     if not data:
         logger.error("No bill data provided by user %s", request.user)
         return JsonResponse({'error': 'bill data is required'}, status=status.HTTP_400_BAD_REQUEST)
-    logger.info("Received bill data: %s", data)
+    log_payload("Received bill data", data)
     year = data.get("fees_year", 0)
     data["fees_year"] = int(year) 
     investor_id = data.get("to_investor_id")
@@ -162,7 +305,7 @@ def bill_investor(request):
         logger.error("to_investor_id is missing in the request by user %s", request.user)
         return JsonResponse({'error': 'to_investor_id is required'}, status=status.HTTP_400_BAD_REQUEST)
     try:
-        investor = entity_model.find_one({"_id": ObjectId(investor_id)})
+        investor = get_document(entity_model, investor_id)
     except Exception as e:
         logger.error("Invalid investor_id %s: %s", investor_id, e)
         return JsonResponse({'error': 'Invalid investor_id'}, status=status.HTTP_400_BAD_REQUEST)
@@ -184,33 +327,117 @@ def bill_investor(request):
     bill_amount = convert_currency(bill_amount, investor.get("bank_account_currency"))
     data["amount"] = bill_amount
     try:
-        bill = BillModel(**data)
-        inserted_result = bill_model.insert_one(bill.model_dump())
+        bill = stamp_new(BillModel(**data).model_dump())
+        inserted_result = bill_model.insert_one(bill)
+        record_bills_created([bill])
+        bump_generation(bill_model)
         update_capital_call_with_bill(data["capital_call_id"], inserted_result)
+    except DuplicateKeyError:
+        logger.error("Duplicate %s bill for investor %s", bill_type, investor_id)
+        return JsonResponse({'error': duplicate_bill_error(bill_type, investor_id, year)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error("Error creating bill for investor %s: %s", investor_id, e)
         return JsonResponse({'error': 'Error creating bill '}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     logger.info("Bill created successfully for investor %s", investor_id)
     return JsonResponse({'message': 'Bill created successfully'}, status=status.HTTP_201_CREATED)
 
+@csrf_exempt
+@api_view(['POST'])
+def bill_capital_call(request, pk):
+    logger.info("bill_capital_call view called with method %s for capital call id %s by user %s", request.method, pk, request.user)
+    data = request.data
+    bill_type = data.get("type")
+    if bill_type not in BillType.values:
+        logger.error("Invalid bill type %s in the request by user %s", bill_type, request.user)
+        return JsonResponse({'error': 'a valid bill type is required'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        year = int(data.get("fees_year", 0))
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'fees_year must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    if bill_type == BillType.YEARLY_FEES and year < 1:
+        return JsonResponse({'error': 'fees_year must be a positive integer for yearly fees bills'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        capital_call = get_document(capital_call_model, pk, {"investor_entities": 1})
+        if not capital_call:
+            logger.error("Capital call with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The capital call does not exist'}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        logger.error("Error retrieving capital call with id %s: %s", pk, e)
+        return JsonResponse({'message': 'Error retrieving the capital call'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    investor_ids = list(dict.fromkeys(capital_call.get("investor_entities", [])))
+    percentage_fee = float(os.getenv("PERCENTAGE_FEE", 0.02))
+    bills, errors = prepare_capital_call_bills(pk, bill_type, year, investor_ids, percentage_fee, data.get("investments"))
+    bill_ids = {}
+    if bills:
+        documents = [stamp_new(bill.model_dump()) for bill in bills.values()]
+        try:
+            try:
+                # insert_many sets the _id of the documents, including the ones rejected
+                bill_model.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Bills created concurrently since the existing ones were read are rejected by the unique indexes
+                write_errors = e.details["writeErrors"]
+                if any(error["code"] != 11000 for error in write_errors):
+                    raise
+                for error in write_errors:
+                    investor_id = documents[error["index"]]["to_investor_id"]
+                    errors[investor_id] = duplicate_bill_error(bill_type, investor_id, year)
+            bill_ids = {
+                investor_id: document["_id"] for investor_id, document in zip(bills, documents) if investor_id not in errors
+            }
+            record_bills_created([document for investor_id, document in zip(bills, documents) if investor_id in bill_ids])
+            bump_generation(bill_model)
+            if bill_ids:
+                capital_call_model.update_one({"_id": ObjectId(pk)}, stamped({"$push": {"bills": {"$each": list(bill_ids.values())}}}))
+                forget_document(capital_call_model, pk)
+                invalidate_documents(capital_call_model, [pk])
+        except Exception as e:
+            logger.error("Error creating bills for capital call %s: %s", pk, e)
+            return JsonResponse({'error': 'Error creating bills'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    results = []
+    for investor_id in investor_ids:
+        if investor_id in bill_ids:
+            bill = bills[investor_id]
+            results.append({'investor_id': investor_id, 'status': 'created', 'bill_id': str(bill_ids[investor_id]), 'amount': bill.amount, 'currency': bill.currency})
+        else:
+            results.append({'investor_id': investor_id, 'status': 'skipped', 'error': errors[investor_id]})
+    logger.info("Created %d bills for capital call %s, skipped %d investors", len(bill_ids), pk, len(errors))
+    return JsonResponse({'created': len(bill_ids), 'results': results}, status=status.HTTP_201_CREATED if bill_ids else status.HTTP_200_OK)
+
 @csrf_exempt
 @api_view(['GET', 'POST'])
 def investment_list(request):
     logger.info("investment_list view called with method %s by user %s", request.method, request.user)
     if request.method == 'GET':
-        investments = parse_json(investment_model.find())
+        try:
+            query = list_filter(investment_model, request.query_params)
+            projection = list_projection(investment_model, request.query_params)
+            if request.query_params.get("stream"):
+                logger.info("Streaming investments matching %s for user %s", query, request.user)
+                return streaming_response(investment_model, request.query_params["stream"], query, projection)
+            investments, next_cursor = paginate(investment_model, request.query_params, query, projection=projection)
+        except ValueError as e:
+            logger.error("Invalid query parameters: %s", e)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         logger.info("Returning %d investments for user %s", len(investments), request.user)
-        return JsonResponse(investments, safe=False)
+        return paginated_response(request, investments, next_cursor)
     elif request.method == 'POST':
-        investment_data = JSONParser().parse(request)
-        logger.info("Received investment data: %s", investment_data)
+        investment_data = request.data
+        log_payload("Received investment data", investment_data)
         try:
             validated_data = Investment(**investment_data)
-            result = investment_model.insert_one(validated_data.model_dump())
+            investment = validated_data.model_dump()
+            investment.update(fee_schedule_fields([investment], float(os.getenv("PERCENTAGE_FEE", 0.02)))[0])
+            result = investment_model.insert_one(stamp_new(investment))
+            record_investment_created(investment)
+            bump_generation(investment_model)
             if validated_data.amount > 50000:
-                membership_bill = bill_model.find_one({"type": BillType.MEMBERSHIP, "to_investor_id": validated_data.investor_id})
+                update = stamped({"$set": {"amount": 0}})
+                membership_bill = bill_model.find_one_and_update({"type": BillType.MEMBERSHIP, "to_investor_id": validated_data.investor_id}, update)
                 if membership_bill:
-                    bill_model.update_one({"_id": membership_bill["_id"]}, {"$set": {"amount": 0}})
+                    invalidate_documents(bill_model, [membership_bill["_id"]])
+                    record_bill_updated(membership_bill, updated_document(membership_bill, update))
+                    bump_generation(bill_model)
             return JsonResponse({'id': str(result.inserted_id)}, status=status.HTTP_201_CREATED)
         except Exception as e:
             logger.error("Failed to validate investment data: %s", e)
@@ -220,6 +447,37 @@ def investment_list(request):
 @api_view(['GET', 'PUT', 'DELETE'])
 def investment_detail(request, pk):
     logger.info("investment_detail view called with method %s for entity id %s by user %s", request.method, pk, request.user)
+    if request.method == 'PUT':
+        try:
+            investment_data = validate_update(Investment, request.data)
+            if FEE_SCHEDULE_FIELDS & set(investment_data):
+                investment = investment_data
+                if not FEE_SCHEDULE_FIELDS <= set(investment_data):
+                    # The fields missing from the update are needed to recompute the fee schedule
+                    investment = get_document(investment_model, pk, {field: 1 for field in FEE_SCHEDULE_FIELDS})
+                    if not investment:
+                        logger.error("Investment with id %s does not exist, requested by user %s", pk, request.user)
+                        return JsonResponse({'message': 'The investment does not exist'}, status=status.HTTP_404_NOT_FOUND)
+                    investment = {**investment, **investment_data}
+                investment_data.update(fee_schedule_fields([investment], float(os.getenv("PERCENTAGE_FEE", 0.02)))[0])
+            update = stamped({"$set": investment_data})
+            investment = investment_model.find_one_and_update({"_id": ObjectId(pk)}, update)
+            forget_document(investment_model, pk)
+            updated_investment = investment and updated_document(investment, update)
+            if investment:
+                invalidate_documents(investment_model, [pk])
+                record_investment_updated(investment, updated_investment)
+                bump_generation(investment_model)
+        except Exception as e:
+            logger.warning("Investment update failed for id %s with errors: %s", pk, e)
+            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not updated_investment:
+            logger.error("Investment with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The investment does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        logger.info("Investment with id %s updated successfully by user %s", pk, request.user)
+        return BSONJsonResponse(updated_investment, status=status.HTTP_200_OK)
+    if request.method == 'GET':
+        return document_response(request, investment_model, pk, "investment")
     try:
         investment = investment_model.find_one({"_id": ObjectId(pk)})
         if not investment:
@@ -228,22 +486,13 @@ def investment_detail(request, pk):
     except Exception as e:
         logger.error("Error retrieving investment with id %s: %s", pk, e)
         return JsonResponse({'message': 'Error retrieving the investment'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    if request.method == 'GET':
-        logger.info("Returning investment data for id %s to user %s", pk, request.user)
-        return JsonResponse(parse_json(investment), safe=False)
-    elif request.method == 'PUT':
-        investment_data = JSONParser().parse(request)
-        try:
-            investment_model.update_one({"_id": ObjectId(pk)}, {"$set": investment_data})
-            updated_investment = investment_model.find_one({"_id": ObjectId(pk)})
-            logger.info("Investment with id %s updated successfully by user %s", pk, request.user)
-            return JsonResponse(parse_json(updated_investment), status=status.HTTP_200_OK, safe=False)
-        except Exception as e:
-            logger.warning("Investment update failed for id %s with errors: %s", pk, e)
-            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST, safe=False)
-    elif request.method == 'DELETE':
+    if request.method == 'DELETE':
         try:
             investment_model.delete_one({"_id": ObjectId(pk)})
+            invalidate_documents(investment_model, [pk])
+            record_deletion(investment_model, pk)
+            record_investment_deleted(investment)
+            bump_generation(investment_model)
             logger.info("Investment with id %s deleted successfully by user %s", pk, request.user)
             return JsonResponse({'message': 'Investment was deleted successfully!'}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
@@ -255,15 +504,24 @@ def investment_detail(request, pk):
 def entity_list(request):
     logger.info("entity_list view called with method %s by user %s", request.method, request.user)
     if request.method == 'GET':
-        entities = parse_json(entity_model.find())
+        try:
+            query = list_filter(entity_model, request.query_params)
+            projection = list_projection(entity_model, request.query_params)
+            if request.query_params.get("stream"):
+                logger.info("Streaming entities matching %s for user %s", query, request.user)
+                return streaming_response(entity_model, request.query_params["stream"], query, projection)
+            entities, next_cursor = paginate(entity_model, request.query_params, query, projection=projection)
+        except ValueError as e:
+            logger.error("Invalid query parameters: %s", e)
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         logger.info("Returning %d entities for user %s", len(entities), request.user)
-        return JsonResponse(entities, safe=False)
+        return paginated_response(request, entities, next_cursor)
     elif request.method == 'POST':
-        entity_data = JSONParser().parse(request)
-        logger.info("Received entity data: %s", entity_data)
+        entity_data = request.data
+        log_payload("Received entity data", entity_data)
         try:
             validated_data = Entity(**entity_data)
-            result = entity_model.insert_one(validated_data.model_dump())
+            result = entity_model.insert_one(stamp_new(validated_data.model_dump()))
             return JsonResponse({'id': str(result.inserted_id)}, status=status.HTTP_201_CREATED)
         except Exception as e:
             logger.error("Failed to validate entity data: %s", e)
@@ -272,6 +530,21 @@ def entity_list(request):
 @api_view(['GET', 'DELETE', 'PUT'])
 def entity_detail(request, pk):
     logger.info("entity_detail view called with method %s for entity id %s by user %s", request.method, pk, request.user)
+    if request.method == 'PUT':
+        try:
+            entity_data = validate_update(Entity, request.data, stored_bank_account(pk, request.data))
+            updated_entity = entity_model.find_one_and_update({"_id": ObjectId(pk)}, stamped({"$set": entity_data}), return_document=ReturnDocument.AFTER)
+            invalidate_documents(entity_model, [pk])
+        except Exception as e:
+            logger.warning("Entity update failed for id %s with errors: %s", pk, e)
+            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not updated_entity:
+            logger.error("Entity with id %s does not exist, requested by user %s", pk, request.user)
+            return JsonResponse({'message': 'The entity does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        logger.info("Entity with id %s updated successfully by user %s", pk, request.user)
+        return BSONJsonResponse(updated_entity, status=status.HTTP_200_OK)
+    if request.method == 'GET':
+        return document_response(request, entity_model, pk, "entity")
     try:
         entity = entity_model.find_one({"_id": ObjectId(pk)})
         if not entity:
@@ -280,24 +553,82 @@ def entity_detail(request, pk):
     except Exception as e:
         logger.error("Error retrieving entity with id %s: %s", pk, e)
         return JsonResponse({'message': 'Error retrieving the entity'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    if request.method == 'GET':
-        logger.info("Returning entity data for id %s to user %s", pk, request.user)
-        return JsonResponse(parse_json(entity), safe=False)
-    elif request.method == 'PUT':
-        entity_data = JSONParser().parse(request)
-        try:
-            entity_model.update_one({"_id": ObjectId(pk)}, {"$set": entity_data})
-            updated_entity = entity_model.find_one({"_id": ObjectId(pk)})
-            logger.info("Entity with id %s updated successfully by user %s", pk, request.user)
-            return JsonResponse(parse_json(updated_entity), status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.warning("Entity update failed for id %s with errors: %s", pk, e)
-            return JsonResponse({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    elif request.method == 'DELETE':
+    if request.method == 'DELETE':
         try:
             entity_model.delete_one({"_id": ObjectId(pk)})
+            invalidate_documents(entity_model, [pk])
+            record_deletion(entity_model, pk)
             logger.info("Entity with id %s deleted successfully by user %s", pk, request.user)
             return JsonResponse({'message': 'Entity was deleted successfully!'}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
             logger.error("Failed to delete entity with id %s: %s", pk, e)
             return JsonResponse({'message': 'Failed to delete the entity'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+def investment_fee_forecast(request):
+    logger.info("investment_fee_forecast view called with method %s by user %s", request.method, request.user)
+    bill_type = request.query_params.get("type", BillType.YEARLY_FEES)
+    if bill_type not in (BillType.UPFRONT_FEES, BillType.YEARLY_FEES):
+        return JsonResponse({'error': 'type must be upfront fees or yearly fees'}, status=status.HTTP_400_BAD_REQUEST)
+    query = {}
+    if request.query_params.get("fund_entity_id"):
+        query["fund_entity_id"] = request.query_params["fund_entity_id"]
+    percentage_fee = float(os.getenv("PERCENTAGE_FEE", 0.02))
+    investments = list(investment_model.find(query, {"amount": 1, "date": 1, "duration": 1, "fund_entity_id": 1}))
+    investments, invalid = split_valid_dates(investments)
+    if invalid:
+        logger.warning("Fee forecast skipped %d investments without a valid date: %s", len(invalid), ", ".join(str(investment["_id"]) for investment in invalid))
+    forecast = fee_forecast(investments, percentage_fee, bill_type)
+    logger.info("Computed %s forecast of %d investments for user %s", bill_type, len(investments), request.user)
+    return JsonResponse({
+        'type': bill_type,
+        'funds': [
+            {'fund_entity_id': fund_entity_id, 'years': {str(year): total for year, total in years.items()}, 'total': sum(years.values())}
+            for fund_entity_id, years in forecast.items()
+        ],
+        'skipped': [str(investment["_id"]) for investment in invalid],
+    })
+
+@api_view(['GET'])
+def report_bills(request):
+    logger.info("report_bills view called with method %s by user %s", request.method, request.user)
+    try:
+        query = list_filter(bill_model, request.query_params)
+    except ValueError as e:
+        logger.error("Invalid query parameters: %s", e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    report = cached_result("bill_report", query, [bill_model, capital_call_model], lambda: bill_report(query))
+    return BSONJsonResponse(report)
+
+@api_view(['GET'])
+def report_investments(request):
+    logger.info("report_investments view called with method %s by user %s", request.method, request.user)
+    try:
+        query = list_filter(investment_model, request.query_params)
+    except ValueError as e:
+        logger.error("Invalid query parameters: %s", e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    report = cached_result("investment_report", query, [investment_model], lambda: investment_report(query))
+    return BSONJsonResponse(report)
+
+CHANGES_COLLECTIONS = {
+    "bills": bill_model,
+    "capital_calls": capital_call_model,
+    "investments": investment_model,
+    "entities": entity_model,
+}
+
+@api_view(['GET'])
+def changes(request, collection):
+    logger.info("changes view called for %s with method %s by user %s", collection, request.method, request.user)
+    try:
+        limit = get_page_size(request.query_params.get("limit"))
+        changed, deleted, next_token, has_more = changes_since(CHANGES_COLLECTIONS[collection], request.query_params.get("since"), limit)
+    except ExpiredToken as e:
+        logger.warning("Expired changes token for %s: %s", collection, e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_410_GONE)
+    except ValueError as e:
+        logger.error("Invalid query parameters: %s", e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    logger.info("Returning %d changed and %d deleted %s for user %s", len(changed), len(deleted), collection, request.user)
+    return BSONJsonResponse({"changes": changed, "deleted": deleted, "next": next_token, "has_more": has_more})
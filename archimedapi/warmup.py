@@ -0,0 +1,30 @@
+import os
+import time
+
+from pymongo.errors import PyMongoError
+from redis import RedisError
+
+from db_connection import get_client
+from utils.currency_conversion import exchange_rate_provider
+from utils.logger import logger
+
+def warm_up():
+    """Open the MongoDB connection pool and load the exchange rates of the current process.
+
+    Meant to run once per worker right after it is forked (see archimedapi/celery.py and
+    gunicorn.conf.py), so that the first request does not pay for it. Failures are only
+    logged: connections are opened again on first use anyway.
+    """
+    start = time.perf_counter()
+    try:
+        get_client().admin.command("ping")
+    except PyMongoError as e:
+        logger.warning("MongoDB warm-up failed: %s", e)
+    try:
+        exchange_rate_provider.rates()
+    except (RedisError, TypeError, ValueError, KeyError) as e:
+        logger.warning("Exchange rates warm-up failed: %s", e)
+    logger.info("Worker %s warmed up in %.3fs", os.getpid(), time.perf_counter() - start)
+
+def warm_up_enabled():
+    return os.getenv("WARM_UP_WORKERS", "false").lower() in ("1", "true", "yes")
@@ -0,0 +1,467 @@
+"""Time every route of archimedapi/urls.py, compute_bill_amount and mark_overdue_invoices on seeded data.
+
+Entities, investments, capital calls and bills are seeded in bulk, then each case is run --repeat
+times through the Django test client. For each case, the latency and the MongoDB commands and
+Redis calls per call are reported. Redis is always replaced by fakeredis. MongoDB is replaced by
+mongomock (`--backend mongomock`, the default), or is a throwaway mongod given by --mongodb-url
+(`--backend mongod`). With mongomock, round trips are exact but latencies are those of a Python
+stand-in without indexes, and the async routes, which need a real server, are skipped. The results are written as JSON to --output, and compared with the
+results of a previous run given as --baseline.
+
+Requires mongomock and fakeredis (pip install mongomock fakeredis).
+
+Usage: python -m benchmarks.endpoints [--scale 0.01] [--repeat 5] [--backend mongod --mongodb-url URL]
+       [--output endpoints.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from datetime import date, timedelta
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archimedapi.settings")
+# Errors are reported in the results, the INFO lines of every request would drown them
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+VOLUMES = {"entities": 10_000, "investments": 100_000, "bills": 500_000, "capital_calls": 1_000}
+RATES = {"GBP": 0.792519, "EUR": 0.9, "USD": 1}
+SEED_BATCH_SIZE = 10_000
+FUNDS_RATIO = 0.05
+
+# Command names of the mongomock collection methods, as pymongo would report them
+MONGOMOCK_COMMANDS = {
+    "find": "find", "find_one": "find", "insert_one": "insert", "insert_many": "insert", "update_one": "update",
+    "update_many": "update", "replace_one": "update", "bulk_write": "update", "delete_one": "delete",
+    "delete_many": "delete", "find_one_and_update": "findAndModify", "find_one_and_delete": "findAndModify",
+    "aggregate": "aggregate", "count_documents": "aggregate", "distinct": "distinct",
+}
+
+def use_mongomock():
+    """Serve db_connection from mongomock, publishing a command event per collection call like pymongo."""
+    import mongomock
+    import db_connection
+    from utils.identity_map import RoundTripListener
+    from utils.metrics import CommandTimingListener
+
+    state = threading.local()
+
+    def publish(method, command):
+        def wrapper(self, *args, **kwargs):
+            # mongomock implements some methods with others, only the outermost call is a command
+            outermost = getattr(state, "depth", 0) == 0
+            state.depth = getattr(state, "depth", 0) + 1
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                state.depth -= 1
+                if outermost:
+                    event = types.SimpleNamespace(command_name=command, duration_micros=int((time.perf_counter() - start) * 1e6))
+                    for listener in self.database.client.event_listeners:
+                        listener.started(event)
+                        listener.succeeded(event)
+        return wrapper
+
+    for name, command in MONGOMOCK_COMMANDS.items():
+        setattr(mongomock.Collection, name, publish(getattr(mongomock.Collection, name), command))
+
+    # pymongo 4.11+ passes the sort of update and replace operations, which mongomock does not know about
+    def without_sort(method):
+        def wrapper(self, *args, sort=None, **kwargs):
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    builder = mongomock.collection.BulkOperationBuilder
+    builder.add_update = without_sort(builder.add_update)
+    builder.add_replace = without_sort(builder.add_replace)
+
+    class MongomockClient(mongomock.MongoClient):
+        def __init__(self, *args, event_listeners=(), **kwargs):
+            super().__init__(*args, **kwargs)
+            self.event_listeners = list(event_listeners)
+
+    db_connection._client = MongomockClient(event_listeners=[RoundTripListener(), CommandTimingListener()])
+
+def use_fakeredis():
+    import fakeredis
+    import db_connection
+    from utils.currency_conversion import exchange_rate_provider
+    from utils.metrics import InstrumentedRedis
+
+    db_connection._redis_client = InstrumentedRedis(connection_pool=fakeredis.FakeRedis(decode_responses=True).connection_pool)
+    exchange_rate_provider.load_rates = lambda: RATES
+    exchange_rate_provider.channel = None
+
+def seed(volumes):
+    """Insert the documents in bulk, bypassing the views, and return the ids the cases need."""
+    from bson import ObjectId
+    from archimedapi.models import bill_model, capital_call_model, entity_model, investment_model
+    from utils.investor_summary import rebuild_investor_summaries
+    from utils.versioning import now
+
+    stamp = {"_version": 1, "updated_at": now()}
+    today = date.today()
+    funds_count = max(1, int(volumes["entities"] * FUNDS_RATIO))
+    entities = [
+        {
+            "type": "fund" if i < funds_count else "investor",
+            "name": f"Entity {i}",
+            "address": f"{i} Benchmark Street",
+            "bank_account_number": "GB82WEST12345698765432",
+            "bank_account_type": "iban",
+            "bank_account_currency": random.choice(["GBP", "EUR", "USD"]),
+            "contact_person": f"Contact {i}",
+            "contact_person_email": f"contact{i}@example.com",
+            "contact_person_phone": "+1234567890",
+            **stamp,
+        }
+        for i in range(volumes["entities"])
+    ]
+    entity_ids = insert(entity_model, entities)
+    fund_ids, investor_ids = [str(i) for i in entity_ids[:funds_count]], [str(i) for i in entity_ids[funds_count:]]
+
+    investments = [
+        {
+            "amount": round(random.uniform(10_000, 200_000), 2),
+            "investor_id": investor_ids[i % len(investor_ids)],
+            "fund_entity_id": random.choice(fund_ids),
+            "duration": random.randint(1, 10),
+            "date": (today - timedelta(days=random.randint(0, 3650))).isoformat(),
+            **stamp,
+        }
+        for i in range(volumes["investments"])
+    ]
+    investment_ids = insert(investment_model, investments)
+    investment_by_investor = {}
+    for investment, investment_id in zip(investments, investment_ids):
+        investment_by_investor.setdefault(investment["investor_id"], str(investment_id))
+
+    capital_calls = [
+        {
+            "fund_entity_id": random.choice(fund_ids),
+            "investor_entities": random.sample(investor_ids, min(10, len(investor_ids))),
+            "purpose": f"Capital call {i}",
+            "date": today.isoformat(),
+            "status": "validated",
+            "currency": "USD",
+            "payment_method": "bank_transfer",
+            "due_date": (today + timedelta(days=30)).isoformat(),
+            "bills": [],
+            **stamp,
+        }
+        for i in range(volumes["capital_calls"])
+    ]
+    capital_call_ids = insert(capital_call_model, capital_calls)
+
+    # One membership bill per investor, then yearly fees bills, unique per (investor, year)
+    bills = []
+    for i in range(volumes["bills"]):
+        investor_id = investor_ids[i % len(investor_ids)]
+        year = i // len(investor_ids)
+        bills.append({
+            "type": "yearly fees" if year else "membership",
+            "capital_call_id": str(capital_call_ids[i % len(capital_call_ids)]),
+            "to_investor_id": investor_id,
+            "investment_id": investment_by_investor.get(investor_id) if year else None,
+            "fees_year": year,
+            "currency": "GBP",
+            "amount": round(random.uniform(100, 5_000), 2),
+            "status": random.choice(["created", "validated", "pending", "paid", "overdue"]),
+            "date": today.isoformat(),
+            "due_date": (today + timedelta(days=random.randint(-60, 60))).isoformat(),
+            **stamp,
+        })
+    bill_ids = insert(bill_model, bills)
+    # Capital calls reference the first bills only, to keep the expanded responses small
+    bills_by_capital_call = {}
+    for bill_id, bill in zip(bill_ids[:1000], bills[:1000]):
+        bills_by_capital_call.setdefault(bill["capital_call_id"], []).append(bill_id)
+    for capital_call_id, capital_call_bills in bills_by_capital_call.items():
+        capital_call_model.update_one({"_id": ObjectId(capital_call_id)}, {"$set": {"bills": capital_call_bills}})
+    rebuild_investor_summaries()
+    investor_id = next(iter(investment_by_investor))
+    return {
+        "fund_id": fund_ids[0],
+        "investor_id": investor_id,
+        "investment_id": investment_by_investor[investor_id],
+        "capital_call_id": str(capital_call_ids[0]),
+        "bill_id": str(bill_ids[0]),
+        "investment_by_investor": investment_by_investor,
+    }
+
+def insert(collection, documents):
+    ids = []
+    for start in range(0, len(documents), SEED_BATCH_SIZE):
+        ids.extend(collection.insert_many(documents[start:start + SEED_BATCH_SIZE], ordered=False).inserted_ids)
+    return ids
+
+def cases(ids):
+    """Benchmark cases as (name, url name, builder). A builder does the untimed setup of iteration i
+    and returns the method, the URL kwargs, the query string or JSON body and the headers of the request."""
+    from archimedapi.models import bill_model, capital_call_model, entity_model, investment_model
+    from utils.cache import bump_generation
+    from utils.fee_engine import fee_schedule_fields
+    from utils.versioning import stamp_new
+
+    investor_id, investment_id, capital_call_id, bill_id = ids["investor_id"], ids["investment_id"], ids["capital_call_id"], ids["bill_id"]
+    entity = {
+        "type": "investor", "name": "Benchmark Investor", "address": "1 Benchmark Street", "bank_account_number": "GB82WEST12345698765432",
+        "bank_account_type": "iban", "bank_account_currency": "GBP", "contact_person": "Jane Doe",
+        "contact_person_email": "jane@example.com", "contact_person_phone": "+1234567890",
+    }
+    capital_call = {
+        "fund_entity_id": ids["fund_id"], "investor_entities": [investor_id], "purpose": "Benchmark", "date": date.today().isoformat(),
+        "status": "validated", "currency": "USD", "payment_method": "bank_transfer", "due_date": (date.today() + timedelta(days=30)).isoformat(), "bills": [],
+    }
+    investment = {"amount": 45_000.0, "investor_id": investor_id, "duration": 3, "date": "2022-06-01"}
+    bill = {"type": "membership", "capital_call_id": capital_call_id, "to_investor_id": investor_id, "currency": "GBP", "amount": 3000.0}
+
+    def throwaway(collection, document):
+        return str(collection.insert_one(stamp_new(dict(document))).inserted_id)
+
+    def fresh_investor():
+        # Yearly fees bills are unique per investor and year, and the seeded investors already have
+        # bills for the first years, so each yearly fees case bills an investor without any
+        pk = throwaway(entity_model, entity)
+        document = {**investment, "investor_id": pk}
+        document.update(fee_schedule_fields([document], float(os.getenv("PERCENTAGE_FEE", 0.02)))[0])
+        return pk, throwaway(investment_model, document)
+
+    def fees_year(i):
+        # Within the schedule of the investment, past its end the fee is 0 and an error is logged
+        return 1 + i % investment["duration"]
+
+    def capital_call_with_investors():
+        investments = dict(fresh_investor() for _ in range(10))
+        pk = throwaway(capital_call_model, {**capital_call, "investor_entities": list(investments)})
+        return pk, investments
+
+    def uncached(i):
+        bump_generation(bill_model, investment_model)
+        return "GET", {}, {}, {}
+
+    yield "index", "index", lambda i: ("GET", {}, {}, {})
+    yield "metrics", "metrics", lambda i: ("GET", {}, {}, {})
+    for prefix, collection, document, update in (
+        ("entity", entity_model, entity, {"name": "Renamed"}),
+        ("investment", investment_model, investment, {"duration": 4}),
+        ("capital-call", capital_call_model, capital_call, {"purpose": "Renamed"}),
+        ("bill", bill_model, bill, {"status": "paid"}),
+    ):
+        if prefix != "bill":
+            yield f"{prefix}-list POST", f"{prefix}-list", lambda i, document=document: ("POST", {}, document, {})
+        yield f"{prefix}-list GET", f"{prefix}-list", lambda i: ("GET", {}, {"limit": 100}, {})
+        yield f"{prefix}-changes GET", f"{prefix}-changes", lambda i: ("GET", {}, {"limit": 100}, {})
+        yield f"{prefix}-detail PUT", f"{prefix}-detail", lambda i, collection=collection, document=document, update=update: (
+            "PUT", {"pk": throwaway(collection, document)}, update, {})
+        yield f"{prefix}-detail DELETE", f"{prefix}-detail", lambda i, collection=collection, document=document: (
+            "DELETE", {"pk": throwaway(collection, document)}, {}, {})
+    yield "entity-list GET filtered", "entity-list", lambda i: ("GET", {}, {"type": "fund", "fields": "name,type"}, {})
+    yield "entity-detail GET", "entity-detail", lambda i: ("GET", {"pk": investor_id}, {}, {})
+    yield "entity-detail GET 304", "entity-detail", lambda i: ("GET", {"pk": investor_id}, {}, {"HTTP_IF_NONE_MATCH": '"1"'})
+    yield "investment-list GET filtered", "investment-list", lambda i: ("GET", {}, {"investor_id": investor_id}, {})
+    yield "investment-detail GET", "investment-detail", lambda i: ("GET", {"pk": investment_id}, {}, {})
+    yield "investment-fee-forecast GET", "investment-fee-forecast", lambda i: ("GET", {}, {"fund_entity_id": ids["fund_id"]}, {})
+    yield "capital-call-list GET expanded", "capital-call-list", lambda i: ("GET", {}, {"limit": 20, "expand": "bills,investors,fund"}, {})
+    yield "capital-call-detail GET", "capital-call-detail", lambda i: ("GET", {"pk": capital_call_id}, {}, {})
+    yield "capital-call-detail GET expanded", "capital-call-detail", lambda i: ("GET", {"pk": capital_call_id}, {"expand": "bills,investors,fund"}, {})
+    yield "capital-call-bills POST", "capital-call-bills", lambda i: (
+        lambda pk, investments: ("POST", {"pk": pk}, {"type": "yearly fees", "fees_year": fees_year(i), "investments": investments}, {})
+    )(*capital_call_with_investors())
+    yield "bill-list GET filtered", "bill-list", lambda i: ("GET", {}, {"status": "pending,overdue", "due_date_from": date.today().isoformat(), "limit": 100}, {})
+    yield "bill-list GET stream", "bill-list", lambda i: ("GET", {}, {"to_investor_id": investor_id, "stream": "ndjson"}, {})
+    yield "bill-list POST", "bill-list", lambda i: (lambda investor, investment_pk: (
+        "POST", {}, {**bill, "to_investor_id": investor, "type": "yearly fees", "fees_year": fees_year(i), "investment_id": investment_pk}, {})
+    )(*fresh_investor())
+    yield "bill-detail GET", "bill-detail", lambda i: ("GET", {"pk": bill_id}, {}, {})
+    yield "bill-investor POST", "bill-investor", lambda i: (lambda investor, investment_pk: ("POST", {}, {
+        "type": "yearly fees", "to_investor_id": investor, "fees_year": fees_year(i), "capital_call_id": capital_call_id, "investment_id": investment_pk, "currency": "GBP",
+    }, {}))(*fresh_investor())
+    yield "report-bills GET", "report-bills", uncached
+    yield "report-bills GET cached", "report-bills", lambda i: ("GET", {}, {}, {})
+    yield "report-investments GET", "report-investments", uncached
+    yield "report-investments GET cached", "report-investments", lambda i: ("GET", {}, {}, {})
+    for prefix in ("entity", "investment", "capital-call", "bill"):
+        yield f"async-{prefix}-list GET", f"async-{prefix}-list", lambda i: ("GET", {}, {"limit": 100}, {})
+    yield "async-entity-detail GET", "async-entity-detail", lambda i: ("GET", {"pk": investor_id}, {}, {})
+    yield "async-investment-detail GET", "async-investment-detail", lambda i: ("GET", {"pk": investment_id}, {}, {})
+    yield "async-capital-call-detail GET", "async-capital-call-detail", lambda i: ("GET", {"pk": capital_call_id}, {}, {})
+    yield "async-bill-detail GET", "async-bill-detail", lambda i: ("GET", {"pk": bill_id}, {}, {})
+    yield "async-bill-investor POST", "async-bill-investor", lambda i: (lambda investor, investment_pk: ("POST", {}, {
+        "type": "yearly fees", "to_investor_id": investor, "fees_year": fees_year(i), "capital_call_id": capital_call_id, "investment_id": investment_pk, "currency": "GBP",
+    }, {}))(*fresh_investor())
+
+def server_timing(response):
+    """Redis calls of the request, from its Server-Timing header."""
+    for metric in response.get("Server-Timing", "").split(","):
+        name, *params = metric.strip().split(";")
+        if name == "redis":
+            desc = next((param for param in params if param.startswith("desc=")), 'desc="0 calls"')
+            return int(desc.split('"')[1].split()[0])
+    return 0
+
+def summarize(durations, round_trips, calls):
+    durations = sorted(durations)
+    return {
+        "calls": calls,
+        "median_ms": statistics.median(durations) * 1000,
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+        "min_ms": durations[0] * 1000,
+        "round_trips": {command: count / calls for command, count in sorted(round_trips.items())},
+    }
+
+def run_case(client, url_name, build, repeat):
+    from collections import Counter
+    from django.urls import reverse
+
+    durations, round_trips, redis_calls, statuses = [], Counter(), 0, Counter()
+    for i in range(repeat):
+        method, kwargs, data, headers = build(i)
+        path = reverse(url_name, kwargs=kwargs)
+        start = time.perf_counter()
+        if method == "GET":
+            response = client.get(path, data, **headers)
+        else:
+            response = getattr(client, method.lower())(path, data=json.dumps(data), content_type="application/json", **headers)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        durations.append(time.perf_counter() - start)
+        statuses[response.status_code] += 1
+        identity_map = getattr(response.wsgi_request, "identity_map", None)
+        if identity_map is not None:
+            round_trips.update(identity_map.round_trips)
+        redis_calls += server_timing(response)
+    result = summarize(durations, round_trips, repeat)
+    result.update({"method": method, "path": path, "statuses": {str(code): count for code, count in statuses.items()}, "redis_calls": redis_calls / repeat})
+    return result
+
+def run_function(function, repeat):
+    from collections import Counter
+    from utils.identity_map import unit_of_work
+
+    durations, round_trips = [], Counter()
+    for _ in range(repeat):
+        with unit_of_work() as identity_map:
+            start = time.perf_counter()
+            value = function()
+            durations.append(time.perf_counter() - start)
+        round_trips.update(identity_map.round_trips)
+    result = summarize(durations, round_trips, repeat)
+    result["result"] = value
+    return result
+
+def compare(results, baseline):
+    print(f"\n{'case':<40} {'median':>10} {'baseline':>10} {'ratio':>7}  round trips")
+    for section in ("endpoints", "functions"):
+        for name, result in results[section].items():
+            before = baseline.get(section, {}).get(name)
+            if not before:
+                continue
+            ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+            trips = sum(result["round_trips"].values())
+            trips_before = sum(before["round_trips"].values())
+            flag = "" if trips == trips_before else f"  {trips_before:g} -> {trips:g}"
+            print(f"{name:<40} {result['median_ms']:8.2f}ms {before['median_ms']:8.2f}ms {ratio:6.2f}x{flag}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongomock", "mongod"], default="mongomock")
+    parser.add_argument("--mongodb-url", help="URL of a throwaway mongod, its archimed database is dropped at the end")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier of the default volumes")
+    for name, count in VOLUMES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, help=f"Number of {name.replace('_', ' ')} ({count} by default)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    volumes = {name: getattr(args, name) or max(1, int(count * args.scale)) for name, count in VOLUMES.items()}
+
+    if args.backend == "mongod":
+        if not args.mongodb_url:
+            parser.error("--backend mongod requires --mongodb-url")
+        os.environ["MONGODB_URL"] = args.mongodb_url
+
+    import django
+    django.setup()
+    logging.getLogger("django.request").setLevel(logging.CRITICAL)
+
+    from django.core.management import call_command
+    from django.test import Client
+    from django.urls import get_resolver
+    from archimedapi.models import BillType
+    from archimedapi.tasks import mark_overdue_invoices
+    from db_connection import get_db
+    from utils.bill_utils import compute_bill_amount
+
+    if args.backend == "mongomock":
+        use_mongomock()
+    else:
+        if any(get_db()[name].estimated_document_count() for name in get_db().list_collection_names()):
+            sys.exit(f"The archimed database of {args.mongodb_url} is not empty, use a throwaway mongod")
+        call_command("ensure_indexes", "--skip-usage", stdout=open(os.devnull, "w"))
+    use_fakeredis()
+
+    try:
+        start = time.perf_counter()
+        ids = seed(volumes)
+        print(f"Seeded {volumes} in {time.perf_counter() - start:.1f}s")
+
+        client = Client(SERVER_NAME="localhost")
+        results = {"backend": args.backend, "volumes": volumes, "repeat": args.repeat, "endpoints": {}, "functions": {}}
+        try:
+            results["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            results["commit"] = None
+        covered = set()
+        for name, url_name, build in cases(ids):
+            covered.add(url_name)
+            if args.backend == "mongomock" and url_name.startswith("async-"):
+                # get_async_client connects to MONGODB_URL, mongomock has no async client
+                results["endpoints"][name] = {"error": "skipped, requires --backend mongod"}
+                continue
+            try:
+                result = run_case(client, url_name, build, args.repeat)
+            except Exception as e:
+                results["endpoints"][name] = {"error": f"{type(e).__name__}: {e}"}
+                print(f"{name:<40} failed: {type(e).__name__}: {e}")
+                continue
+            results["endpoints"][name] = result
+            print(f"{name:<40} {result['median_ms']:8.2f} ms median {result['p95_ms']:8.2f} ms p95  {result['round_trips']} redis {result['redis_calls']:g}  {result['statuses']}")
+        missing = sorted(pattern.name for pattern in get_resolver().url_patterns if getattr(pattern, "name", None) and pattern.name not in covered)
+        if missing:
+            print(f"Routes without a benchmark case: {', '.join(missing)}")
+
+        fee = float(os.getenv("PERCENTAGE_FEE", 0.02))
+        functions = {
+            "compute_bill_amount membership": lambda: compute_bill_amount(BillType.MEMBERSHIP, fee, ids["investor_id"]),
+            "compute_bill_amount yearly fees": lambda: compute_bill_amount(BillType.YEARLY_FEES, fee, ids["investor_id"], ids["investment_id"], 1),
+        }
+        for name, function in functions.items():
+            results["functions"][name] = result = run_function(function, args.repeat)
+            print(f"{name:<40} {result['median_ms']:8.2f} ms median  {result['round_trips']}")
+        # Only the first run has bills to flip, the next ones measure the empty scan
+        for name in ("mark_overdue_invoices", "mark_overdue_invoices again"):
+            results["functions"][name] = result = run_function(mark_overdue_invoices, 1)
+            print(f"{name:<40} {result['median_ms']:8.2f} ms  modified {result['result']['modified']}  {result['round_trips']}")
+    finally:
+        if args.backend == "mongod":
+            get_db().client.drop_database(get_db().name)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
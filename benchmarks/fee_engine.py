@@ -0,0 +1,59 @@
+"""Compare the scalar compute_investment_fee with the vectorised fee engine.
+
+Usage: python -m benchmarks.fee_engine [--investments N]
+"""
+import argparse
+import os
+import random
+import time
+from datetime import date
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archimedapi.settings")
+
+import django
+
+django.setup()
+
+from archimedapi.models import BillType
+from utils.bill_utils import compute_investment_fee
+from utils.fee_engine import fee_forecast, to_arrays, yearly_fee_schedules
+
+def make_investments(count):
+    return [
+        {
+            "amount": random.uniform(10000, 200000),
+            "date": date(random.randint(2015, 2025), random.randint(1, 12), random.randint(1, 28)).isoformat(),
+            "duration": random.randint(1, 10),
+            "fund_entity_id": f"fund-{random.randint(1, 20)}",
+        }
+        for _ in range(count)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--investments", type=int, default=100_000)
+    args = parser.parse_args()
+    investments = make_investments(args.investments)
+
+    start = time.perf_counter()
+    for investment in investments:
+        for year in range(1, investment["duration"] + 1):
+            compute_investment_fee(BillType.YEARLY_FEES, 0.02, investment, year)
+    scalar = time.perf_counter() - start
+
+    arrays = to_arrays(investments)
+    start = time.perf_counter()
+    yearly_fee_schedules(*arrays, 0.02)
+    vectorised = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fee_forecast(investments, 0.02)
+    forecast = time.perf_counter() - start
+
+    print(f"{args.investments} investments")
+    print(f"scalar schedules:     {scalar * 1000:>10.1f} ms")
+    print(f"vectorised schedules: {vectorised * 1000:>10.1f} ms")
+    print(f"forecast (with array conversion): {forecast * 1000:>10.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compare the old parse_json + JsonResponse serialisation with utils.json_codec.
+
+Usage: python -m benchmarks.json_codec [--repeat N]
+"""
+import argparse
+import datetime
+import json
+import random
+import time
+
+from bson import Decimal128, ObjectId, json_util
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.http import JsonResponse
+
+from utils.json_codec import BSONJsonResponse
+
+def make_bills(count):
+    today = datetime.datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "type": random.choice(["membership", "upfront fees", "yearly fees"]),
+            "capital_call_id": str(ObjectId()),
+            "to_investor_id": str(ObjectId()),
+            "investment_id": ObjectId(),
+            "currency": "GBP",
+            "amount": random.random() * 10000,
+            "vat": Decimal128("0.20"),
+            "status": "created",
+            "date": today,
+            "due_date": today + datetime.timedelta(days=30),
+            "fees_year": random.randint(1, 5),
+        }
+        for _ in range(count)
+    ]
+
+def parse_json_response(documents):
+    return JsonResponse(json.loads(json_util.dumps(documents)), safe=False)
+
+def codec_response(documents):
+    return BSONJsonResponse(documents)
+
+def best_of(func, documents, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(documents)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'documents':>10} {'parse_json (ms)':>16} {'json_codec (ms)':>16} {'speedup':>8}")
+    for count in (1_000, 100_000):
+        documents = make_bills(count)
+        assert json.loads(parse_json_response(documents).content) == json.loads(codec_response(documents).content)
+        old = best_of(parse_json_response, documents, args.repeat)
+        new = best_of(codec_response, documents, args.repeat)
+        print(f"{count:>10} {old * 1000:>16.1f} {new * 1000:>16.1f} {old / new:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Load test running deployments side by side: latency percentiles and throughput at a given concurrency.
+
+Each target is hit by --concurrency clients, each with its own keep-alive connection sending one
+request after the other, for --duration seconds. To compare the WSGI and ASGI deployments:
+
+    gunicorn -c gunicorn.conf.py --workers 4 --bind :8000 archimedapi.wsgi
+    uvicorn archimedapi.asgi:application --workers 4 --port 8001
+    python -m benchmarks.load --target wsgi=http://localhost:8000/entities/ --target asgi=http://localhost:8001/async/entities/
+
+Usage: python -m benchmarks.load --target NAME=URL [--target ...] [--concurrency 200] [--duration 30] [--output load.json]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by the server")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(status_line.split()[1]), headers.get("connection", "").lower() != "close"
+
+async def client(url, deadline, latencies, errors):
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    request = f"GET {path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\nAccept: application/json\r\n\r\n".encode()
+    connection = None
+    while time.perf_counter() < deadline:
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            reader, writer = connection
+            start = time.perf_counter()
+            writer.write(request)
+            status, keep_alive = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            if not keep_alive:
+                writer.close()
+                connection = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+async def run(url, concurrency, duration):
+    latencies, errors = [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*(client(url, start + duration, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        return {"url": url, "requests": 0, "errors": errors}
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "url": url,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "p50": percentiles[49],
+        "p99": percentiles[98],
+        "max": max(latencies),
+        "errors": errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", action="append", required=True, help="NAME=URL, may be repeated")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = {}
+    for target in args.target:
+        name, _, url = target.partition("=")
+        results[name] = result = asyncio.run(run(url, args.concurrency, args.duration))
+        if not result["requests"]:
+            print(f"{name:>10}: no successful request, errors {result['errors']}")
+            continue
+        print(
+            f"{name:>10}: {result['requests_per_second']:8.1f} req/s, p50 {result['p50'] * 1000:7.1f} ms, "
+            f"p99 {result['p99'] * 1000:7.1f} ms, max {result['max'] * 1000:7.1f} ms, errors {result['errors'] or 0}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "duration": args.duration, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measure the cold start of a worker: import time of the Django app and latency of its first requests.
+
+Each run happens in a fresh interpreter, against the MongoDB and Redis configured in the environment.
+
+Usage: python -m benchmarks.startup [--runs N] [--path /entities/?limit=1] [--output startup.json]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "archimedapi.settings")
+import django
+django.setup()
+import archimedapi.urls
+import archimedapi.tasks
+result = {"import": time.perf_counter() - start}
+from django.test import Client
+client = Client(SERVER_NAME="localhost")
+for name in ("first_request", "second_request"):
+    start = time.perf_counter()
+    try:
+        status = client.get(sys.argv[1]).status_code
+    except Exception as e:
+        status = type(e).__name__
+    result[name] = time.perf_counter() - start
+    result[name + "_status"] = status
+print(json.dumps(result))
+"""
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/entities/?limit=1")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, "-c", CHILD, args.path], capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    summary = {
+        name: {"median": statistics.median(run[name] for run in runs), "max": max(run[name] for run in runs)}
+        for name in ("import", "first_request", "second_request")
+    }
+    summary["statuses"] = sorted({str(run["first_request_status"]) for run in runs})
+    for name in ("import", "first_request", "second_request"):
+        print(f"{name:>15}: median {summary[name]['median'] * 1000:8.1f} ms, max {summary[name]['max'] * 1000:8.1f} ms")
+    print(f"first request statuses: {', '.join(summary['statuses'])}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"runs": runs, "summary": summary}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
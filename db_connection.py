@@ -1,9 +1,129 @@
-import pymongo
+import asyncio
 import os
+import threading
+import pymongo
 from dotenv import load_dotenv
+from utils.identity_map import RoundTripListener
+from utils.logger import logger
+from utils.metrics import CommandTimingListener, InstrumentedRedis
+from utils.query_plan import AsyncGuardedCollection, guard, guard_enabled
 
 load_dotenv()
 
-url = os.environ.get('MONGODB_URL')
-client = pymongo.MongoClient(url)
-db = client['archimed']
\ No newline at end of file
+# Connections are opened on first use rather than at import time, so that importing the
+# views, the Celery tasks or running manage.py does not wait on MongoDB or Redis, and so
+# that each forked worker opens its own connection pool.
+_client = None
+_async_client = None
+_redis_client = None
+_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = pymongo.MongoClient(os.environ.get('MONGODB_URL'), event_listeners=[RoundTripListener(), CommandTimingListener()])
+    return _client
+
+def get_db():
+    return get_client()['archimed']
+
+def get_async_client():
+    """Client of the async views, bound to the running event loop.
+
+    An AsyncMongoClient can only be used from the event loop it was first used on. Under ASGI there
+    is a single loop per process, when views are run on a loop of their own (WSGI, tests) the
+    client is replaced whenever the loop changes, and the replaced one is closed.
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop:
+        if _async_client is not None:
+            _close_async_client(loop, _async_client[1])
+        _async_client = (loop, pymongo.AsyncMongoClient(os.environ.get('MONGODB_URL'), event_listeners=[RoundTripListener(), CommandTimingListener()]))
+    return _async_client[1]
+
+_closing = set()
+
+def _close_async_client(loop, client):
+    # The loop of the replaced client is usually gone, its monitors and connections are closed from this one
+    async def close():
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning("Failed to close the replaced async MongoDB client: %s", e)
+
+    task = loop.create_task(close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+def get_async_collection(collection):
+    """Async counterpart of one of the collections of archimedapi.models."""
+    async_collection = get_async_client()['archimed'][collection.name]
+    if guard_enabled():
+        # QUERY_PLAN_GUARD explains the queries before running them
+        return AsyncGuardedCollection(async_collection)
+    return async_collection
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        with _lock:
+            if _redis_client is None:
+                _redis_client = InstrumentedRedis(
+                    host=os.getenv('REDIS_HOST'),
+                    port=os.getenv('REDIS_PORT'),
+                    password=os.getenv('REDIS_PASSWORD'),
+                    decode_responses=True)
+    return _redis_client
+
+def _reset_after_fork():
+    # Connection pools inherited from the parent process must not be shared with it
+    global _client, _async_client, _redis_client, _lock
+    _client = None
+    _async_client = None
+    _redis_client = None
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+class LazyCollection:
+    """Stand-in for a pymongo collection that resolves it on first use.
+
+    The collection is resolved once per client, so again in a forked process, whose client is
+    reset by _reset_after_fork.
+    """
+
+    _resolved = (None, None)
+
+    def __init__(self, name):
+        self.name = name
+
+    def _collection(self):
+        client, collection = self._resolved
+        if client is None or client is not _client:
+            client = get_client()
+            collection = client['archimed'][self.name]
+            self._resolved = (client, collection)
+        return collection
+
+    def __getattr__(self, attr):
+        collection = self._collection()
+        value = getattr(collection, attr)
+        if guard_enabled():
+            # QUERY_PLAN_GUARD explains the queries before running them
+            return guard(collection, attr, value)
+        return value
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r})"
+
+class LazyDatabase:
+    def __getitem__(self, name):
+        return LazyCollection(name)
+
+    def __getattr__(self, attr):
+        return getattr(get_db(), attr)
+
+db = LazyDatabase()
@@ -0,0 +1,10 @@
+# gunicorn -c gunicorn.conf.py archimedapi.wsgi
+from archimedapi.warmup import warm_up, warm_up_enabled
+from utils.metrics import mark_process_dead
+
+def post_fork(server, worker):
+    if warm_up_enabled():
+        warm_up()
+
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
@@ -1,79 +1,207 @@
+from collections import defaultdict
 from django.http import JsonResponse
-from archimedapi.models import BillType
+from archimedapi.models import BillModel, BillType
 from rest_framework import status
 from datetime import date
 from bson import ObjectId
-from archimedapi.models import entity_model, investment_model
+from archimedapi.models import bill_model, entity_model, investment_model, investor_summary_model, find_by_ids, EntityType
+from utils.currency_conversion import convert_many, get_exchange_rate
+from utils.identity_map import get_document
 from utils.logger import logger
 from utils.general import days_in_year
 
-def check_existing_bill(bill_model, bill_type, investor_id, year):   
+# Bill types an existing bill of the investor can conflict with
+CONFLICTING_BILL_TYPES = {
+    BillType.MEMBERSHIP: [BillType.MEMBERSHIP],
+    BillType.UPFRONT_FEES: [BillType.YEARLY_FEES, BillType.UPFRONT_FEES],
+    BillType.YEARLY_FEES: [BillType.UPFRONT_FEES, BillType.YEARLY_FEES],
+}
+
+def existing_bill_error(existing_bills, bill_type, investor_id, year):
+    """Return why a bill cannot be created given the investor's existing bills, or None if it can."""
+    existing_types = {bill["type"] for bill in existing_bills}
     if bill_type == BillType.MEMBERSHIP:
-        existing_bill = bill_model.find_one({"type": bill_type, "to_investor_id": investor_id})
-        if existing_bill:
-            return JsonResponse({'error': f"{bill_type} bill already exists for investor {investor_id}"}, status=status.HTTP_400_BAD_REQUEST)
+        if BillType.MEMBERSHIP in existing_types:
+            return f"{bill_type} bill already exists for investor {investor_id}"
     else:
         if bill_type == BillType.UPFRONT_FEES:
-            if bill_model.find_one({"type": BillType.YEARLY_FEES, "to_investor_id": investor_id}):
-                return JsonResponse({'error': f"Yearly fees bill already exists for investor {investor_id} hence cannot generate an upfront fees bill"}, status=status.HTTP_400_BAD_REQUEST)
+            if BillType.YEARLY_FEES in existing_types:
+                return f"Yearly fees bill already exists for investor {investor_id} hence cannot generate an upfront fees bill"
         elif bill_type == BillType.YEARLY_FEES:
-            if bill_model.find_one({"type": BillType.UPFRONT_FEES, "to_investor_id": investor_id}):
-                return JsonResponse({'error': f"Upfront fees bill already exists for investor {investor_id} hence cannot generate a yearly fees bill"}, status=status.HTTP_400_BAD_REQUEST)
+            if BillType.UPFRONT_FEES in existing_types:
+                return f"Upfront fees bill already exists for investor {investor_id} hence cannot generate a yearly fees bill"
 
         # Check for existing bill for the same type and year
-        if bill_model.find_one({"type": bill_type, "to_investor_id": investor_id, "fees_year": year}): 
-            return JsonResponse({'error': f"{bill_type} bill already exists for investor {investor_id} for year {year}"}, status=status.HTTP_400_BAD_REQUEST)
+        if any(bill["type"] == bill_type and bill.get("fees_year") == year for bill in existing_bills):
+            return f"{bill_type} bill already exists for investor {investor_id} for year {year}"
+    return None
+
+def duplicate_bill_error(bill_type, investor_id, year):
+    """Message of a bill rejected by one of the unique indexes of the bill collection."""
+    return existing_bill_error([{"type": bill_type, "fees_year": year}], bill_type, investor_id, year)
+
+# Duplicate bills are rejected by the unique indexes of the bill collection when inserted,
+# only the exclusivity between upfront and yearly fees bills has to be checked beforehand.
+EXCLUSIVE_BILL_TYPES = {
+    BillType.UPFRONT_FEES: BillType.YEARLY_FEES,
+    BillType.YEARLY_FEES: BillType.UPFRONT_FEES,
+}
+
+def check_existing_bill(bill_model, bill_type, investor_id, year):
+    exclusive_type = EXCLUSIVE_BILL_TYPES.get(bill_type)
+    if exclusive_type and bill_model.find_one({"to_investor_id": investor_id, "type": exclusive_type}, {"_id": 1}):
+        error = existing_bill_error([{"type": exclusive_type}], bill_type, investor_id, year)
+        return JsonResponse({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+async def acheck_existing_bill(bill_model, bill_type, investor_id, year):
+    """Same as check_existing_bill with an async collection."""
+    exclusive_type = EXCLUSIVE_BILL_TYPES.get(bill_type)
+    if exclusive_type and await bill_model.find_one({"to_investor_id": investor_id, "type": exclusive_type}, {"_id": 1}):
+        error = existing_bill_error([{"type": exclusive_type}], bill_type, investor_id, year)
+        return JsonResponse({'error': error}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def compute_membership_fee(investment_amounts):
+    if any(x > 50000 for x in investment_amounts):
+        return 0
+    return 3000
+
+def is_fee_schedule_current(investment, fee_percentage):
+    """Whether the fee schedule stored on the investment was computed this year with this fee percentage."""
+    return (
+        investment.get("fee_schedule") is not None
+        and investment.get("fee_schedule_year") == date.today().year
+        and investment.get("fee_schedule_percentage") == fee_percentage
+    )
+
+def compute_investment_fee(bill_type: BillType, fee_percentage, investment, year):
+    amount = investment.get("amount", 0)
+    if bill_type == BillType.UPFRONT_FEES:
+        return amount * fee_percentage * 5
+    elif bill_type == BillType.YEARLY_FEES:
+        if is_fee_schedule_current(investment, fee_percentage):
+            try:
+                return investment["fee_schedule"][year-1]
+            except IndexError:
+                logger.error("Year index %s out of range for the fee schedule of investment %s", year, investment.get("_id"))
+                return 0
+        investment_date = investment.get("date")
+        investment_date = date.fromisoformat(investment_date)
+        current_date = date.today()
+        end_of_year = date(current_date.year, 12, 31)
+        delta = end_of_year - investment_date
+        days_diff = delta.days
+        if investment_date.year <= 2019 and investment_date.month < 4:
+            amounts = [days_diff / 365 * fee_percentage * amount]
+            amounts.extend([fee_percentage * amount for _ in range(1, investment.get("duration", 1))])
+            try:
+                return amounts[year-1]
+            except IndexError:
+                logger.error("Year index %s out of range for amounts list", year)
+                return 0
+        if investment_date.year >= 2019 and investment_date.month >= 4: 
+            amounts = [
+                (days_diff / days_in_year()) * fee_percentage * amount, 
+                fee_percentage * amount, 
+                (fee_percentage - 0.002) * amount, 
+                (fee_percentage - 0.004) * amount
+            ]
+            amounts.extend([(fee_percentage - 0.01) * amount for _ in range(4, investment.get("duration", 1))])
+            try:
+                return amounts[year-1]
+            except IndexError:
+                logger.error("Year index %s out of range for amounts list", year)
+                return 0
+    return 0 
+
 def compute_bill_amount(bill_type: BillType, fee_percentage, investor_id, investment_id=None, year=None):
     if year:
         year = int(year)
         assert year >= 1, "Year must be a positive integer"
     if bill_type == BillType.MEMBERSHIP:
-        all_investments = [investment["amount"] for investment in entity_model.find({"investor_id": investor_id})]
-        if any(x > 50000 for x in all_investments):
-            return 0
-        else:
-            return 3000
+        summary = get_document(investor_summary_model, investor_id)
+        return compute_membership_fee([summary.get("investment_max", 0)] if summary else [])
     else:
         if not investment_id:
             logger.error("Investment ID is required for bill type %s", bill_type)
             return FileNotFoundError 
 
-        investment = investment_model.find_one({"_id": ObjectId(investment_id)})
+        investment = get_document(investment_model, investment_id)
         if not investment:
             logger.error("Investment with id %s not found", investment_id)
             return None
 
-        amount = investment.get("amount", 0)
-        if bill_type == BillType.UPFRONT_FEES:
-            return amount * fee_percentage * 5
-        elif bill_type == BillType.YEARLY_FEES:
-            investment_date = investment.get("date")
-            investment_date = date.fromisoformat(investment_date)
-            current_date = date.today()
-            end_of_year = date(current_date.year, 12, 31)
-            delta = end_of_year - investment_date
-            days_diff = delta.days
-            if investment_date.year <= 2019 and investment_date.month < 4:
-                amounts = [days_diff / 365 * fee_percentage * amount]
-                amounts.extend([fee_percentage * amount for _ in range(1, investment.get("duration", 1))])
-                try:
-                    return amounts[year-1]
-                except IndexError:
-                    logger.error("Year index %s out of range for amounts list", year)
-                    return 0
-            if investment_date.year >= 2019 and investment_date.month >= 4: 
-                amounts = [
-                    (days_diff / days_in_year()) * fee_percentage * amount, 
-                    fee_percentage * amount, 
-                    (fee_percentage - 0.002) * amount, 
-                    (fee_percentage - 0.004) * amount
-                ]
-                amounts.extend([(fee_percentage - 0.01) * amount for _ in range(4, investment.get("duration", 1))])
-                try:
-                    return amounts[year-1]
-                except IndexError:
-                    logger.error("Year index %s out of range for amounts list", year)
-                    return 0
-    return 0 
\ No newline at end of file
+        return compute_investment_fee(bill_type, fee_percentage, investment, year)
+
+def prepare_capital_call_bills(capital_call_id, bill_type, year, investor_ids, fee_percentage, investment_choices=None):
+    """Build the bills of all the investors of a capital call, reading each collection once.
+
+    Returns the bills that can be created and the reasons why the other investors cannot be billed,
+    both keyed by investor id. investment_choices maps investor ids to the investment to bill when
+    the investor has several investments.
+    """
+    investment_choices = investment_choices or {}
+    errors = {investor_id: f"Invalid investor id {investor_id}" for investor_id in investor_ids if not ObjectId.is_valid(investor_id)}
+    investor_ids = [investor_id for investor_id in investor_ids if investor_id not in errors]
+
+    investors = find_by_ids(entity_model, investor_ids, {"type": 1, "bank_account_currency": 1})
+    investments_by_investor = defaultdict(list)
+    if bill_type == BillType.MEMBERSHIP:
+        summaries = find_by_ids(investor_summary_model, investor_ids, {"investment_max": 1})
+    else:
+        for investment in investment_model.find({"investor_id": {"$in": investor_ids}}):
+            investments_by_investor[investment["investor_id"]].append(investment)
+    existing_bills_by_investor = defaultdict(list)
+    existing_bills = bill_model.find(
+        {"to_investor_id": {"$in": investor_ids}, "type": {"$in": CONFLICTING_BILL_TYPES[bill_type]}},
+        {"to_investor_id": 1, "type": 1, "fees_year": 1},
+    )
+    for bill in existing_bills:
+        existing_bills_by_investor[bill["to_investor_id"]].append(bill)
+
+    bills = {}
+    for investor_id in investor_ids:
+        investor = investors.get(ObjectId(investor_id))
+        if not investor or investor.get("type") != EntityType.INVESTOR:
+            errors[investor_id] = f"Entity with id {investor_id} is not an investor"
+            continue
+        error = existing_bill_error(existing_bills_by_investor[investor_id], bill_type, investor_id, year)
+        if error:
+            errors[investor_id] = error
+            continue
+        investments = investments_by_investor[investor_id]
+        investment = None
+        if bill_type == BillType.MEMBERSHIP:
+            summary = summaries.get(ObjectId(investor_id))
+            amount = compute_membership_fee([summary.get("investment_max", 0)] if summary else [])
+        else:
+            investment_id = investment_choices.get(investor_id)
+            if investment_id:
+                investment = next((investment for investment in investments if str(investment["_id"]) == investment_id), None)
+                if not investment:
+                    errors[investor_id] = f"Investment with id {investment_id} not found for investor {investor_id}"
+                    continue
+            elif len(investments) == 1:
+                investment = investments[0]
+            else:
+                errors[investor_id] = f"An investment id is required for investor {investor_id} who has {len(investments)} investments"
+                continue
+            amount = compute_investment_fee(bill_type, fee_percentage, investment, year)
+        currency = investor.get("bank_account_currency")
+        if currency != "USD" and not get_exchange_rate(currency):
+            errors[investor_id] = f"Exchange rate not available for {currency}."
+            continue
+        # The references were checked above in bulk, skip the per bill validators
+        bills[investor_id] = BillModel.model_construct(
+            type=BillType(bill_type),
+            capital_call_id=capital_call_id,
+            to_investor_id=investor_id,
+            currency=currency,
+            amount=amount,
+            investment_id=str(investment["_id"]) if investment else None,
+            fees_year=year,
+        )
+    converted_amounts = convert_many([bill.amount for bill in bills.values()], [bill.currency for bill in bills.values()])
+    for bill, amount in zip(bills.values(), converted_amounts):
+        bill.amount = amount
+    return bills, errors
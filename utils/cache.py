@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+import redis
+from bson import ObjectId
+from dotenv import load_dotenv
+
+from db_connection import get_redis
+from utils.json_codec import dumps, loads
+from utils.logger import logger
+
+load_dotenv()
+
+# Seconds a cached result is kept, bounds how stale it can get if a generation bump is lost
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 3600))
+
+# Cached results are invalidated by per-collection generation counters: every write to a
+# collection made by the views increments its counter, and a cached result is only served
+# if the counters of the collections it was computed from are unchanged. A cache hit is a
+# single MGET of the result and of the counters.
+
+def generation_key(collection):
+    return f"generation:{collection.name}"
+
+def bump_generation(*collections):
+    """To be called after writing to the given collections, invalidates the results computed from them."""
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        for collection in collections:
+            pipeline.incr(generation_key(collection))
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.error("Failed to bump the cache generation of %s: %s", ", ".join(c.name for c in collections), e)
+
+def result_key(name, params):
+    digest = hashlib.sha1(dumps(sorted(params.items())).encode()).hexdigest()
+    return f"result:{name}:{digest}"
+
+def cached_result(name, params, collections, compute):
+    """Return the cached result of compute() for these parameters, computing and caching it if it is missing or stale.
+
+    Redis errors are logged and the result is computed without the cache.
+    """
+    key = result_key(name, params)
+    try:
+        cached, *generations = get_redis().mget([key, *(generation_key(collection) for collection in collections)])
+    except redis.RedisError as e:
+        logger.warning("Cannot read cached result %s: %s", key, e)
+        return compute()
+    generations = [int(generation or 0) for generation in generations]
+    if cached:
+        entry = loads(cached)
+        if entry["generations"] == generations:
+            return entry["result"]
+    # Generations are read before computing, so a write made meanwhile invalidates the result
+    result = compute()
+    try:
+        get_redis().set(key, dumps({"generations": generations, "result": result}), ex=RESULT_CACHE_TTL)
+    except redis.RedisError as e:
+        logger.warning("Cannot cache result %s: %s", key, e)
+    return result
+
+# Optional read-through cache of the serialised documents returned by the detail routes,
+# with their ETag and Last-Modified. Entries are deleted by the write paths of the views and
+# of the Celery tasks, and expire after DETAIL_CACHE_TTL seconds in case a deletion is lost.
+DETAIL_CACHE_ENABLED = os.getenv('DETAIL_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+DETAIL_CACHE_TTL = int(os.getenv('DETAIL_CACHE_TTL', 300))
+
+def document_key(collection, document_id):
+    # Ids are normalised so that an uppercase hex id in a URL hits the entry the writes invalidate
+    if ObjectId.is_valid(document_id):
+        document_id = ObjectId(document_id)
+    return f"document:{collection.name}:{document_id}"
+
+def get_cached_document(collection, document_id):
+    if not DETAIL_CACHE_ENABLED:
+        return None
+    try:
+        cached = get_redis().get(document_key(collection, document_id))
+    except redis.RedisError as e:
+        logger.warning("Cannot read cached document %s %s: %s", collection.name, document_id, e)
+        return None
+    return loads(cached) if cached else None
+
+def cache_document(collection, document_id, entry):
+    if not DETAIL_CACHE_ENABLED:
+        return
+    try:
+        get_redis().set(document_key(collection, document_id), dumps(entry), ex=DETAIL_CACHE_TTL)
+    except redis.RedisError as e:
+        logger.warning("Cannot cache document %s %s: %s", collection.name, document_id, e)
+
+def invalidate_documents(collection, document_ids):
+    if not DETAIL_CACHE_ENABLED or not document_ids:
+        return
+    try:
+        get_redis().delete(*(document_key(collection, document_id) for document_id in document_ids))
+    except redis.RedisError as e:
+        logger.error("Failed to invalidate cached documents of %s: %s", collection.name, e)
@@ -0,0 +1,75 @@
+import base64
+import binascii
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+
+from archimedapi.models import tombstone_model
+from utils.versioning import now
+
+# Changes feeds: the documents of a collection written after a token, and the ids of the
+# documents deleted after it, ordered by (updated_at, _id). Both are range scans on an
+# (updated_at, _id) index, so a sync costs in proportion to the number of changes. The token
+# is the (updated_at, _id) of the last change returned. Documents written before updated_at
+# was stamped sort first, on the initial sync only.
+
+class ExpiredToken(ValueError):
+    """The token is older than the retention of the deletions, the client has to sync again from scratch."""
+
+def encode_token(updated_at, object_id):
+    milliseconds = "" if updated_at is None else str(int((updated_at - datetime(1970, 1, 1)) / timedelta(milliseconds=1)))
+    return base64.urlsafe_b64encode(f"{milliseconds}:{object_id}".encode()).decode().rstrip("=")
+
+def decode_token(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        milliseconds, object_id = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+        updated_at = datetime(1970, 1, 1) + timedelta(milliseconds=int(milliseconds)) if milliseconds else None
+        return updated_at, ObjectId(object_id)
+    except (binascii.Error, InvalidId, UnicodeDecodeError, ValueError, TypeError):
+        raise ValueError(f"Invalid token {token}")
+
+def after_token(token):
+    if token is None:
+        return {}
+    updated_at, last_id = token
+    if updated_at is None:
+        return {"$or": [{"updated_at": None, "_id": {"$gt": last_id}}, {"updated_at": {"$type": "date"}}]}
+    return {"$or": [{"updated_at": {"$gt": updated_at}}, {"updated_at": updated_at, "_id": {"$gt": last_id}}]}
+
+def record_deletion(collection, document_id):
+    tombstone_model.insert_one({"collection": collection.name, "document_id": ObjectId(document_id), "updated_at": now()})
+
+def changes_since(collection, since, limit):
+    """Return the changed documents, the deleted ids, the next token and whether more changes are available.
+
+    Raises ValueError on an invalid token and ExpiredToken if deletions may have been forgotten since it.
+    """
+    token = decode_token(since) if since else None
+    if token and token[0] and token[0] < now() - timedelta(days=settings.CHANGES_RETENTION_DAYS):
+        raise ExpiredToken(f"Token {since} is older than {settings.CHANGES_RETENTION_DAYS} days, sync again without it")
+    settled = {"updated_at": {"$lte": now() - timedelta(seconds=settings.CHANGES_SETTLE_SECONDS)}}
+    sort = [("updated_at", 1), ("_id", 1)]
+    # Each source is read up to limit + 1 entries, the merge keeps the first ones overall
+    documents = list(collection.find({"$and": [after_token(token), {"$or": [settled, {"updated_at": None}]}]}).sort(sort).limit(limit + 1))
+    tombstones = list(tombstone_model.find(
+        {"$and": [{"collection": collection.name}, after_token(token), settled]}
+    ).sort(sort).limit(limit + 1))
+
+    def sort_key(entry):
+        document = entry[1]
+        return (document.get("updated_at") is not None, document.get("updated_at") or datetime.min, document["_id"])
+
+    entries = sorted([("changed", document) for document in documents] + [("deleted", tombstone) for tombstone in tombstones], key=sort_key)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    changed = [document for kind, document in entries if kind == "changed"]
+    deleted = [{"_id": tombstone["document_id"], "deleted_at": tombstone["updated_at"]} for kind, tombstone in entries if kind == "deleted"]
+    if entries:
+        last = entries[-1][1]
+        next_token = encode_token(last.get("updated_at"), last["_id"])
+    else:
+        next_token = since
+    return changed, deleted, next_token, has_more
@@ -1,35 +1,118 @@
-
 import json
 import os
+import threading
+import time
 import redis
+from db_connection import get_redis
 from utils.logger import logger
 from dotenv import load_dotenv
 
 load_dotenv()
 
-redis_client = redis.Redis(
-  host=os.getenv('REDIS_HOST'),
-  port=os.getenv('REDIS_PORT'),
-  password=os.getenv('REDIS_PASSWORD'),
-  decode_responses=True)
+# Seconds an exchange rates snapshot is used before being reloaded from Redis
+EXCHANGE_RATES_TTL = float(os.getenv('EXCHANGE_RATES_TTL', 300))
+# Channel on which a message is published whenever the rates are republished in Redis
+EXCHANGE_RATES_CHANNEL = os.getenv('EXCHANGE_RATES_CHANNEL', 'currencies:updated')
 
 # Stores exchange rates from USD to other currencies
 def get_exchange_rates():
-    return json.loads(redis_client.execute_command('JSON.GET', 'currencies'))['rates']
+    return json.loads(get_redis().execute_command('JSON.GET', 'currencies'))['rates']
+
+class ExchangeRateProvider:
+    """In-process cache of the exchange rates stored in Redis.
+
+    Rates are loaded on first use and reloaded once they are older than the TTL, or as soon as
+    a message is published on EXCHANGE_RATES_CHANNEL. If Redis cannot be reached, the last
+    loaded rates keep being used until the next reload attempt.
+    """
+
+    def __init__(self, load_rates=get_exchange_rates, ttl=EXCHANGE_RATES_TTL, channel=EXCHANGE_RATES_CHANNEL):
+        self.load_rates = load_rates
+        self.ttl = ttl
+        self.channel = channel
+        self._rates = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def rates(self):
+        if self._rates is None or time.monotonic() >= self._expires_at:
+            self.refresh()
+        return self._rates
+
+    def refresh(self):
+        with self._lock:
+            if self._rates is not None and time.monotonic() < self._expires_at:
+                return
+            try:
+                rates = self.load_rates()
+            except (redis.RedisError, TypeError, ValueError, KeyError) as e:
+                if self._rates is None:
+                    raise
+                logger.warning("Failed to reload exchange rates, keeping the previous ones: %s", e)
+                self._expires_at = time.monotonic() + self.ttl
+                return
+            self._rates = rates
+            self._expires_at = time.monotonic() + self.ttl
+        self.listen_for_updates()
+
+    def invalidate(self, message=None):
+        self._expires_at = 0
 
-exchange_rates = get_exchange_rates()
+    def listen_for_updates(self):
+        # Listener threads do not survive a fork, start one in each worker process
+        if not self.channel or self._listener_pid == os.getpid():
+            return
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self.invalidate})
+            pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self.listener_failed)
+        except redis.RedisError as e:
+            logger.warning("Cannot subscribe to exchange rates updates, relying on the TTL only: %s", e)
+            return
+        self._listener_pid = os.getpid()
+
+    def listener_failed(self, error, pubsub, thread):
+        # Stop the listener thread and subscribe again on the next reload, the updates published
+        # in between are missed so the rates are reloaded on next use
+        logger.warning("Exchange rates updates listener failed, subscribing again on the next reload: %s", error)
+        thread.stop()
+        self._listener_pid = None
+        self.invalidate()
+
+    def get(self, target_currency):
+        return self.rates().get(target_currency)
+
+    def convert_many(self, amounts, target_currencies, base_currency="USD"):
+        """Convert each amount to the currency at the same position, reading the rates once."""
+        rates = self.rates()
+        missing = {currency for currency in target_currencies if currency != base_currency and not rates.get(currency)}
+        if missing:
+            raise ValueError(f"Exchange rate not available for {', '.join(sorted(missing))}.")
+        return [
+            amount if currency == base_currency else amount * rates[currency]
+            for amount, currency in zip(amounts, target_currencies)
+        ]
+
+exchange_rate_provider = ExchangeRateProvider()
+
+def notify_exchange_rates_updated():
+    """To be called by the job republishing the rates so that every worker reloads them."""
+    get_redis().publish(EXCHANGE_RATES_CHANNEL, 'updated')
 
 # Base currency is USD for now
 def get_exchange_rate(target_currency):
-    return exchange_rates.get(target_currency)
+    return exchange_rate_provider.get(target_currency)
 
 def convert_currency(amount, target_currency, base_currency="USD"):
-    logger.info(f"Converting {amount} from {base_currency} to {target_currency}")
     if base_currency == target_currency:
         return amount
     exchange_rate = get_exchange_rate(target_currency)
-    logger.info(f"Exchange rate {base_currency}/{target_currency}: {exchange_rate}")
     if not exchange_rate:
         raise ValueError("Exchange rate not available.")
     converted_amount = amount * exchange_rate
+    logger.debug("Converted %s %s to %s %s at %s", amount, base_currency, converted_amount, target_currency, exchange_rate)
     return converted_amount
+
+def convert_many(amounts, target_currencies, base_currency="USD"):
+    return exchange_rate_provider.convert_many(amounts, target_currencies, base_currency)
@@ -0,0 +1,80 @@
+from collections import defaultdict
+
+from archimedapi.models import BillStatus, bill_model, entity_model
+
+# ?expand= on the capital call routes replaces the referenced ids with the documents they point
+# to, resolved by $lookup stages of the same aggregation as the capital calls themselves instead
+# of one request per bill and investor. Capital calls store ids as strings or ObjectIds, both
+# are converted to ObjectIds so that each $lookup is served by the _id index.
+
+BILL_FIELDS = ["type", "to_investor_id", "investment_id", "currency", "amount", "status", "date", "due_date", "fees_year"]
+ENTITY_FIELDS = ["name", "type", "bank_account_currency", "contact_person", "contact_person_email"]
+
+# expand value: (capital call field holding the ids, referenced collection, embedded fields)
+CAPITAL_CALL_EXPANSIONS = {
+    "bills": ("bills", bill_model, BILL_FIELDS),
+    "investors": ("investor_entities", entity_model, ENTITY_FIELDS),
+    "fund": ("fund_entity_id", entity_model, ENTITY_FIELDS),
+}
+
+def parse_expand(value):
+    """Parse a comma separated ?expand= value, raises ValueError on unknown expansions."""
+    expand = [name.strip() for name in (value or "").split(",") if name.strip()]
+    unknown = [name for name in expand if name not in CAPITAL_CALL_EXPANSIONS]
+    if unknown:
+        raise ValueError(f"Invalid expand {', '.join(unknown)}, expected any of {', '.join(CAPITAL_CALL_EXPANSIONS)}")
+    return list(dict.fromkeys(expand))
+
+def expand_projection(projection, expand):
+    """Add the fields holding the expanded references to a ?fields= projection, so that they are
+    resolved and the bill totals computed even when not requested."""
+    if projection is None:
+        return None
+    return {**projection, **{CAPITAL_CALL_EXPANSIONS[name][0]: 1 for name in expand}}
+
+def to_object_id(expression):
+    return {"$convert": {"input": expression, "to": "objectId", "onError": None, "onNull": None}}
+
+def expand_pipeline(expand):
+    """Aggregation stages embedding the expanded references of capital calls."""
+    stages = []
+    for name in expand:
+        field, collection, fields = CAPITAL_CALL_EXPANSIONS[name]
+        ids_field = f"_expand_{name}"
+        if name == "fund":
+            ids = to_object_id(f"${field}")
+        else:
+            ids = {"$map": {"input": {"$ifNull": [f"${field}", []]}, "in": to_object_id("$$this")}}
+        stages += [
+            {"$addFields": {ids_field: ids}},
+            {"$lookup": {
+                "from": collection.name,
+                "localField": ids_field,
+                "foreignField": "_id",
+                "pipeline": [{"$project": {field_name: 1 for field_name in fields}}],
+                "as": field,
+            }},
+            {"$project": {ids_field: 0}},
+        ]
+        if name == "fund":
+            stages.append({"$addFields": {field: {"$arrayElemAt": [f"${field}", 0]}}})
+    return stages
+
+def bill_totals(bills):
+    """Amounts billed (all bills but the cancelled ones), paid and overdue, per currency."""
+    totals = {"billed": defaultdict(float), "paid": defaultdict(float), "overdue": defaultdict(float)}
+    for bill in bills:
+        currency, amount, bill_status = bill.get("currency"), bill.get("amount", 0), bill.get("status")
+        if bill_status == BillStatus.CANCELLED:
+            continue
+        totals["billed"][currency] += amount
+        if bill_status == BillStatus.PAID:
+            totals["paid"][currency] += amount
+        elif bill_status == BillStatus.OVERDUE:
+            totals["overdue"][currency] += amount
+    return {key: dict(amounts) for key, amounts in totals.items()}
+
+def add_bill_totals(capital_calls):
+    for capital_call in capital_calls:
+        capital_call["bill_totals"] = bill_totals(capital_call.get("bills", []))
+    return capital_calls
@@ -0,0 +1,119 @@
+from datetime import date
+
+import numpy as np
+
+from archimedapi.models import BillType
+from utils.general import days_in_year
+
+# Vectorised counterpart of utils.bill_utils.compute_investment_fee: the fees of every
+# year of a whole batch of investments are computed at once as a 2D array, row i holding
+# the amounts due for years 1, 2, ... of investment i (0 past the end of its schedule).
+
+def to_arrays(investments):
+    """Raises KeyError, TypeError or ValueError if the date of an investment is missing or not an ISO date."""
+    amounts = np.array([investment.get("amount", 0) for investment in investments], dtype=float)
+    # Parsed as compute_investment_fee does, numpy would read a missing date as NaT and 20240101 as a year
+    dates = np.array([date.fromisoformat(investment["date"]) for investment in investments], dtype="datetime64[D]")
+    durations = np.array([investment.get("duration", 1) for investment in investments], dtype=int)
+    return amounts, dates, durations
+
+def fee_rules(dates, durations):
+    """Return the masks of the investments following the old and the new rules, and the length of their schedules."""
+    years = dates.astype("datetime64[Y]").astype(int) + 1970
+    months = dates.astype("datetime64[M]").astype(int) % 12 + 1
+    # Same date rules as compute_investment_fee: January-March up to 2019 follow the old
+    # schedule, April-December from 2019 the new one, and the other investments have no fees.
+    before_2019 = (years <= 2019) & (months < 4)
+    after_2019 = (years >= 2019) & (months >= 4)
+    lengths = np.where(before_2019, np.maximum(durations, 1), np.where(after_2019, np.maximum(durations, 4), 0))
+    return before_2019, after_2019, lengths
+
+def yearly_fee_schedules(amounts, dates, durations, fee_percentage, today=None):
+    today = today or date.today()
+    n = len(amounts)
+    days_diff = (np.datetime64(date(today.year, 12, 31), "D") - dates).astype(int)
+    before_2019, after_2019, lengths = fee_rules(dates, durations)
+    max_years = int(lengths.max()) if n else 0
+
+    schedules = np.zeros((n, max_years))
+    if not max_years:
+        return schedules
+    # Operations are ordered as in compute_investment_fee so that results are identical
+    schedules[before_2019] = (fee_percentage * amounts[before_2019])[:, None]
+    schedules[before_2019, 0] = days_diff[before_2019] / 365 * fee_percentage * amounts[before_2019]
+
+    new_rates = np.full(max(max_years, 4), fee_percentage - 0.01)
+    new_rates[:4] = [fee_percentage, fee_percentage, fee_percentage - 0.002, fee_percentage - 0.004]
+    schedules[after_2019] = new_rates[:max_years] * amounts[after_2019][:, None]
+    schedules[after_2019, 0] = (days_diff[after_2019] / days_in_year(today.year)) * fee_percentage * amounts[after_2019]
+
+    schedules[np.arange(max_years) >= lengths[:, None]] = 0
+    return schedules
+
+def fee_schedule_fields(investments, fee_percentage, today=None):
+    """Materialised yearly fees schedule of each investment, as stored on the investment documents.
+
+    The first year is prorated up to the end of the current year, so a schedule is only valid
+    for the year and the fee percentage it was computed with.
+    """
+    today = today or date.today()
+    amounts, dates, durations = to_arrays(investments)
+    schedules = yearly_fee_schedules(amounts, dates, durations, fee_percentage, today)
+    lengths = fee_rules(dates, durations)[2]
+    return [
+        {
+            "fee_schedule": schedule[:length].tolist(),
+            "fee_schedule_year": today.year,
+            "fee_schedule_percentage": fee_percentage,
+        }
+        for schedule, length in zip(schedules, lengths)
+    ]
+
+def split_valid_dates(investments):
+    """Investments whose date compute_investment_fee can read, and the others."""
+    valid, invalid = [], []
+    for investment in investments:
+        try:
+            date.fromisoformat(investment["date"])
+        except (KeyError, TypeError, ValueError):
+            invalid.append(investment)
+        else:
+            valid.append(investment)
+    return valid, invalid
+
+def upfront_fees(amounts, fee_percentage):
+    return amounts * fee_percentage * 5
+
+def fee_forecast(investments, fee_percentage, bill_type=BillType.YEARLY_FEES, today=None):
+    """Expected fee revenue per fund and per calendar year for a batch of investments.
+
+    Yearly fees of year k of an investment are due in the calendar year of the investment + k - 1,
+    upfront fees in the calendar year of the investment.
+    """
+    if not investments:
+        return {}
+    amounts, dates, durations = to_arrays(investments)
+    funds, fund_index = np.unique(
+        np.array([str(investment.get("fund_entity_id") or "") for investment in investments]), return_inverse=True
+    )
+    first_years = dates.astype("datetime64[Y]").astype(int) + 1970
+    if bill_type == BillType.UPFRONT_FEES:
+        fees = upfront_fees(amounts, fee_percentage)[:, None]
+    else:
+        fees = yearly_fee_schedules(amounts, dates, durations, fee_percentage, today)
+    if not fees.size:
+        return {}
+
+    base_year = int(first_years.min())
+    year_offsets = first_years[:, None] - base_year + np.arange(fees.shape[1])
+    n_years = int(year_offsets.max()) + 1
+    totals = np.bincount(
+        (fund_index[:, None] * n_years + year_offsets).ravel(), weights=fees.ravel(), minlength=len(funds) * n_years
+    ).reshape(len(funds), n_years)
+
+    forecast = {}
+    for fund, fund_totals in zip(funds, totals):
+        forecast[fund or None] = {
+            base_year + offset: float(total) for offset, total in enumerate(fund_totals) if total
+        }
+    return forecast
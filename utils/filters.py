@@ -0,0 +1,77 @@
+from datetime import date
+
+from archimedapi.models import (
+    BillModel,
+    CapitalCallModel,
+    Entity,
+    Investment,
+    bill_model,
+    capital_call_model,
+    entity_model,
+    investment_model,
+)
+
+# Query parameters accepted by the list routes, keyed by collection name, as
+# parameter: (field, operator). Every filtered field leads one of the indexes of the
+# collection in archimedapi.models.INDEXES, followed by _id, which gives the order of the pages
+# (utils.pagination.page_sort). Comma separated values of an equality filter match any of them.
+LIST_FILTERS = {
+    bill_model.name: {
+        "status": ("status", "$eq"),
+        "to_investor_id": ("to_investor_id", "$eq"),
+        "capital_call_id": ("capital_call_id", "$eq"),
+        "due_date_from": ("due_date", "$gte"),
+        "due_date_to": ("due_date", "$lte"),
+    },
+    investment_model.name: {
+        "investor_id": ("investor_id", "$eq"),
+        "fund_entity_id": ("fund_entity_id", "$eq"),
+    },
+    capital_call_model.name: {
+        "status": ("status", "$eq"),
+    },
+    entity_model.name: {
+        "type": ("type", "$eq"),
+    },
+}
+
+# Fields that can be requested with ?fields=, _id is always returned
+LIST_FIELDS = {
+    bill_model.name: set(BillModel.model_fields),
+    investment_model.name: set(Investment.model_fields) | {"fee_schedule", "fee_schedule_year", "fee_schedule_percentage"},
+    capital_call_model.name: set(CapitalCallModel.model_fields),
+    entity_model.name: set(Entity.model_fields),
+}
+
+# Filtered fields holding ISO dates, checked before being compared as strings
+DATE_FIELDS = {"due_date"}
+
+def list_filter(collection, query_params):
+    """Translate the whitelisted filters of a list request into a MongoDB query."""
+    query = {}
+    for parameter, (field, operator) in LIST_FILTERS[collection.name].items():
+        value = query_params.get(parameter)
+        if value in (None, ""):
+            continue
+        if field in DATE_FIELDS:
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Invalid date {value} for {parameter}")
+        if operator == "$eq":
+            values = value.split(",")
+            query[field] = values[0] if len(values) == 1 else {"$in": values}
+        else:
+            query.setdefault(field, {})[operator] = value
+    return query
+
+def list_projection(collection, query_params):
+    """Translate ?fields= into a projection, None when every field is requested."""
+    value = query_params.get("fields")
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = sorted(set(fields) - LIST_FIELDS[collection.name] - {"_id"})
+    if unknown:
+        raise ValueError(f"Invalid fields {', '.join(unknown)}")
+    return {field: 1 for field in fields}
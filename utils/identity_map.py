@@ -0,0 +1,137 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from bson import ObjectId
+from pymongo import monitoring
+
+# Identity map of the current request, set by archimedapi.middleware.IdentityMapMiddleware.
+# Outside of a request (Celery tasks, management commands) there is none and every lookup
+# goes to MongoDB.
+_current = ContextVar("identity_map", default=None)
+
+class IdentityMap:
+    """Documents loaded by ID during a unit of work, each one read from MongoDB at most once.
+
+    Documents are cached per projection, and a whole document already loaded also serves the
+    lookups with a projection, so that the views, the model validators and utils/bill_utils.py
+    can share them. Callers must not modify them, and may get more fields than they asked for.
+    `round_trips` counts the commands sent to MongoDB during the unit of work, by command name.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self.round_trips = Counter()
+
+    @property
+    def total_round_trips(self):
+        return sum(self.round_trips.values())
+
+    @staticmethod
+    def _key(collection, object_id, projection=None):
+        # Computed before querying, the driver may add _id to the projection
+        return (collection.name, object_id, None if projection is None else repr(sorted(projection.items())))
+
+    def _cached(self, collection, object_id, projection):
+        """(True, document) if the document was loaded whole or with the same projection, (False, None) otherwise."""
+        for key in {self._key(collection, object_id), self._key(collection, object_id, projection)}:
+            if key in self._documents:
+                return True, self._documents[key]
+        return False, None
+
+    def get(self, collection, document_id, projection=None):
+        object_id = ObjectId(document_id)
+        found, document = self._cached(collection, object_id, projection)
+        if not found:
+            key = self._key(collection, object_id, projection)
+            document = self._documents[key] = collection.find_one({"_id": object_id}, projection)
+        return document
+
+    async def aget(self, collection, document_id, projection=None):
+        """Same as get with an async collection, documents are shared with the sync lookups."""
+        object_id = ObjectId(document_id)
+        found, document = self._cached(collection, object_id, projection)
+        if not found:
+            key = self._key(collection, object_id, projection)
+            document = self._documents[key] = await collection.find_one({"_id": object_id}, projection)
+        return document
+
+    def get_many(self, collection, ids, projection=None):
+        documents, missing = {}, []
+        for object_id in {ObjectId(document_id) for document_id in ids}:
+            found, document = self._cached(collection, object_id, projection)
+            if found:
+                documents[object_id] = document
+            else:
+                missing.append(object_id)
+        if missing:
+            keys = {object_id: self._key(collection, object_id, projection) for object_id in missing}
+            found = {document["_id"]: document for document in collection.find({"_id": {"$in": missing}}, projection)}
+            for object_id in missing:
+                documents[object_id] = self._documents[keys[object_id]] = found.get(object_id)
+        return {object_id: document for object_id, document in documents.items() if document is not None}
+
+    def forget(self, collection, document_id):
+        object_id = ObjectId(document_id)
+        for key in [key for key in self._documents if key[:2] == (collection.name, object_id)]:
+            del self._documents[key]
+
+def current_identity_map():
+    return _current.get()
+
+@contextmanager
+def unit_of_work():
+    """Share one identity map between every lookup made inside the block."""
+    identity_map = IdentityMap()
+    token = _current.set(identity_map)
+    try:
+        yield identity_map
+    finally:
+        _current.reset(token)
+
+def get_document(collection, document_id, projection=None):
+    """Fetch a document by ID, from the identity map of the current unit of work if there is one."""
+    identity_map = _current.get()
+    if identity_map is None:
+        return collection.find_one({"_id": ObjectId(document_id)}, projection)
+    return identity_map.get(collection, document_id, projection)
+
+async def aget_document(collection, document_id, projection=None):
+    """Same as get_document with an async collection."""
+    identity_map = _current.get()
+    if identity_map is None:
+        return await collection.find_one({"_id": ObjectId(document_id)}, projection)
+    return await identity_map.aget(collection, document_id, projection)
+
+def get_documents(collection, ids, projection=None):
+    """Fetch the documents with the given ids in a single query at most, keyed by ObjectId."""
+    identity_map = _current.get()
+    if identity_map is None:
+        object_ids = list({ObjectId(document_id) for document_id in ids})
+        return {document["_id"]: document for document in collection.find({"_id": {"$in": object_ids}}, projection)}
+    return identity_map.get_many(collection, ids, projection)
+
+def forget_document(collection, document_id):
+    """To be called after writing to a document so that later lookups read it again."""
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.forget(collection, document_id)
+
+class RoundTripListener(monitoring.CommandListener):
+    """Counts the commands sent to MongoDB in the identity map of the current unit of work.
+
+    pymongo publishes command events in the thread that runs the command, so the context
+    variable is the one of the request that issued it.
+    """
+
+    def started(self, event):
+        identity_map = _current.get()
+        # Explains are sent by the query plan guard of utils/query_plan.py, not by the application
+        if identity_map is not None and event.command_name != "explain":
+            identity_map.round_trips[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
@@ -0,0 +1,158 @@
+from collections import Counter, defaultdict
+
+from bson import ObjectId
+from pymongo import DESCENDING, ReplaceOne, ReturnDocument, UpdateOne
+
+from archimedapi.models import BillStatus, bill_model, investment_model, investor_summary_model
+from utils.versioning import now
+
+# Per-investor aggregates, so that membership fees and waivers are decided with a single point
+# read instead of scanning the investments of the investor. Each write to the investments and
+# bills collections is followed by one atomic update of the summary of the investor. The
+# summaries are not updated in the same transaction as the documents they aggregate, run
+# `python manage.py rebuild_investor_summaries` to repair them if they drift.
+#
+#   {
+#       "_id": ObjectId(investor_id),
+#       "investment_count": 2, "investment_total": 80000.0, "investment_max": 60000.0,
+#       "currencies": ["GBP"],                  # currencies the investor has been billed in
+#       "outstanding_bills": {"GBP": 1250.0},   # amount of the bills not paid nor cancelled
+#       "rebuilt_at": datetime,                 # last rebuild, or creation by the hooks below
+#   }
+#
+# Removing the largest investment of an investor reads the largest remaining one in a second
+# write, an investment created in between can leave investment_max stale until the next rebuild.
+
+# Bills counted in the outstanding totals, marking a bill overdue leaves them unchanged
+OUTSTANDING_BILL_STATUSES = [BillStatus.CREATED, BillStatus.PENDING, BillStatus.OVERDUE]
+
+def on_insert(update):
+    # Summaries created while a rebuild runs are newer than it and must not be deleted by it
+    return {**update, "$setOnInsert": {"rebuilt_at": now()}}
+
+def get_investor_summary(investor_id):
+    return investor_summary_model.find_one({"_id": ObjectId(investor_id)})
+
+def record_investment_created(investment):
+    amount = investment.get("amount", 0)
+    investor_summary_model.update_one(
+        {"_id": ObjectId(investment["investor_id"])},
+        on_insert({"$inc": {"investment_count": 1, "investment_total": amount}, "$max": {"investment_max": amount}}),
+        upsert=True,
+    )
+
+def record_investment_deleted(investment):
+    amount = investment.get("amount", 0)
+    summary = investor_summary_model.find_one_and_update(
+        {"_id": ObjectId(investment["investor_id"])},
+        {"$inc": {"investment_count": -1, "investment_total": -amount}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if summary and amount >= summary.get("investment_max", 0):
+        # $max cannot be undone, read the largest remaining investment instead
+        refresh_investment_max(investment["investor_id"])
+
+def record_investment_updated(before, after):
+    if (before["investor_id"], before.get("amount", 0)) != (after["investor_id"], after.get("amount", 0)):
+        record_investment_deleted(before)
+        record_investment_created(after)
+
+def refresh_investment_max(investor_id):
+    largest = investment_model.find_one({"investor_id": investor_id}, {"amount": 1}, sort=[("amount", DESCENDING)])
+    investor_summary_model.update_one(
+        {"_id": ObjectId(investor_id)}, {"$set": {"investment_max": largest.get("amount", 0) if largest else 0}}
+    )
+
+def outstanding_increments(bill, sign=1):
+    if bill.get("status", BillStatus.CREATED) not in OUTSTANDING_BILL_STATUSES or not bill.get("currency"):
+        return Counter()
+    return Counter({f"outstanding_bills.{bill['currency']}": sign * bill.get("amount", 0)})
+
+def bill_summary_update(increments, currency=None):
+    update = {}
+    increments = {field: value for field, value in increments.items() if value}
+    if increments:
+        update["$inc"] = increments
+    if currency:
+        update["$addToSet"] = {"currencies": currency}
+    return update
+
+def record_bills_created(bills):
+    operations = []
+    for bill in bills:
+        update = bill_summary_update(outstanding_increments(bill), bill.get("currency"))
+        if update:
+            operations.append(UpdateOne({"_id": ObjectId(bill["to_investor_id"])}, on_insert(update), upsert=True))
+    if operations:
+        investor_summary_model.bulk_write(operations, ordered=False)
+
+def record_bill_deleted(bill):
+    update = bill_summary_update(outstanding_increments(bill, -1))
+    if update:
+        investor_summary_model.update_one({"_id": ObjectId(bill["to_investor_id"])}, on_insert(update), upsert=True)
+
+def record_bill_updated(before, after):
+    if before["to_investor_id"] != after["to_investor_id"]:
+        record_bill_deleted(before)
+        record_bills_created([after])
+        return
+    increments = outstanding_increments(after)
+    increments.update(outstanding_increments(before, -1))
+    update = bill_summary_update(increments, after.get("currency") if after.get("currency") != before.get("currency") else None)
+    if update:
+        investor_summary_model.update_one({"_id": ObjectId(after["to_investor_id"])}, on_insert(update), upsert=True)
+
+def compute_investor_summaries(investor_ids=None):
+    """Recompute the summaries of the given investors, or of every investor, from the investments and bills."""
+    summaries = defaultdict(lambda: {
+        "investment_count": 0, "investment_total": 0, "investment_max": 0, "currencies": [], "outstanding_bills": {},
+    })
+    investment_match = {"investor_id": {"$in": investor_ids}} if investor_ids is not None else {}
+    for group in investment_model.aggregate([
+        {"$match": investment_match},
+        {"$group": {
+            "_id": "$investor_id",
+            "investment_count": {"$sum": 1},
+            "investment_total": {"$sum": "$amount"},
+            "investment_max": {"$max": "$amount"},
+        }},
+    ]):
+        if ObjectId.is_valid(group["_id"]):
+            summaries[ObjectId(group.pop("_id"))].update(group)
+
+    bill_match = {"to_investor_id": {"$in": investor_ids}} if investor_ids is not None else {}
+    for group in bill_model.aggregate([
+        {"$match": bill_match},
+        {"$group": {
+            "_id": {"investor_id": "$to_investor_id", "currency": "$currency"},
+            "outstanding": {"$sum": {"$cond": [{"$in": ["$status", OUTSTANDING_BILL_STATUSES]}, "$amount", 0]}},
+        }},
+    ]):
+        investor_id, currency = group["_id"]["investor_id"], group["_id"].get("currency")
+        if not ObjectId.is_valid(investor_id) or not currency:
+            continue
+        summary = summaries[ObjectId(investor_id)]
+        summary["currencies"].append(currency)
+        if group["outstanding"]:
+            summary["outstanding_bills"][currency] = group["outstanding"]
+    for summary in summaries.values():
+        summary["currencies"].sort()
+    return summaries
+
+def rebuild_investor_summaries(investor_ids=None, chunk_size=1000):
+    """Replace the stored summaries with recomputed ones, returns the number of summaries written and deleted.
+
+    Every summary written is stamped with the start of the rebuild, the summaries with an older
+    stamp belong to investors left without investments nor bills and are deleted.
+    """
+    started = now()
+    summaries = compute_investor_summaries(investor_ids)
+    operations = [ReplaceOne({"_id": investor_id}, {**summary, "rebuilt_at": started}, upsert=True) for investor_id, summary in summaries.items()]
+    for start in range(0, len(operations), chunk_size):
+        investor_summary_model.bulk_write(operations[start:start + chunk_size], ordered=False)
+    # Summaries written before rebuilt_at existed have none
+    stale_query = {"$or": [{"rebuilt_at": {"$lt": started}}, {"rebuilt_at": None}]}
+    if investor_ids is not None:
+        stale_query["_id"] = {"$in": [ObjectId(investor_id) for investor_id in investor_ids if ObjectId.is_valid(investor_id)]}
+    deleted = investor_summary_model.delete_many(stale_query).deleted_count
+    return len(operations), deleted
@@ -0,0 +1,57 @@
+import datetime
+import json
+
+from bson import Decimal128, ObjectId, json_util
+from django.http import HttpResponse
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+
+# Single pass BSON -> JSON encoding. Documents are handed to json.dumps as they come
+# out of pymongo and the BSON types are converted by the default hook while the
+# string is being built, producing the same relaxed extended JSON as json_util.dumps
+# ({"$oid": ...}, {"$date": ...}, {"$numberDecimal": ...}) without walking the tree
+# beforehand or decoding it again.
+
+def default(obj):
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    if isinstance(obj, datetime.datetime) and obj.tzinfo is None and obj.year >= 1970:
+        # pymongo decodes dates as naive UTC datetimes
+        if obj.microsecond >= 1000:
+            return {"$date": obj.isoformat(timespec="milliseconds") + "Z"}
+        return {"$date": obj.isoformat(timespec="seconds") + "Z"}
+    if isinstance(obj, Decimal128):
+        return {"$numberDecimal": str(obj)}
+    # aware or pre-epoch datetimes and the less common BSON types (Binary, Regex...)
+    return json_util.default(obj)
+
+def dumps(data):
+    return json.dumps(data, default=default, separators=(",", ":"))
+
+def loads(data):
+    return json.loads(data)
+
+class BSONJsonResponse(HttpResponse):
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=dumps(data), **kwargs)
+
+class BSONJSONRenderer(BaseRenderer):
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return dumps(data).encode()
+
+class BSONJSONParser(BaseParser):
+    media_type = "application/json"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as e:
+            raise ParseError(f"JSON parse error - {e}")
@@ -1,8 +1,105 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Records are handed to a queue by the threads that log them and written to stderr by a
+# background thread, so that logging never blocks a request on I/O. Records below WARNING are
+# sampled at LOG_SAMPLE_RATE, warnings and errors are always kept. Payloads are only logged at
+# DEBUG, through log_payload, and truncated to LOG_PAYLOAD_MAX_CHARS.
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 1))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 2000))
+
+# Attributes of every LogRecord, anything else was passed through extra= and is output as is
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields given through extra= next to the message."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records below WARNING."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+class StructuredQueueHandler(QueueHandler):
+    """Queues records with their message formatted and their traceback as text, both picklable."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def make_formatter(output_format):
+    if output_format == 'json':
+        return JsonFormatter()
+    return logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-logger = logging.getLogger('app')
 handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
\ No newline at end of file
+handler.setFormatter(make_formatter(LOG_FORMAT))
+queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+listener.start()
+
+@atexit.register
+def _stop_listener():
+    # Writes the records still queued
+    listener.stop()
+
+def _restart_after_fork():
+    # The thread of the listener does not survive a fork, the child gets a queue and a thread of its own
+    global listener
+    queue_handler.queue = queue.SimpleQueue()
+    listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+logger = logging.getLogger('app')
+logger.addHandler(queue_handler)
+logger.setLevel(LOG_LEVEL)
+
+def log_payload(message, payload):
+    """Log a request payload at DEBUG, truncated to LOG_PAYLOAD_MAX_CHARS."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    try:
+        text = json.dumps(payload, default=str)
+    except (TypeError, ValueError):
+        text = repr(payload)
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+    logger.debug("%s: %s", message, text)
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from pymongo import monitoring
+
+# Prometheus metrics of the web processes and of the Celery workers. Every MongoDB command and
+# Redis call is timed, and attributed to the request being served if there is one (see
+# archimedapi.middleware.MetricsMiddleware). With PROMETHEUS_MULTIPROC_DIR set, every process
+# writing to the directory (gunicorn workers, Celery workers) is aggregated by /metrics.
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Duration of the requests", ["view", "method", "status"])
+REQUEST_MONGODB_DURATION = Histogram("http_request_mongodb_duration_seconds", "Time spent in MongoDB commands per request", ["view"])
+REQUEST_MONGODB_COMMANDS = Histogram(
+    "http_request_mongodb_commands", "MongoDB commands sent per request", ["view"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+REQUEST_REDIS_DURATION = Histogram("http_request_redis_duration_seconds", "Time spent in Redis calls per request", ["view"])
+REQUEST_REDIS_COMMANDS = Histogram(
+    "http_request_redis_commands", "Redis calls made per request", ["view"], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+MONGODB_COMMAND_DURATION = Histogram("mongodb_command_duration_seconds", "Duration of the MongoDB commands", ["command"])
+REDIS_COMMAND_DURATION = Histogram("redis_command_duration_seconds", "Duration of the Redis calls, a pipeline counts as one", ["command"])
+TASK_DURATION = Histogram(
+    "celery_task_duration_seconds", "Duration of the Celery tasks", ["task", "state"], buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+TASK_ROWS = Counter("celery_task_rows_total", "Documents touched by the Celery tasks", ["task", "operation"])
+# Summary of the last run of each task, to alert on a task that stops running or suddenly touches many more documents
+TASK_LAST_RUN_ROWS = Gauge(
+    "celery_task_last_run_rows", "Documents touched by the last run of the Celery tasks", ["task", "operation"], multiprocess_mode="mostrecent",
+)
+TASK_LAST_RUN = Gauge(
+    "celery_task_last_run_timestamp_seconds", "End of the last successful run of the Celery tasks", ["task"], multiprocess_mode="mostrecent",
+)
+
+class RequestMetrics:
+    """MongoDB and Redis time and round trips of the request being served."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.mongodb_commands = 0
+        self.mongodb_seconds = 0.0
+        self.redis_commands = 0
+        self.redis_seconds = 0.0
+        # Async views run Redis calls in threads of their own, concurrently with the request
+        self._lock = threading.Lock()
+
+    def add_mongodb(self, seconds):
+        with self._lock:
+            self.mongodb_commands += 1
+            self.mongodb_seconds += seconds
+
+    def add_redis(self, seconds):
+        with self._lock:
+            self.redis_commands += 1
+            self.redis_seconds += seconds
+
+    def server_timing(self):
+        total = (time.perf_counter() - self.start) * 1000
+        return (
+            f'mongodb;dur={self.mongodb_seconds * 1000:.1f};desc="{self.mongodb_commands} commands", '
+            f'redis;dur={self.redis_seconds * 1000:.1f};desc="{self.redis_commands} calls", '
+            f"total;dur={total:.1f}"
+        )
+
+    def observe(self, view, method, status):
+        REQUEST_DURATION.labels(view, method, status).observe(time.perf_counter() - self.start)
+        REQUEST_MONGODB_DURATION.labels(view).observe(self.mongodb_seconds)
+        REQUEST_MONGODB_COMMANDS.labels(view).observe(self.mongodb_commands)
+        REQUEST_REDIS_DURATION.labels(view).observe(self.redis_seconds)
+        REQUEST_REDIS_COMMANDS.labels(view).observe(self.redis_commands)
+
+_current = ContextVar("request_metrics", default=None)
+
+@contextmanager
+def measure_request():
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+class CommandTimingListener(monitoring.CommandListener):
+    """Times the MongoDB commands, registered on the clients of db_connection."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGODB_COMMAND_DURATION.labels(event.command_name).observe(seconds)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add_mongodb(seconds)
+
+@contextmanager
+def timed_redis(command):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        REDIS_COMMAND_DURATION.labels(command).observe(seconds)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add_redis(seconds)
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed_redis("PIPELINE"):
+            return super().execute(raise_on_error)
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client timing each call, and each pipeline as a whole."""
+
+    def execute_command(self, *args, **options):
+        with timed_redis(str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def record_task_rows(task, operation, count):
+    TASK_ROWS.labels(task, operation).inc(count)
+    TASK_LAST_RUN_ROWS.labels(task, operation).set(count)
+
+def record_task_run(task):
+    TASK_LAST_RUN.labels(task).set_to_current_time()
+
+def render_metrics():
+    """Return the metrics in the Prometheus text format, and their content type."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
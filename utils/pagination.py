@@ -0,0 +1,126 @@
+import base64
+import binascii
+
+import bson
+from bson import ObjectId
+from bson.errors import BSONError, InvalidId
+from django.conf import settings
+
+# Keyset pagination over _id: each page is a range scan on the _id index starting
+# right after the last document of the previous page, so the cost of a page does
+# not depend on how deep into the collection it is.
+#
+# Equality filters keep the _id order, served by the (field, _id) indexes of the list filters.
+# An index on (field, _id) returns the documents of a range on field in field order though, so
+# pages filtered by a range are sorted by (field, _id) instead, and their cursor holds the value
+# of field of the last document along with its _id.
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+def range_field(query):
+    """Field filtered by a range in the query, whose index gives the order of the pages, if any."""
+    for field, condition in query.items():
+        if field != "_id" and isinstance(condition, dict) and RANGE_OPERATORS.intersection(condition):
+            return field
+    return None
+
+def page_sort(query):
+    field = range_field(query)
+    return [(field, 1), ("_id", 1)] if field else [("_id", 1)]
+
+def encode_cursor(object_id, value=None):
+    raw = object_id.binary if value is None else bson.encode({"value": value, "_id": object_id})
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Return the _id of the last document of the previous page and its value of the range field, if any."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode())
+        if len(raw) == 12:
+            return ObjectId(raw), None
+        position = bson.decode(raw)
+        return ObjectId(position["_id"]), position["value"]
+    except (binascii.Error, BSONError, InvalidId, KeyError, ValueError, TypeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+
+def get_page_size(value):
+    if value in (None, ""):
+        return settings.API_PAGE_SIZE
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid limit {value}")
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, settings.API_MAX_PAGE_SIZE)
+
+def page_query(query_params, query=None):
+    """Return the page size and the query of the page requested by ?limit= and ?after=."""
+    limit = get_page_size(query_params.get("limit"))
+    query = dict(query or {})
+    after = query_params.get("after")
+    if after:
+        last_id, value = decode_cursor(after)
+        field = range_field(query)
+        if field is None:
+            query["_id"] = {"$gt": last_id}
+        elif value is not None and all(type(bound) is type(value) for bound in query[field].values()):
+            # The lower bound of the range moves to the last value, so the index scan starts there
+            condition = dict(query[field])
+            if "$gte" not in condition or value > condition["$gte"]:
+                condition["$gte"] = value
+            query[field] = condition
+            query["$or"] = [{field: {"$gt": value}}, {"_id": {"$gt": last_id}}]
+        else:
+            raise ValueError(f"Invalid cursor {after}")
+    return limit, query
+
+def page_projection(query, projection):
+    """Projection including the range field, needed for the cursor, and whether it was added to it."""
+    field = range_field(query)
+    if not projection or not field or field in projection or not all(projection.values()):
+        return projection, False
+    return {**projection, field: 1}, True
+
+def page_stages(query, limit, pipeline=None, projection=None):
+    stages = [{"$match": query}, {"$sort": dict(page_sort(query))}, {"$limit": limit + 1}, *(pipeline or [])]
+    if projection:
+        stages.append({"$project": projection})
+    return stages
+
+def split_page(documents, limit, query, added_field=False):
+    next_cursor = None
+    field = range_field(query)
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1]["_id"], documents[-1].get(field) if field else None)
+    if added_field:
+        for document in documents:
+            document.pop(field, None)
+    return documents, next_cursor
+
+def paginate(collection, query_params, query=None, pipeline=None, projection=None):
+    """Return one page of documents and the cursor of the next page (None on the last page).
+
+    Pages are sorted by _id, or by the range field then _id. Aggregation stages given in pipeline
+    are applied to the documents of the page, in the same query.
+    """
+    limit, query = page_query(query_params, query)
+    projection, added_field = page_projection(query, projection)
+    # Fetch one extra document to know whether a next page exists without a count
+    if pipeline:
+        documents = list(collection.aggregate(page_stages(query, limit, pipeline, projection)))
+    else:
+        documents = list(collection.find(query, projection).sort(page_sort(query)).limit(limit + 1))
+    return split_page(documents, limit, query, added_field)
+
+async def apaginate(collection, query_params, query=None, pipeline=None, projection=None):
+    """Same as paginate with an async collection."""
+    limit, query = page_query(query_params, query)
+    projection, added_field = page_projection(query, projection)
+    if pipeline:
+        documents = await (await collection.aggregate(page_stages(query, limit, pipeline, projection))).to_list()
+    else:
+        documents = await collection.find(query, projection).sort(page_sort(query)).limit(limit + 1).to_list()
+    return split_page(documents, limit, query, added_field)
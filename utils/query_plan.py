@@ -0,0 +1,227 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from utils.logger import logger
+
+# Opt-in guard against unindexed queries, for development and the test suite. With
+# QUERY_PLAN_GUARD set to log or raise, every filtered query issued through the collections of
+# archimedapi.models is explained first, and flagged when its winning plan scans the whole
+# collection or examines more than QUERY_PLAN_MAX_RATIO documents per document returned.
+# Queries without a filter read the whole collection by design and are not explained.
+
+# Methods taking a filter, with the position of the filter in their arguments
+FILTER_ARGUMENT = {
+    "find_one": 0, "count_documents": 0, "distinct": 1, "update_one": 0, "update_many": 0, "replace_one": 0,
+    "delete_one": 0, "delete_many": 0, "find_one_and_update": 0, "find_one_and_replace": 0, "find_one_and_delete": 0,
+}
+# Methods acting on the first matching document only
+SINGLE_DOCUMENT = {"find_one", "update_one", "replace_one", "delete_one", "find_one_and_update", "find_one_and_replace", "find_one_and_delete"}
+
+class UnindexedQuery(Exception):
+    pass
+
+# Read once, every query of the collections checks it
+_enabled = None
+
+def guard_enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = getattr(settings, "QUERY_PLAN_GUARD", "off") in ("log", "raise")
+    return _enabled
+
+def _reset_enabled(setting, **kwargs):
+    global _enabled
+    if setting == "QUERY_PLAN_GUARD":
+        _enabled = None
+
+setting_changed.connect(_reset_enabled)
+
+def find_values(document, key):
+    """Values of every field named key, at any depth of an explain output."""
+    if isinstance(document, dict):
+        for name, value in document.items():
+            if name == key:
+                yield value
+            else:
+                yield from find_values(value, key)
+    elif isinstance(document, list):
+        for value in document:
+            yield from find_values(value, key)
+
+def explain_find(cursor):
+    return cursor.explain()
+
+def explain_aggregate(collection, pipeline):
+    return collection.database.command("explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats")
+
+async def aexplain_find(cursor):
+    return await cursor.explain()
+
+async def aexplain_aggregate(collection, pipeline):
+    return await collection.database.command("explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats")
+
+def check_plan(collection_name, operation, query, explanation):
+    """Log or raise, depending on QUERY_PLAN_GUARD, if the explained query is not served by an index."""
+    stages = {stage for plan in find_values(explanation, "winningPlan") for stage in find_values(plan, "stage")}
+    examined = sum(stats.get("totalDocsExamined", 0) for stats in find_values(explanation, "executionStats"))
+    returned = sum(stats.get("nReturned", 0) for stats in find_values(explanation, "executionStats"))
+    ratio = examined / max(returned, 1)
+    if "COLLSCAN" in stages:
+        problem = "scans the whole collection"
+    elif ratio > settings.QUERY_PLAN_MAX_RATIO:
+        problem = f"examined {examined} documents for {returned} returned"
+    else:
+        return
+    message = f"{operation} on {collection_name} {problem}: {query}"
+    if settings.QUERY_PLAN_GUARD == "raise":
+        raise UnindexedQuery(message)
+    logger.warning("Unindexed query, %s", message)
+
+class GuardedCursor:
+    """Cursor whose query is explained, with the sort, skip and limit chained on it, when first read."""
+
+    def __init__(self, cursor, collection_name, query):
+        self._cursor = cursor
+        self._collection_name = collection_name
+        self._query = query
+        self._checked = not query
+
+    def __getattr__(self, attr):
+        value = getattr(self._cursor, attr)
+        if not callable(value):
+            return value
+
+        def chained(*args, **kwargs):
+            result = value(*args, **kwargs)
+            return self if result is self._cursor else result
+        return chained
+
+    def _check(self):
+        if not self._checked:
+            self._checked = True
+            check_plan(self._collection_name, "find", self._query, explain_find(self._cursor.clone()))
+
+    def __iter__(self):
+        self._check()
+        return iter(self._cursor)
+
+    def __next__(self):
+        self._check()
+        return next(self._cursor)
+
+    next = __next__
+
+    def to_list(self, length=None):
+        self._check()
+        return self._cursor.to_list(length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+def guard(collection, attr, method):
+    """Wrap the query methods of a pymongo collection so that their plan is checked."""
+    if attr == "find":
+        def find(*args, **kwargs):
+            query = kwargs.get("filter", args[0] if args else None)
+            return GuardedCursor(method(*args, **kwargs), collection.name, query)
+        return find
+
+    if attr == "aggregate":
+        def aggregate(pipeline, *args, **kwargs):
+            if pipeline and pipeline[0].get("$match"):
+                check_plan(collection.name, "aggregate", pipeline[0]["$match"], explain_aggregate(collection, pipeline))
+            return method(pipeline, *args, **kwargs)
+        return aggregate
+
+    if attr in FILTER_ARGUMENT:
+        position = FILTER_ARGUMENT[attr]
+
+        def query_method(*args, **kwargs):
+            query = kwargs.get("filter", args[position] if len(args) > position else None)
+            if query:
+                if attr == "find_one":
+                    cursor = collection.find(*args, **kwargs)
+                else:
+                    cursor = collection.find(query)
+                    if kwargs.get("sort"):
+                        cursor = cursor.sort(kwargs["sort"])
+                if attr in SINGLE_DOCUMENT:
+                    cursor = cursor.limit(1)
+                check_plan(collection.name, attr, query, explain_find(cursor))
+            return method(*args, **kwargs)
+        return query_method
+
+    return method
+
+class AsyncGuardedCursor(GuardedCursor):
+    """Same as GuardedCursor with an async cursor, explained through the async collection."""
+
+    async def _acheck(self):
+        if not self._checked:
+            self._checked = True
+            check_plan(self._collection_name, "find", self._query, await aexplain_find(self._cursor.clone()))
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        await self._acheck()
+        return await self._iterator.__anext__()
+
+    async def to_list(self, length=None):
+        await self._acheck()
+        return await self._cursor.to_list(length)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._cursor.close()
+
+def aguard(collection, attr, method):
+    """Same as guard with a pymongo async collection, whose query methods are coroutines."""
+    if attr == "find":
+        def find(*args, **kwargs):
+            query = kwargs.get("filter", args[0] if args else None)
+            return AsyncGuardedCursor(method(*args, **kwargs), collection.name, query)
+        return find
+
+    if attr == "aggregate":
+        async def aggregate(pipeline, *args, **kwargs):
+            if pipeline and pipeline[0].get("$match"):
+                check_plan(collection.name, "aggregate", pipeline[0]["$match"], await aexplain_aggregate(collection, pipeline))
+            return await method(pipeline, *args, **kwargs)
+        return aggregate
+
+    if attr in FILTER_ARGUMENT:
+        position = FILTER_ARGUMENT[attr]
+
+        async def query_method(*args, **kwargs):
+            query = kwargs.get("filter", args[position] if len(args) > position else None)
+            if query:
+                if attr == "find_one":
+                    cursor = collection.find(*args, **kwargs)
+                else:
+                    cursor = collection.find(query)
+                    if kwargs.get("sort"):
+                        cursor = cursor.sort(kwargs["sort"])
+                if attr in SINGLE_DOCUMENT:
+                    cursor = cursor.limit(1)
+                check_plan(collection.name, attr, query, await aexplain_find(cursor))
+            return await method(*args, **kwargs)
+        return query_method
+
+    return method
+
+class AsyncGuardedCollection:
+    """Async collection whose query methods are wrapped by aguard."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, attr):
+        return aguard(self._collection, attr, getattr(self._collection, attr))
@@ -0,0 +1,59 @@
+from archimedapi.models import bill_model, capital_call_model, investment_model
+
+# Reporting totals computed by a single $facet aggregation per collection. Amounts are never
+# converted: every total is split by currency, so each row holds the grouping keys, the
+# currency, the total amount and the number of documents.
+
+BILL_REPORT_GROUPS = {
+    "by_type": {"type": "$type"},
+    "by_status": {"status": "$status"},
+    "by_month": {"month": {"$substrBytes": ["$date", 0, 7]}},
+    "by_investor": {"investor_id": "$to_investor_id"},
+}
+
+# Bills only reference their fund through their capital call: the bills are first totalled per
+# capital call, so that each capital call is looked up once, then per fund. Bills without a
+# valid capital call are reported under a null fund.
+BILL_FUND_FACET = [
+    {"$group": {"_id": {"capital_call_id": "$capital_call_id", "currency": "$currency"}, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}},
+    {"$addFields": {"capital_call_oid": {"$convert": {"input": "$_id.capital_call_id", "to": "objectId", "onError": None, "onNull": None}}}},
+    {"$lookup": {"from": capital_call_model.name, "localField": "capital_call_oid", "foreignField": "_id", "as": "capital_call"}},
+    {"$unwind": {"path": "$capital_call", "preserveNullAndEmptyArrays": True}},
+    {"$group": {
+        "_id": {"fund_entity_id": {"$ifNull": ["$capital_call.fund_entity_id", None]}, "currency": "$_id.currency"},
+        "total": {"$sum": "$total"},
+        "count": {"$sum": "$count"},
+    }},
+]
+
+# Investments carry no currency of their own, their totals are split by fund and investor only
+INVESTMENT_REPORT_GROUPS = {
+    "by_fund": {"fund_entity_id": "$fund_entity_id"},
+    "by_month": {"month": {"$substrBytes": ["$date", 0, 7]}},
+    "by_investor": {"investor_id": "$investor_id"},
+}
+
+def report_pipeline(query, groups, currency_field=None, extra_facets=None):
+    facets = dict(extra_facets or {})
+    for name, keys in groups.items():
+        if currency_field:
+            keys = {**keys, "currency": currency_field}
+        facets[name] = [{"$group": {"_id": keys, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}]
+    facets["overall"] = [{"$group": {"_id": {"currency": currency_field} if currency_field else None, "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}]
+    return [{"$match": query}, {"$facet": facets}]
+
+def report_rows(groups):
+    return [
+        {**(group["_id"] or {}), "total": group["total"], "count": group["count"]}
+        for group in sorted(groups, key=lambda group: str(group["_id"]))
+    ]
+
+def run_report(collection, query, groups, currency_field=None, extra_facets=None):
+    result = next(collection.aggregate(report_pipeline(query, groups, currency_field, extra_facets)))
+    return {name: report_rows(rows) for name, rows in result.items()}
+
+def bill_report(query):
+    return run_report(bill_model, query, BILL_REPORT_GROUPS, "$currency", {"by_fund": BILL_FUND_FACET})
+
+def investment_report(query):
+    return run_report(investment_model, query, INVESTMENT_REPORT_GROUPS)
@@ -0,0 +1,65 @@
+from django.conf import settings
+
+from utils.json_codec import dumps
+
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+def iter_batches(cursor, batch_size):
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def aiter_batches(cursor, batch_size):
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def stream_documents(cursor, output_format="json", batch_size=None):
+    """Serialise a pymongo cursor one batch at a time, as a JSON array or as newline delimited JSON.
+
+    Only the documents of the current batch are held in memory, whatever the size of the result.
+    """
+    if output_format not in STREAM_FORMATS:
+        raise ValueError(f"Invalid stream format {output_format}")
+    batch_size = batch_size or settings.API_STREAM_BATCH_SIZE
+    cursor = cursor.batch_size(batch_size)
+    if output_format == "ndjson":
+        for batch in iter_batches(cursor, batch_size):
+            yield "".join(dumps(document) + "\n" for document in batch)
+        return
+    yield "["
+    separator = ""
+    for batch in iter_batches(cursor, batch_size):
+        yield separator + ",".join(dumps(document) for document in batch)
+        separator = ","
+    yield "]"
+
+async def astream_documents(cursor, output_format="json", batch_size=None):
+    """Same as stream_documents with an async cursor."""
+    if output_format not in STREAM_FORMATS:
+        raise ValueError(f"Invalid stream format {output_format}")
+    batch_size = batch_size or settings.API_STREAM_BATCH_SIZE
+    cursor = cursor.batch_size(batch_size)
+    if output_format == "ndjson":
+        async for batch in aiter_batches(cursor, batch_size):
+            yield "".join(dumps(document) + "\n" for document in batch)
+        return
+    yield "["
+    separator = ""
+    async for batch in aiter_batches(cursor, batch_size):
+        yield separator + ",".join(dumps(document) for document in batch)
+        separator = ","
+    yield "]"
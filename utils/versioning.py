@@ -0,0 +1,53 @@
+import calendar
+import hashlib
+from datetime import datetime, timezone
+
+from django.utils.http import http_date
+
+# Every write path stamps the documents it writes with a `_version` incremented on each
+# write and the `updated_at` time of the write, which back the ETag and Last-Modified
+# headers of the detail routes. Times are naive UTC datetimes truncated to milliseconds,
+# as pymongo reads them back.
+
+def now():
+    current = datetime.now(timezone.utc).replace(tzinfo=None)
+    return current.replace(microsecond=current.microsecond // 1000 * 1000)
+
+def stamp_new(document):
+    """Stamp a document about to be inserted."""
+    document["_version"] = 1
+    document["updated_at"] = now()
+    return document
+
+def stamped(update):
+    """Add the version increment and the write time to an update document."""
+    return {
+        **update,
+        "$inc": {**update.get("$inc", {}), "_version": 1},
+        "$set": {**update.get("$set", {}), "updated_at": now()},
+    }
+
+def updated_document(before, update):
+    """The document as stored once the stamped $set update has been applied to before."""
+    return {**before, **update["$set"], "_version": before.get("_version", 0) + 1}
+
+def document_etag(document, body=None):
+    # Documents written before versioning have no _version, their ETag is a hash of their body
+    if "_version" in document:
+        return f'"{document["_version"]}"'
+    if body is None:
+        return None
+    return f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+
+def last_modified(document):
+    updated_at = document.get("updated_at")
+    if not isinstance(updated_at, datetime):
+        return None
+    return http_date(calendar.timegm(updated_at.utctimetuple()))
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [value.strip().removeprefix("W/") for value in if_none_match.split(",")]